@@ -0,0 +1,45 @@
+# The models and main functions can be imported from the package directly, e.g.
+# "from occu_py import MaxLikOccu". Their modules are only imported on first
+# access, so that importing the package does not load JAX, arviz or Stan.
+from importlib import import_module
+
+LAZY_ATTRIBUTES = {
+    "ChecklistModel": ".checklist_model",
+    "ChecklistData": ".checklist_dataset",
+    "load_ebird_dataset": ".checklist_dataset",
+    "load_example_dataset": ".checklist_dataset",
+    "MaxLikOccu": ".max_lik_occu",
+    "EMOccu": ".em_occu",
+    "MultiSpeciesOccuADVI": ".multi_species_occu_advi",
+    "MultiSpeciesOccuMCMC": ".multi_species_occu_mcmc",
+    "MultiSpeciesOccuLaplace": ".multi_species_occu_laplace",
+    "MultiSpeciesOccuStan": ".multi_species_occu_stan",
+    "MultiSpeciesPresenceAbsence": ".multi_species_presence_absence",
+    "simulate_checklist_data": ".simulation",
+    "cross_validate": ".cross_validation",
+    "compute_metrics": ".evaluation",
+    "FitCache": ".fit_cache",
+    "PredictionStore": ".prediction_store",
+    "export_predictor": ".export",
+    "load_predictor": ".predictor_runtime",
+}
+
+__all__ = list(LAZY_ATTRIBUTES)
+
+
+def __getattr__(name):
+
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(import_module(LAZY_ATTRIBUTES[name], __name__), name)
+
+    # Cache the attribute so that this is only called once per name.
+    globals()[name] = value
+
+    return value
+
+
+def __dir__():
+
+    return sorted(list(globals()) + __all__)
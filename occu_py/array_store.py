@@ -0,0 +1,117 @@
+# A single-file store for named arrays plus JSON metadata. The file starts with
+# a magic string and the length of a JSON header, which lists each array's
+# dtype, shape and byte offset. The arrays follow, each aligned to ALIGNMENT
+# bytes, so that they can be memory-mapped without copying.
+import os
+import json
+import struct
+import numpy as np
+
+MAGIC = b"OCCUARR1"
+ALIGNMENT = 64
+
+
+def _align(offset):
+
+    return ALIGNMENT * int(np.ceil(offset / ALIGNMENT))
+
+
+def save_array_store(target_file: str, arrays: dict, metadata=None) -> None:
+    """Saves arrays and metadata to a single file.
+
+    Args:
+        target_file: The file to write. It is written to a temporary file first
+            and then moved into place, so that readers never see a partial
+            file.
+        arrays: A dictionary mapping names to numpy arrays. Object arrays are
+            not supported; strings should be stored with a fixed-width unicode
+            dtype.
+        metadata: A JSON-serialisable dictionary.
+    """
+
+    arrays = {x: np.ascontiguousarray(y) for x, y in arrays.items()}
+
+    array_info = dict()
+    offset = 0
+
+    for cur_name, cur_array in arrays.items():
+
+        assert cur_array.dtype != object, f"Cannot store object array {cur_name}."
+
+        array_info[cur_name] = {
+            "dtype": cur_array.dtype.str,
+            "shape": list(cur_array.shape),
+            "offset": offset,
+        }
+
+        offset = _align(offset + cur_array.nbytes)
+
+    header = json.dumps(
+        {"metadata": metadata if metadata is not None else dict(), "arrays": array_info}
+    ).encode("utf-8")
+
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    temp_file = target_file + ".tmp"
+
+    with open(temp_file, "wb") as f:
+
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+
+        for cur_name, cur_array in arrays.items():
+            f.seek(data_start + array_info[cur_name]["offset"])
+            f.write(cur_array.tobytes())
+
+        # Make sure the file extends to the end of the last array.
+        f.truncate(data_start + offset)
+
+    os.replace(temp_file, target_file)
+
+
+def read_header(store_file: str):
+    # Returns the parsed JSON header and the offset at which the arrays start.
+
+    with open(store_file, "rb") as f:
+
+        assert f.read(len(MAGIC)) == MAGIC, f"{store_file} is not an array store."
+
+        (header_length,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length).decode("utf-8"))
+
+    return header, _align(len(MAGIC) + 8 + header_length)
+
+
+def load_array_store(store_file: str, mmap_mode="r"):
+    """Loads the arrays and metadata saved with save_array_store.
+
+    Args:
+        store_file: The file to load.
+        mmap_mode: If "r" or "r+", the arrays are views into a single memory
+            map of the file. If None, they are read into memory.
+
+    Returns:
+        A tuple of a dictionary of arrays and the metadata dictionary.
+    """
+
+    header, data_start = read_header(store_file)
+
+    if mmap_mode is None:
+        with open(store_file, "rb") as f:
+            buffer = np.frombuffer(f.read(), dtype=np.uint8)
+    else:
+        buffer = np.memmap(store_file, dtype=np.uint8, mode=mmap_mode)
+
+    arrays = dict()
+
+    for cur_name, cur_info in header["arrays"].items():
+
+        dtype = np.dtype(cur_info["dtype"])
+        shape = tuple(cur_info["shape"])
+        start = data_start + cur_info["offset"]
+        n_bytes = dtype.itemsize * int(np.prod(shape))
+
+        arrays[cur_name] = buffer[start : start + n_bytes].view(dtype).reshape(shape)
+
+    return arrays, header["metadata"]
@@ -4,10 +4,6 @@ import numpy as np
 import pandas as pd
 from glob import glob
 from os.path import join
-from ml_tools.paths import base_name_from_path
-from ml_tools.modelling import remove_correlated_variables
-from sklearn.preprocessing import LabelEncoder
-from ml_tools.sdm import land_cover_lookup
 import os
 
 
@@ -36,6 +32,8 @@ def load_ebird_dataset_using_env_var(
         join(os.environ["EBIRD_DATA_PATH"], "checklists_with_folds.csv"),
         join(os.environ["EBIRD_DATA_PATH"], "raster_cell_covs.csv"),
         join(os.environ["EBIRD_DATA_PATH"], "all_pa.csv"),
+        train_folds=train_folds,
+        test_folds=test_folds,
     )
 
     return ebird_dataset
@@ -48,6 +46,8 @@ def load_ebird_dataset(
     train_folds=[1, 2, 3],
     test_folds=[4],
 ):
+    from sklearn.preprocessing import LabelEncoder
+    from ml_tools.modelling import remove_correlated_variables
 
     sampling_data = pd.read_csv(ebird_checklist_file, index_col=0)
     species_pa_df = pd.read_csv(species_pa_file, index_col=0)
@@ -111,9 +111,31 @@ def load_ebird_dataset(
     return {"train": train_data, "test": test_data}
 
 
+def load_example_dataset(data_dir):
+    """Loads a dataset stored in the format of examples/data.
+
+    Args:
+        data_dir: Folder containing X_env.csv, X_checklist.csv, y_checklist.csv
+            and checklist_cell_ids.csv.
+
+    Returns:
+        The dataset as ChecklistData.
+    """
+
+    X_env = pd.read_csv(join(data_dir, "X_env.csv"), index_col=0)
+    X_obs = pd.read_csv(join(data_dir, "X_checklist.csv"), index_col=0)
+    y_obs = pd.read_csv(join(data_dir, "y_checklist.csv"), index_col=0).astype(int)
+    cell_ids = pd.read_csv(join(data_dir, "checklist_cell_ids.csv"), index_col=0)
+
+    return ChecklistData(
+        X_env=X_env, X_obs=X_obs, y_obs=y_obs, env_cell_ids=cell_ids.values[:, 0]
+    )
+
+
 def random_cell_subset(
     n_cells, numeric_checklist_cell_ids, n_cells_to_pick=1000, seed=2
 ):
+    from sklearn.preprocessing import LabelEncoder
 
     np.random.seed(seed)
 
@@ -160,6 +182,7 @@ def random_checklist_subset(
 
 
 def add_derived_covariates_env(X_env):
+    from ml_tools.sdm import land_cover_lookup
 
     land_covers = X_env[[x for x in X_env.columns if "X" in x and x != "X"]]
 
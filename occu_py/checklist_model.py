@@ -25,6 +25,77 @@ class ChecklistModel(ABC):
     ) -> np.ndarray:
         pass
 
+    def predict_conditional_occupancy(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ) -> pd.DataFrame:
+        """Predicts the probability of presence in each cell given the
+        checklists observed there.
+
+        This is one for species detected in a cell, and otherwise the
+        probability of presence given the non-detections. Cells without
+        checklists get the marginal probability of presence.
+
+        Args:
+            X_env: The environmental covariates of the cells.
+            X_checklist: The checklist covariates.
+            y_checklist: The detections on the checklists, with a column for
+                each species in the model.
+            checklist_cell_ids: The cell of each checklist, indexing X_env.
+
+        Returns:
+            A DataFrame of probabilities [n_cells x n_species].
+        """
+
+        raise NotImplementedError(
+            f"{type(self).__name__} does not predict conditional occupancy."
+        )
+
+    def predict_marginal_probabilities_to_store(
+        self,
+        target_folder: str,
+        X: pd.DataFrame,
+        X_obs=None,
+        chunk_size=100000,
+        dtype=np.float32,
+    ) -> None:
+        """Predicts the probabilities of presence, or of observation if X_obs is
+        given, and writes them to a prediction store in chunks of rows.
+
+        Only one chunk of predictions is held in memory at a time. The store
+        can be read with occu_py.prediction_store.PredictionStore.
+
+        Args:
+            target_folder: The folder of the store.
+            X: The environmental covariates (of each checklist's cell if X_obs
+                is given).
+            X_obs: The checklist covariates.
+            chunk_size: The number of rows predicted at once.
+            dtype: The floating point type to store the predictions as.
+        """
+        from .prediction_store import write_predictions
+
+        if X_obs is None:
+            predict_chunk = lambda rows: self.predict_marginal_probabilities_direct(
+                X.iloc[rows]
+            )
+        else:
+            predict_chunk = lambda rows: self.predict_marginal_probabilities_obs(
+                X.iloc[rows], X_obs.iloc[rows]
+            )
+
+        write_predictions(
+            target_folder,
+            predict_chunk,
+            X.shape[0],
+            X.index if X_obs is None else X_obs.index,
+            chunk_size=chunk_size,
+            dtype=dtype,
+        )
+
     @abstractmethod
     def save_model(self, target_folder: str) -> None:
         """Saves the model to files in the target folder.
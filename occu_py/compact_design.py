@@ -0,0 +1,616 @@
+# Compact design matrices for formulas with categorical factors.
+#
+# patsy expands categorical factors (e.g. protocol_type) into dense columns of
+# zeros and ones, so that the design matrix of a detection formula is mostly
+# zeros. Here, each term made up only of categorical factors (including the
+# intercept) is stored instead as one integer code per row, indexing the
+# combination of the term's categories, plus a small table with the term's
+# columns for each combination. Only the remaining terms, e.g. log_duration_z,
+# are stored as dense columns. The product with coefficients (design_dot) is
+# then a skinny matrix product plus one gather per categorical term.
+#
+# Terms that are mostly zero, such as the has_* land cover indicators of the
+# env formula, can instead be kept as a sparse block of their non-zero entries
+# (see sparse_threshold in build_compact_design), whose product with the
+# coefficients is a segment sum under JAX and a scipy sparse product otherwise.
+# Designs can also carry a standardisation of their columns, which design_dot
+# folds into the coefficients, so that scaling the covariates keeps them sparse.
+#
+# For an eBird-like detection formula with four categorical covariates and a
+# million checklists (see scripts/benchmark_compact_design.py), the design
+# takes 28MB instead of 240MB. The gathers are somewhat slower than the dense
+# product, though: about 1.3x for the jitted likelihood and 1.5x for its
+# gradient, so the saving is in memory rather than in time.
+import itertools
+import numpy as np
+from patsy import ModelDesc, EvalEnvironment
+from patsy.build import design_matrix_builders
+from patsy.categorical import categorical_to_int
+from patsy.missing import NAAction
+
+# Env terms with at most this fraction of non-zero entries, such as the has_*
+# indicators, are stored sparse. For a million rows, sparse indicators take a
+# fraction of the memory of dense ones; the jitted likelihood and gradient are
+# as fast up to about 5% density and become slower beyond about 10%.
+SPARSE_THRESHOLD = 0.1
+
+
+class CompactDesign(object):
+    """A design matrix stored as category codes, a sparse block and a dense block.
+
+    Attributes:
+        dense: The columns of the terms with numerical factors [n_rows x
+            n_dense].
+        dense_columns: The index of each dense column in the full matrix.
+        tables: For each categorical term, the values of its columns for each
+            combination of its categories [n_combinations x n_term_columns].
+        table_columns: For each categorical term, the indices of its columns
+            in the full matrix.
+        codes: For each categorical term, the combination of categories of each
+            row [n_rows], or None if the term has no factors (the intercept).
+        column_names: The names of the columns of the full matrix.
+        sparse_rows: The rows of the non-zero entries of the sparse terms, in
+            increasing order [n_non_zero].
+        sparse_columns: Their columns in the full matrix [n_non_zero].
+        sparse_values: Their values [n_non_zero].
+        column_means: If given, the means subtracted from each column of the
+            full matrix before dividing by column_scales.
+        column_scales: If given, the scales of the columns of the full matrix.
+    """
+
+    def __init__(
+        self,
+        dense,
+        dense_columns,
+        tables,
+        table_columns,
+        codes,
+        names,
+        sparse_rows=None,
+        sparse_columns=None,
+        sparse_values=None,
+        column_means=None,
+        column_scales=None,
+    ):
+
+        self.dense = dense
+        self.dense_columns = dense_columns
+        self.tables = tables
+        self.table_columns = table_columns
+        self.codes = codes
+        self.column_names = names
+
+        self.sparse_rows = (
+            np.zeros(0, dtype=np.int32) if sparse_rows is None else sparse_rows
+        )
+        self.sparse_columns = (
+            np.zeros(0, dtype=np.int32) if sparse_columns is None else sparse_columns
+        )
+        self.sparse_values = (
+            np.zeros(0, dtype=dense.dtype) if sparse_values is None else sparse_values
+        )
+
+        self.column_means = column_means
+        self.column_scales = column_scales
+
+        self._sparse_matrix = None
+
+    @property
+    def shape(self):
+
+        return (self.dense.shape[0], len(self.column_names))
+
+    @property
+    def dtype(self):
+
+        return self.dense.dtype
+
+    @property
+    def nbytes(self):
+
+        return (
+            self.dense.nbytes
+            + sum(x.nbytes for x in self.codes if x is not None)
+            + self.sparse_rows.nbytes
+            + self.sparse_columns.nbytes
+            + self.sparse_values.nbytes
+        )
+
+    def __getitem__(self, rows):
+        """Selects rows, given as a slice or as indices."""
+
+        rows = np.arange(self.shape[0])[rows]
+
+        # The entries of each selected row are contiguous in the sparse block.
+        starts = np.searchsorted(self.sparse_rows, rows, side="left")
+        lengths = np.searchsorted(self.sparse_rows, rows, side="right") - starts
+        offsets = np.cumsum(lengths) - lengths
+        entries = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+        return CompactDesign(
+            self.dense[rows],
+            self.dense_columns,
+            self.tables,
+            self.table_columns,
+            [None if x is None else x[rows] for x in self.codes],
+            self.column_names,
+            np.repeat(np.arange(len(rows), dtype=np.int32), lengths),
+            self.sparse_columns[entries],
+            self.sparse_values[entries],
+            self.column_means,
+            self.column_scales,
+        )
+
+    def pad(self, n_rows, n_non_zero=None):
+        """Appends zero rows up to n_rows, and zero entries to the sparse block
+        up to n_non_zero if given.
+
+        In the padded rows, the categorical terms take their first combination
+        of categories, so these rows are only zero in the dense and sparse
+        blocks.
+        """
+
+        n_padding = n_rows - self.shape[0]
+        n_entry_padding = (
+            0 if n_non_zero is None else n_non_zero - self.sparse_values.shape[0]
+        )
+
+        assert n_padding >= 0 and n_entry_padding >= 0
+
+        # The padded entries go in the last row, keeping the rows sorted.
+        pad_entries = lambda x, value: np.pad(
+            x, (0, n_entry_padding), constant_values=value
+        )
+
+        return CompactDesign(
+            np.pad(self.dense, ((0, n_padding), (0, 0))),
+            self.dense_columns,
+            self.tables,
+            self.table_columns,
+            [None if x is None else np.pad(x, (0, n_padding)) for x in self.codes],
+            self.column_names,
+            pad_entries(self.sparse_rows, n_rows - 1),
+            pad_entries(self.sparse_columns, 0),
+            pad_entries(self.sparse_values, 0),
+            self.column_means,
+            self.column_scales,
+        )
+
+    def sparse_matrix(self):
+        """Returns the sparse block as a scipy CSR matrix [n_rows x n_columns]."""
+        from scipy.sparse import csr_matrix
+
+        if self._sparse_matrix is None:
+            indptr = np.searchsorted(self.sparse_rows, np.arange(self.shape[0] + 1))
+            self._sparse_matrix = csr_matrix(
+                (self.sparse_values, self.sparse_columns, indptr), shape=self.shape
+            )
+
+        return self._sparse_matrix
+
+    def to_dense(self):
+        """Returns the equivalent dense design matrix."""
+
+        result = np.zeros(self.shape, dtype=self.dense.dtype)
+        result[:, self.dense_columns] = self.dense
+
+        for table, columns, codes in zip(self.tables, self.table_columns, self.codes):
+            result[:, columns] = table[0] if codes is None else table[codes]
+
+        # The sparse entries are added, as in design_dot, so that the zero
+        # entries added by pad leave the other blocks unchanged.
+        np.add.at(result, (self.sparse_rows, self.sparse_columns), self.sparse_values)
+
+        if self.column_scales is not None:
+            result = (result - self.column_means) / self.column_scales
+
+        return result
+
+
+def _flatten_compact_design(design):
+
+    children = (
+        design.dense,
+        design.tables,
+        design.codes,
+        design.sparse_rows,
+        design.sparse_columns,
+        design.sparse_values,
+        design.column_means,
+        design.column_scales,
+    )
+
+    # The column indices are static: they determine which computation is
+    # compiled.
+    aux_data = (
+        tuple(int(x) for x in design.dense_columns),
+        tuple(tuple(int(y) for y in x) for x in design.table_columns),
+        tuple(design.column_names),
+    )
+
+    return children, aux_data
+
+
+def _unflatten_compact_design(aux_data, children):
+
+    dense_columns, table_columns, names = aux_data
+    dense, tables, codes, *sparse_block, column_means, column_scales = children
+
+    return CompactDesign(
+        dense,
+        np.array(dense_columns, dtype=int),
+        tables,
+        [np.array(x, dtype=int) for x in table_columns],
+        codes,
+        list(names),
+        *sparse_block,
+        column_means,
+        column_scales,
+    )
+
+
+_pytree_registered = False
+
+
+def register_pytree():
+    """Registers CompactDesign as a JAX pytree, so that designs can be passed
+    to jitted functions as arguments.
+
+    This module does not import JAX, so that importing the models stays fast;
+    the modules passing designs to jitted functions call this instead when
+    they are imported. Calling it again has no effect.
+    """
+    global _pytree_registered
+
+    if not _pytree_registered:
+        from jax.tree_util import register_pytree_node
+
+        register_pytree_node(
+            CompactDesign, _flatten_compact_design, _unflatten_compact_design
+        )
+        _pytree_registered = True
+
+
+def as_dense(design):
+    """Returns a design matrix as a dense array."""
+
+    return design.to_dense() if isinstance(design, CompactDesign) else design
+
+
+def pad_design(design, n_rows, n_non_zero=None):
+    """Appends zero rows to a dense or compact design up to n_rows.
+
+    For a CompactDesign, the sparse block is padded to n_non_zero entries if
+    given; see CompactDesign.pad.
+    """
+
+    if isinstance(design, CompactDesign):
+        return design.pad(n_rows, n_non_zero)
+
+    return np.pad(design, ((0, n_rows - design.shape[0]), (0, 0)))
+
+
+def standardise_design(design: CompactDesign, means, scales) -> CompactDesign:
+    """Returns the design with its columns standardised as (x - means) / scales.
+
+    Means or scales of None leave the columns uncentred or unscaled,
+    respectively, as with a StandardScaler's mean_ and scale_. They are stored
+    in the design's dtype.
+    """
+
+    n_columns = design.shape[1]
+
+    return CompactDesign(
+        design.dense,
+        design.dense_columns,
+        design.tables,
+        design.table_columns,
+        design.codes,
+        design.column_names,
+        design.sparse_rows,
+        design.sparse_columns,
+        design.sparse_values,
+        (
+            np.zeros(n_columns, dtype=design.dtype)
+            if means is None
+            else np.asarray(means, dtype=design.dtype)
+        ),
+        (
+            np.ones(n_columns, dtype=design.dtype)
+            if scales is None
+            else np.asarray(scales, dtype=design.dtype)
+        ),
+    )
+
+
+def fit_standard_scaler(design, chunk_size=100000):
+    """Fits a StandardScaler to a design, densifying one chunk of rows at a time."""
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler()
+
+    for start in range(0, design.shape[0], chunk_size):
+        scaler.partial_fit(as_dense(design[start : start + chunk_size]))
+
+    return scaler
+
+
+def accumulate_dot(a, b, accumulation_dtype=None):
+    # Returns a @ b. If accumulation_dtype is given, the JAX product is
+    # accumulated (and returned) in this dtype, e.g. float64 for float32
+    # inputs; this also applies to the products in its gradient.
+
+    if accumulation_dtype is None:
+        return a @ b
+
+    import jax.numpy as jnp
+
+    return jnp.matmul(a, b, preferred_element_type=accumulation_dtype)
+
+
+def sparse_dot(design, coefs, accumulation_dtype=None):
+    # The product of the sparse block with coefficients. JAX arrays (including
+    # tracers under jit and vmap) use a segment sum over the rows; numpy arrays
+    # use scipy's sparse product.
+
+    if isinstance(coefs, np.ndarray):
+        return design.sparse_matrix() @ coefs
+
+    from jax.ops import segment_sum
+
+    values = design.sparse_values.reshape((-1,) + (1,) * (coefs.ndim - 1))
+    products = values * coefs[design.sparse_columns]
+
+    if accumulation_dtype is not None:
+        products = products.astype(accumulation_dtype)
+
+    return segment_sum(
+        products,
+        design.sparse_rows,
+        num_segments=design.shape[0],
+        indices_are_sorted=True,
+    )
+
+
+def design_dot(design, coefs, accumulation_dtype=None):
+    """Multiplies a design matrix with coefficients.
+
+    Args:
+        design: A dense design matrix or a CompactDesign.
+        coefs: The coefficients [n_columns] or [n_columns x k], as a numpy or
+            JAX array.
+        accumulation_dtype: If given, the sums making up the product (and its
+            gradient) are accumulated in this dtype, which is also that of the
+            result. Only for JAX arrays.
+
+    Returns:
+        The product [n_rows] or [n_rows x k].
+    """
+
+    if not isinstance(design, CompactDesign):
+        return accumulate_dot(design, coefs, accumulation_dtype)
+
+    if design.column_scales is not None:
+        # (X - m) / s @ b = X @ (b / s) - m @ (b / s)
+        coefs = coefs / design.column_scales.reshape((-1,) + (1,) * (coefs.ndim - 1))
+
+    result = accumulate_dot(
+        design.dense, coefs[design.dense_columns], accumulation_dtype
+    )
+
+    for table, columns, codes in zip(design.tables, design.table_columns, design.codes):
+
+        term_values = accumulate_dot(table, coefs[columns], accumulation_dtype)
+        result = result + (term_values[0] if codes is None else term_values[codes])
+
+    if design.sparse_values.shape[0] > 0:
+        result = result + sparse_dot(design, coefs, accumulation_dtype)
+
+    if design.column_scales is not None:
+        result = result - accumulate_dot(design.column_means, coefs, accumulation_dtype)
+
+    return result
+
+
+def evaluate_factors(design_info, factors, data):
+    # Returns the category codes of categorical factors and the values
+    # [n_rows x n_columns] of numerical ones.
+
+    values = dict()
+
+    for cur_factor in factors:
+
+        cur_info = design_info.factor_infos[cur_factor]
+        cur_values = cur_factor.eval(cur_info.state, data)
+
+        if cur_info.type == "categorical":
+            values[cur_factor] = np.asarray(
+                categorical_to_int(
+                    cur_values,
+                    cur_info.categories,
+                    NAAction("raise"),
+                    origin=cur_factor,
+                )
+            )
+        else:
+            cur_values = np.asarray(cur_values, dtype=float)
+            values[cur_factor] = cur_values.reshape(cur_values.shape[0], -1)
+
+    return values
+
+
+def evaluate_term_columns(design_info, term, factor_values, n_rows):
+    # Computes the columns of a term from the values of its factors, as
+    # returned by evaluate_factors. As in patsy, each column of a subterm is
+    # the product of one column of each factor (from the contrast matrix for
+    # categorical factors), with the left-most factor varying fastest.
+
+    columns = list()
+
+    for cur_subterm in design_info.term_codings[term]:
+
+        pieces = list()
+
+        for cur_factor in cur_subterm.factors:
+
+            cur_values = factor_values[cur_factor]
+
+            if cur_factor in cur_subterm.contrast_matrices:
+                matrix = cur_subterm.contrast_matrices[cur_factor].matrix
+                pieces.append([matrix[cur_values, i] for i in range(matrix.shape[1])])
+            else:
+                pieces.append([cur_values[:, i] for i in range(cur_values.shape[1])])
+
+        for cur_combination in itertools.product(*reversed(pieces)):
+
+            # Terms without factors (the intercept) have a column of ones.
+            columns.append(
+                np.prod(np.stack(cur_combination), axis=0)
+                if len(cur_combination) > 0
+                else np.ones(n_rows)
+            )
+
+    return np.stack(columns, axis=1)
+
+
+def find_non_zero(values, columns):
+    # Returns the rows, columns and values of the non-zero entries of a block
+    # of columns [n_rows x n_block_columns], in row-major order.
+
+    rows, block_columns = np.nonzero(values)
+
+    return rows, columns[block_columns], values[rows, block_columns]
+
+
+def build_compact_design(
+    design_info, data, dtype=np.float64, sparse_threshold=None, drop_intercept=False
+) -> CompactDesign:
+    """Builds the compact version of a design matrix.
+
+    This is the equivalent of build_design_matrices([design_info], data)[0];
+    however, missing values raise an error rather than being dropped.
+
+    Args:
+        design_info: The patsy design info.
+        data: The data, e.g. a data frame.
+        dtype: The floating point type of the dense block and the tables.
+        sparse_threshold: If given, terms whose fraction of non-zero entries
+            is at most this are stored in the sparse block.
+        drop_intercept: Whether to leave out the intercept column.
+
+    Returns:
+        The CompactDesign.
+    """
+
+    dense_blocks, dense_columns = list(), list()
+    tables, table_columns, codes = list(), list(), list()
+    sparse_blocks, column_names = list(), list()
+
+    factor_values = evaluate_factors(design_info, design_info.factor_infos, data)
+    n_rows = data.shape[0]
+
+    def is_sparse(values):
+        return sparse_threshold is not None and (
+            np.count_nonzero(values) <= sparse_threshold * values.size
+        )
+
+    for cur_term, cur_slice in design_info.term_slices.items():
+
+        if drop_intercept and len(cur_term.factors) == 0:
+            continue
+
+        cur_names = design_info.column_names[cur_slice]
+        cur_columns = np.arange(len(column_names), len(column_names) + len(cur_names))
+        column_names.extend(cur_names)
+
+        cur_infos = [design_info.factor_infos[x] for x in cur_term.factors]
+
+        if any(x.type == "numerical" for x in cur_infos):
+
+            cur_values = evaluate_term_columns(
+                design_info, cur_term, factor_values, n_rows
+            )
+
+            if is_sparse(cur_values):
+                sparse_blocks.append(find_non_zero(cur_values, cur_columns))
+            else:
+                dense_blocks.append(cur_values)
+                dense_columns.extend(cur_columns.tolist())
+
+            continue
+
+        # Enumerate the combinations of the term's categories, the left-most
+        # factor varying fastest, and find each row's combination.
+        n_categories = [len(x.categories) for x in cur_infos]
+        grid = [x.ravel(order="F") for x in np.indices(n_categories)]
+        grid_values = dict(zip(cur_term.factors, grid))
+
+        cur_table = evaluate_term_columns(
+            design_info, cur_term, grid_values, int(np.prod(n_categories))
+        ).astype(dtype)
+
+        if len(cur_term.factors) == 0:
+            tables.append(cur_table)
+            table_columns.append(cur_columns)
+            codes.append(None)
+            continue
+
+        strides = np.cumprod([1] + n_categories[:-1])
+        combined = sum(x * factor_values[y] for x, y in zip(strides, cur_term.factors))
+
+        # Indicators such as has_* columns mostly take a zero row of the table.
+        if is_sparse(cur_table[combined]):
+            sparse_blocks.append(find_non_zero(cur_table[combined], cur_columns))
+            continue
+
+        tables.append(cur_table)
+        table_columns.append(cur_columns)
+        codes.append(combined.astype(np.min_scalar_type(cur_table.shape[0] - 1)))
+
+    dense = (
+        np.concatenate(dense_blocks, axis=1)
+        if len(dense_blocks) > 0
+        else np.zeros((n_rows, 0))
+    )
+
+    # Merge the sparse terms, keeping the entries of each row together.
+    sparse_rows, sparse_columns, sparse_values = [
+        np.concatenate([np.zeros(0)] + [x[i] for x in sparse_blocks]) for i in range(3)
+    ]
+    order = np.argsort(sparse_rows, kind="stable")
+
+    return CompactDesign(
+        dense.astype(dtype),
+        np.array(dense_columns, dtype=int),
+        tables,
+        table_columns,
+        codes,
+        column_names,
+        sparse_rows[order].astype(np.int32),
+        sparse_columns[order].astype(np.int32),
+        sparse_values[order].astype(dtype),
+    )
+
+
+def compact_dmatrix(formula: str, data, eval_env=0, **kwargs):
+    """The compact equivalent of patsy's dmatrix(formula, data).
+
+    The design info is learnt from the data without building the dense design
+    matrix. Variables in the formula are looked up in the caller's namespace,
+    as with dmatrix. Further keyword arguments are passed on to
+    build_compact_design.
+
+    Returns:
+        A tuple of the CompactDesign and the patsy design info.
+    """
+
+    eval_env = EvalEnvironment.capture(eval_env, reference=1)
+
+    design_info = design_matrix_builders(
+        [ModelDesc.from_formula(formula).rhs_termlist],
+        lambda: iter([data]),
+        eval_env,
+        NA_action="raise",
+    )[0]
+
+    return build_compact_design(design_info, data, **kwargs), design_info
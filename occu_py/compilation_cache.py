@@ -0,0 +1,122 @@
+# A persistent cache of the executables XLA compiles for model fits, so that
+# refitting the same model structure (e.g. per fold, per region or after a data
+# refresh) in a new process loads them from disk instead of compiling again.
+#
+# This uses JAX's persistent compilation cache, whose key is a hash of the
+# compiled computation: the model's likelihood and solver, the number of
+# columns its formulas produce, the shapes and dtypes of the data, and the
+# backend. Two things are needed for refits to share entries:
+#
+# - The data must be passed to the jitted functions as arguments. Arrays closed
+#   over are baked into the computation as constants, so that any change to the
+#   data changes the key (and makes compiling slower). To pass the compact
+#   designs as arguments, CompactDesign is registered as a pytree (see
+#   compact_design.register_pytree).
+# - The data must have the same shapes, so the fits pad the numbers of cells,
+#   checklists and sparse entries up to the sizes given by bucket_size, with
+#   zero weights for the padding.
+#
+# Fits whose likelihood is handed to an external optimiser as a closure (the
+# ADVI fit and MaxLikOccu's trust-ncg solver) still compile their data in, so
+# they only benefit for identical data.
+import os
+from collections import Counter
+from jax import config, monitoring
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "occu_py", "jax_compilation_cache"
+)
+
+# Set this environment variable to use a different default directory.
+CACHE_DIR_ENV_VAR = "OCCU_PY_COMPILATION_CACHE_DIR"
+
+_REQUEST_EVENT = "/jax/compilation_cache/compile_requests_use_cache"
+_HIT_EVENT = "/jax/compilation_cache/cache_hits"
+_TIME_SAVED_EVENT = "/jax/compilation_cache/compile_time_saved_sec"
+
+_cache_stats = Counter()
+_listeners_registered = False
+
+
+def _record_event(event, **kwargs):
+
+    if event == _REQUEST_EVENT:
+        _cache_stats["requests"] += 1
+    elif event == _HIT_EVENT:
+        _cache_stats["hits"] += 1
+
+
+def _record_duration(event, duration_secs, **kwargs):
+
+    if event == _TIME_SAVED_EVENT:
+        _cache_stats["seconds_saved"] += duration_secs
+
+
+def enable_compilation_cache(cache_dir=None, min_compile_time_secs=0.0):
+    """Enables JAX's persistent compilation cache for this process.
+
+    Args:
+        cache_dir: The directory to store the compiled executables in. If None,
+            the directory in the environment variable
+            OCCU_PY_COMPILATION_CACHE_DIR is used, or DEFAULT_CACHE_DIR if that
+            is not set.
+        min_compile_time_secs: Only computations that take at least this long
+            to compile are cached.
+
+    Returns:
+        The cache directory.
+    """
+
+    global _listeners_registered
+
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV_VAR, DEFAULT_CACHE_DIR)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    config.update("jax_compilation_cache_dir", cache_dir)
+    config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_secs)
+    config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+
+    if not _listeners_registered:
+        monitoring.register_event_listener(_record_event)
+        monitoring.register_event_duration_secs_listener(_record_duration)
+        _listeners_registered = True
+
+    return cache_dir
+
+
+def get_compilation_cache_stats():
+    """Returns the hits and misses of the persistent compilation cache.
+
+    These are counted since the cache was enabled (or the counts were reset)
+    and returned as a dictionary with the number of "hits" and "misses", and the
+    compile time saved by the hits in "seconds_saved".
+    """
+
+    return {
+        "hits": _cache_stats["hits"],
+        "misses": _cache_stats["requests"] - _cache_stats["hits"],
+        "seconds_saved": _cache_stats["seconds_saved"],
+    }
+
+
+def reset_compilation_cache_stats():
+
+    _cache_stats.clear()
+
+
+def bucket_size(n, min_size=256, sizes_per_doubling=8):
+    """Rounds n up to the next size in a fixed set of bucket sizes.
+
+    The sizes are min_size and then sizes_per_doubling evenly spaced sizes
+    between each power of two and the next, so that padding adds at most
+    1 / sizes_per_doubling to the size of the data.
+    """
+
+    if n <= min_size:
+        return min_size
+
+    step = max(2 ** (int(n).bit_length() - 1) // sizes_per_doubling, 1)
+
+    return -(-n // step) * step
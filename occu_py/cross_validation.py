@@ -0,0 +1,201 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from os.path import join
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .checklist_dataset import ChecklistData
+from .checklist_model import ChecklistModel
+from .evaluation import compute_metrics
+from .fit_cache import fingerprint_fit
+
+
+def subset_checklists(data: ChecklistData, checklist_mask: np.ndarray):
+    """Subsets a dataset to some of its checklists and the cells they use.
+
+    Args:
+        data: The dataset to subset.
+        checklist_mask: Boolean mask selecting the checklists to keep.
+
+    Returns:
+        The subset as ChecklistData, with env_cell_ids renumbered to index the
+        rows of the subset X_env.
+    """
+
+    cell_ids = data.env_cell_ids[checklist_mask]
+    cells_used, new_cell_ids = np.unique(cell_ids, return_inverse=True)
+
+    return ChecklistData(
+        X_env=data.X_env.iloc[cells_used],
+        X_obs=data.X_obs[checklist_mask],
+        y_obs=data.y_obs[checklist_mask],
+        env_cell_ids=new_cell_ids,
+    )
+
+
+def create_fold_splits(data: ChecklistData, fold_ids: np.ndarray):
+    """Creates the train / test splits for cross-validation.
+
+    Args:
+        data: The full dataset.
+        fold_ids: The fold of each checklist in data.
+
+    Returns:
+        A dictionary mapping each fold to a dictionary with entries "train"
+        (all other folds) and "test" (the fold itself), both ChecklistData.
+    """
+
+    return {
+        cur_fold: {
+            "train": subset_checklists(data, fold_ids != cur_fold),
+            "test": subset_checklists(data, fold_ids == cur_fold),
+        }
+        for cur_fold in np.unique(fold_ids)
+    }
+
+
+def compute_held_out_metrics(y: pd.DataFrame, pred_probs: pd.DataFrame, eps=1e-10):
+    """Computes per-species held-out metrics for checklist-level predictions.
+
+    Args:
+        y: Observed detections [checklists x species].
+        pred_probs: Predicted detection probabilities, same shape as y.
+        eps: Probabilities are clipped to [eps, 1 - eps] for the log likelihood.
+
+    Returns:
+        A DataFrame indexed by species with the mean held-out log likelihood
+        per checklist ("log_lik"), the Brier score ("brier") and the AUC
+        ("auc"), which is NaN for species with only one outcome in y. See
+        occu_py.evaluation.compute_metrics.
+    """
+
+    return compute_metrics(y, pred_probs, eps=eps)
+
+
+def fingerprint_fold(model: ChecklistModel, split: dict):
+    """Returns a fingerprint of evaluating the model on a fold.
+
+    This combines the fingerprint of fitting the model to the training data
+    (see fit_cache.fingerprint_fit), which covers the model's configuration,
+    with one of the test data.
+    """
+
+    hasher = hashlib.blake2b(digest_size=16)
+
+    for cur_set in [split["train"], split["test"]]:
+        hasher.update(
+            fingerprint_fit(
+                model,
+                cur_set.X_env,
+                cur_set.X_obs,
+                cur_set.y_obs,
+                cur_set.env_cell_ids,
+            ).encode()
+        )
+
+    return hasher.hexdigest()
+
+
+def fit_and_evaluate_fold(
+    model: ChecklistModel, train: ChecklistData, test: ChecklistData
+):
+    """Fits the model on the training data and evaluates it on the test data.
+
+    Returns:
+        The output of compute_held_out_metrics on the test checklists.
+    """
+
+    model.fit(
+        X_env=train.X_env,
+        X_checklist=train.X_obs,
+        y_checklist=train.y_obs,
+        checklist_cell_ids=train.env_cell_ids,
+    )
+
+    pred_probs = model.predict_marginal_probabilities_obs(
+        test.X_env.iloc[test.env_cell_ids], test.X_obs
+    )
+
+    return compute_held_out_metrics(test.y_obs, pred_probs)
+
+
+def cross_validate(
+    model: ChecklistModel,
+    data: ChecklistData,
+    fold_ids=None,
+    fold_column="fold_id",
+    cache_dir=None,
+    n_workers=None,
+):
+    """Runs k-fold cross-validation, fitting the folds in parallel.
+
+    Each fold is fitted on a copy of the (unfitted) model in a separate worker
+    process, and results are collected as folds finish. The folds are built
+    from the in-memory dataset, e.g. the "train" entry of load_ebird_dataset
+    called with all folds as training folds.
+
+    Args:
+        model: The model to evaluate. It must be picklable.
+        data: The dataset to cross-validate on.
+        fold_ids: The fold of each checklist. If None, these are taken from
+            the column fold_column of data.X_obs.
+        fold_column: See fold_ids.
+        cache_dir: If given, the results of each fold are stored in this folder
+            and folds with stored results are not refitted. The results are
+            stored under a fingerprint of the model's configuration and of the
+            fold's data (see fingerprint_fold), so that a different model or
+            dataset is never given the results of another.
+        n_workers: The number of worker processes. Defaults to the number of
+            CPUs.
+
+    Returns:
+        A DataFrame indexed by fold and species, with the held-out metrics
+        computed by compute_held_out_metrics.
+    """
+
+    if fold_ids is None:
+        fold_ids = data.X_obs[fold_column].values
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    results = dict()
+    splits = create_fold_splits(data, np.asarray(fold_ids))
+
+    if cache_dir is not None:
+        cache_files = {
+            x: join(cache_dir, f"fold_{x}_{fingerprint_fold(model, y)}.csv")
+            for x, y in splits.items()
+        }
+
+    for cur_fold in list(splits.keys()):
+
+        if cache_dir is not None and os.path.isfile(cache_files[cur_fold]):
+            results[cur_fold] = pd.read_csv(cache_files[cur_fold], index_col=0)
+            del splits[cur_fold]
+
+    # JAX does not support forking, so the workers are spawned.
+    with ProcessPoolExecutor(n_workers, mp_context=get_context("spawn")) as executor:
+
+        futures = {
+            executor.submit(
+                fit_and_evaluate_fold,
+                model,
+                cur_split["train"],
+                cur_split["test"],
+            ): cur_fold
+            for cur_fold, cur_split in splits.items()
+        }
+
+        for cur_future in as_completed(futures):
+
+            cur_fold = futures[cur_future]
+            results[cur_fold] = cur_future.result()
+
+            if cache_dir is not None:
+                results[cur_fold].to_csv(cache_files[cur_fold])
+
+    return pd.concat(
+        [results[x] for x in sorted(results)], keys=sorted(results), names=["fold"]
+    )
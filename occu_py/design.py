@@ -0,0 +1,197 @@
+# Saving and restoring patsy design infos without the training data.
+#
+# A fitted DesignInfo is encoded as JSON: its terms (lists of factor codes), its
+# column names, and for each factor its kind, its categories and the state of
+# any stateful transforms such as center or standardize. To restore it, the
+# terms are evaluated on a small synthetic data frame with the right variables
+# and categories, and the saved transform state is then put back.
+import os
+import json
+import numpy as np
+import pandas as pd
+from os.path import join
+from patsy import dmatrix, ModelDesc, Term, EvalFactor, EvalEnvironment
+from patsy import builtins as patsy_builtins
+from patsy.eval import ast_names
+
+ENCODING_VERSION = 1
+
+# Names that are not data variables when they appear in a factor's code.
+KNOWN_NAMES = set(patsy_builtins.__all__) | {"np", "numpy"}
+
+
+def to_json_value(value):
+    # Converts numpy scalars (e.g. in the categories) to Python ones.
+
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def encode_transform(transform):
+    # Encodes the attributes of a stateful transform. Arrays keep their dtype,
+    # although extended precision floats are stored as doubles.
+
+    state = dict()
+
+    for cur_name, cur_value in transform.__dict__.items():
+
+        if isinstance(cur_value, np.ndarray):
+            state[cur_name] = {
+                "dtype": cur_value.dtype.str,
+                "value": (
+                    cur_value.astype(float).tolist()
+                    if cur_value.dtype.kind == "f"
+                    else cur_value.tolist()
+                ),
+            }
+        else:
+            state[cur_name] = to_json_value(cur_value)
+
+    return {
+        "class": f"{type(transform).__module__}.{type(transform).__name__}",
+        "state": state,
+    }
+
+
+def encode_design_info(design_info) -> dict:
+    """Encodes a fitted patsy DesignInfo as a JSON-serialisable dictionary.
+
+    Args:
+        design_info: The design info, e.g. from dmatrix(formula, X).design_info.
+
+    Returns:
+        A dictionary with the column names, the terms as lists of factor codes
+        and, for each factor, its kind ("numerical" or "categorical"), its
+        number of columns or categories, the data variables it uses and the
+        state of its stateful transforms.
+    """
+
+    factors = dict()
+
+    for cur_factor, cur_info in design_info.factor_infos.items():
+
+        factors[cur_factor.code] = {
+            "kind": cur_info.type,
+            "num_columns": cur_info.num_columns,
+            "categories": (
+                None
+                if cur_info.categories is None
+                else [to_json_value(x) for x in cur_info.categories]
+            ),
+            "variables": sorted(set(ast_names(cur_factor.code)) - KNOWN_NAMES),
+            "transforms": {
+                x: encode_transform(y) for x, y in cur_info.state["transforms"].items()
+            },
+        }
+
+    return {
+        "version": ENCODING_VERSION,
+        "column_names": list(design_info.column_names),
+        "terms": [[x.code for x in y.factors] for y in design_info.terms],
+        "factors": factors,
+    }
+
+
+def create_synthetic_data(encoded):
+    # Creates a small data frame from which dmatrix can rebuild the design
+    # info: categorical variables cycle through their categories and numerical
+    # ones take positive values.
+
+    n_rows = max(
+        [3]
+        + [len(x["categories"]) for x in encoded["factors"].values() if x["categories"]]
+    )
+
+    data = dict()
+
+    for cur_factor in encoded["factors"].values():
+
+        for cur_variable in cur_factor["variables"]:
+
+            if cur_factor["kind"] == "categorical":
+                categories = cur_factor["categories"]
+                data[cur_variable] = pd.Categorical(
+                    [categories[i % len(categories)] for i in range(n_rows)],
+                    categories=categories,
+                )
+            elif cur_variable not in data:
+                data[cur_variable] = np.linspace(1.0, 2.0, n_rows)
+
+    return pd.DataFrame(data)
+
+
+def decode_design_info(encoded: dict):
+    """Reconstructs the patsy DesignInfo encoded with encode_design_info.
+
+    Raises:
+        ValueError: If the reconstructed design does not have the saved
+            columns, e.g. because a factor's variables could not be inferred.
+    """
+
+    model_desc = ModelDesc(
+        [], [Term([EvalFactor(x) for x in cur_term]) for cur_term in encoded["terms"]]
+    )
+
+    design_info = dmatrix(
+        model_desc,
+        create_synthetic_data(encoded),
+        eval_env=EvalEnvironment([{"np": np, "numpy": np}]),
+    ).design_info
+
+    if list(design_info.column_names) != encoded["column_names"]:
+        raise ValueError(
+            f"Could not reconstruct the design: expected columns "
+            f"{encoded['column_names']}, got {design_info.column_names}."
+        )
+
+    for cur_factor, cur_info in design_info.factor_infos.items():
+
+        saved_transforms = encoded["factors"][cur_factor.code]["transforms"]
+
+        for cur_name, cur_transform in cur_info.state["transforms"].items():
+
+            saved = saved_transforms[cur_name]
+            class_name = (
+                f"{type(cur_transform).__module__}.{type(cur_transform).__name__}"
+            )
+            assert class_name == saved["class"]
+
+            for cur_attribute, cur_value in saved["state"].items():
+
+                if isinstance(cur_value, dict) and "dtype" in cur_value:
+                    cur_value = np.array(cur_value["value"], dtype=cur_value["dtype"])
+
+                setattr(cur_transform, cur_attribute, cur_value)
+
+    return design_info
+
+
+def save_design_info_json(design_info, target_file: str) -> None:
+
+    with open(target_file, "w") as f:
+        json.dump(encode_design_info(design_info), f, indent=2)
+
+
+def load_design_info(folder: str, name: str):
+    """Loads the design info called name from a model folder.
+
+    This reads name + ".json", written by save_design_info_json. Folders saved
+    before this format was introduced contain name + ".pkl" instead, which is
+    restored with ml_tools.
+
+    Args:
+        folder: The model folder.
+        name: The file name without extension, e.g. "design_info_env".
+
+    Returns:
+        The patsy DesignInfo.
+    """
+
+    json_file = join(folder, name + ".json")
+
+    if os.path.isfile(json_file):
+        with open(json_file) as f:
+            return decode_design_info(json.load(f))
+
+    from ml_tools.patsy import restore_design_info
+
+    return restore_design_info(join(folder, name + ".pkl"))
@@ -0,0 +1,381 @@
+# Posterior draws stored for selective loading. The draws of each variable are
+# saved in an array store (see array_store.py) with their chains concatenated.
+# Variables with a species dimension are stored species-major, i.e. as
+# [n_species x n_draws x ...], so that the draws of one species are contiguous
+# on disk and reading a subset of species (and of draws) only touches the
+# corresponding blocks of the memory-mapped file.
+#
+# To keep files small, save_draw_store by default stores the draws as float32
+# and leaves out derived quantities (the obs_coefs, which are recomputed from
+# the non-centred parameters when they are read). It can also thin the draws
+# to a target number, which makes prediction proportionally faster. For a
+# Laplace fit with 64 species and 1000 draws (see
+# scripts/benchmark_draw_storage.py), the draws take 8.5MB as netCDF and 3.4MB
+# with the defaults; thinned to 250 draws, they take 0.8MB and predicting
+# 2000 checklists from the restored model is about three times faster.
+#
+# The rest of what the models need to predict (the species and coefficient
+# names, the formulas, any scaling of the env covariates) and their fit
+# results are saved by save_model_info in a second array store, rather than
+# pickled as they used to be.
+import os
+import json
+import numpy as np
+import pandas as pd
+from os.path import join
+from types import SimpleNamespace
+from .array_store import save_array_store, load_array_store
+
+DRAW_STORE_FILE = "posterior_draws.bin"
+REPRESENTATIVE_DRAWS_FILE = "representative_draws.json"
+MODEL_INFO_FILE = "model_info.bin"
+
+# Models saved before save_model_info pickled their model info here.
+LEGACY_MODEL_INFO_FILE = "design_info.pkl"
+
+# The variables whose last dimension indexes the species.
+SPECIES_VARIABLES = ["env_slopes", "env_intercepts", "obs_coefs_raw", "obs_coefs"]
+
+# Deterministic functions of the other variables, which need not be stored.
+DERIVED_VARIABLES = ["obs_coefs"]
+
+
+class DrawStore(object):
+    """Posterior draws loaded lazily from a file written by save_draw_store.
+
+    Draws are returned in the same layout as the flattened posterior of an
+    arviz InferenceData, i.e. [n_draws x ... x n_species], but only the
+    requested species and draws are read from disk.
+    """
+
+    def __init__(self, store_file: str, mmap_mode="r"):
+
+        self.arrays, self.metadata = load_array_store(store_file, mmap_mode)
+        self.species_names = self.metadata["species_names"]
+        self.n_draws = self.metadata["n_draws"]
+
+    def __contains__(self, name):
+
+        return name in self.arrays
+
+    def get(self, name, species_indices=None, draw_indices=None):
+        """Reads the draws of a variable.
+
+        Args:
+            name: The variable name, e.g. "env_slopes".
+            species_indices: The indices of the species to read. All species
+                are read if None. Ignored for variables without a species
+                dimension.
+            draw_indices: The draws to read, as a slice or an array of
+                indices. All draws are read if None.
+
+        Returns:
+            The draws [n_draws x ... x n_species].
+        """
+
+        if name == "obs_coefs" and name not in self.arrays:
+            # As in functional.model.transform_non_centred.
+            raw = self.get("obs_coefs_raw", species_indices, draw_indices)
+            prior_means = self.get("obs_coef_prior_means", None, draw_indices)
+            prior_sds = self.get("obs_coef_prior_sds", None, draw_indices)
+
+            return raw * prior_sds + prior_means
+
+        stored = self.arrays[name]
+        draw_indices = slice(None) if draw_indices is None else draw_indices
+
+        if name not in self.metadata["species_variables"]:
+            return np.asarray(stored[draw_indices])
+
+        species_indices = (
+            slice(None) if species_indices is None else np.asarray(species_indices)
+        )
+
+        if isinstance(draw_indices, slice):
+            # Basic and advanced indexing can be combined in a single read.
+            values = stored[species_indices, draw_indices]
+        else:
+            values = stored[species_indices][:, draw_indices]
+
+        return np.moveaxis(np.asarray(values), 0, -1)
+
+
+def flatten_posterior(samples):
+    # Returns the draws of each variable of an arviz InferenceData with the
+    # chains concatenated.
+
+    return {
+        x: np.reshape(y.values, (-1, *y.values.shape[2:]))
+        for x, y in samples.posterior.items()
+    }
+
+
+def save_draw_store(
+    samples,
+    species_names,
+    target_file: str,
+    n_draws=None,
+    dtype=np.float32,
+    keep_derived=False,
+) -> None:
+    """Saves posterior draws in the species-major layout read by DrawStore.
+
+    Args:
+        samples: The draws, either as an arviz InferenceData or as a DrawStore
+            (e.g. when saving a restored model again).
+        species_names: The names of the species.
+        target_file: The file to write.
+        n_draws: If given, only this many evenly spaced draws are saved.
+        dtype: The floating point type of the saved draws. If None, the
+            draws are saved with their current type.
+        keep_derived: Whether to save the derived variables, too. By default
+            they are recomputed when read.
+    """
+
+    if isinstance(samples, DrawStore):
+        arrays = samples.arrays
+    else:
+        draws = flatten_posterior(samples)
+        arrays = {
+            x: np.moveaxis(y, -1, 0) if x in SPECIES_VARIABLES else y
+            for x, y in draws.items()
+        }
+
+    if not keep_derived:
+        arrays = {x: y for x, y in arrays.items() if x not in DERIVED_VARIABLES}
+
+    species_variables = [x for x in SPECIES_VARIABLES if x in arrays]
+    draw_indices = select_draws(samples, n_draws)
+
+    arrays = {
+        x: y[:, draw_indices] if x in species_variables else y[draw_indices]
+        for x, y in arrays.items()
+    }
+
+    if dtype is not None:
+        arrays = {
+            x: y.astype(dtype) if y.dtype.kind == "f" else y for x, y in arrays.items()
+        }
+
+    metadata = {
+        "species_names": [str(x) for x in species_names],
+        "species_variables": species_variables,
+        "n_draws": arrays[species_variables[0]].shape[1],
+    }
+
+    save_array_store(target_file, arrays, metadata)
+
+
+def fetch_draws(samples, name, species_indices=None, draw_indices=None):
+    """Fetches the draws of a variable [n_draws x ... x n_species].
+
+    Works both for arviz InferenceData (whose chains are concatenated) and for
+    DrawStores, from which only the requested species and draws are read.
+    """
+
+    if isinstance(samples, DrawStore):
+        return samples.get(name, species_indices, draw_indices)
+
+    values = samples.posterior[name].values
+    values = np.reshape(values, (-1, *values.shape[2:]))
+
+    if draw_indices is not None:
+        values = values[draw_indices]
+
+    if species_indices is not None and name in SPECIES_VARIABLES:
+        values = values[..., np.asarray(species_indices)]
+
+    return values
+
+
+def count_draws(samples):
+    # The total number of draws across chains.
+
+    if isinstance(samples, DrawStore):
+        return samples.n_draws
+
+    return samples.posterior.sizes["chain"] * samples.posterior.sizes["draw"]
+
+
+def select_draws(samples, n_draws=None):
+    """Returns a slice selecting n_draws evenly spaced draws (all if None)."""
+
+    n_available = count_draws(samples)
+
+    if n_draws is None or n_draws >= n_available:
+        return slice(None)
+
+    step = n_available // n_draws
+
+    return slice(0, step * n_draws, step)
+
+
+def find_species_indices(species_names, species=None):
+    """Returns the indices of the given species (None if species is None).
+
+    Raises:
+        ValueError: If any of the species were not part of the model.
+    """
+
+    if species is None:
+        return None
+
+    lookup = {x: i for i, x in enumerate(species_names)}
+    unknown = [x for x in species if x not in lookup]
+
+    if len(unknown) > 0:
+        raise ValueError(f"Species {unknown} are not part of the model.")
+
+    return np.array([lookup[x] for x in species], dtype=int)
+
+
+def save_representative_draws(representative_draws: dict, target_file: str) -> None:
+    """Saves representative draws, as returned by compress_posterior, to JSON."""
+
+    with open(target_file, "w") as f:
+        json.dump(
+            {
+                "indices": [int(x) for x in representative_draws["indices"]],
+                "weights": [float(x) for x in representative_draws["weights"]],
+                "errors": {
+                    str(x): y for x, y in representative_draws["errors"].items()
+                },
+            },
+            f,
+            indent=2,
+        )
+
+
+def load_representative_draws(representative_draws_file: str) -> dict:
+
+    with open(representative_draws_file) as f:
+        loaded = json.load(f)
+
+    return {
+        "indices": np.array(loaded["indices"], dtype=int),
+        "weights": np.array(loaded["weights"]),
+        "errors": loaded["errors"],
+    }
+
+
+def split_results(results: dict, prefix: str):
+    # Splits nested dictionaries of fit results (e.g. an optimiser's) into
+    # numerical arrays and JSON values, keyed by their paths joined by "/".
+    # Anything else, such as functions, is left out.
+
+    arrays, values = dict(), dict()
+
+    for cur_key, cur_value in results.items():
+
+        cur_name = f"{prefix}/{cur_key}"
+
+        if isinstance(cur_value, dict):
+            cur_arrays, cur_values = split_results(cur_value, cur_name)
+            arrays.update(cur_arrays)
+            values.update(cur_values)
+        elif cur_value is None or isinstance(cur_value, (bool, int, float, str)):
+            values[cur_name] = cur_value
+        elif isinstance(cur_value, np.generic):
+            values[cur_name] = cur_value.item()
+        else:
+            cur_array = np.asarray(cur_value)
+
+            if cur_array.dtype.kind in "biuf":
+                arrays[cur_name] = cur_array
+
+    return arrays, values
+
+
+def join_results(arrays: dict, values: dict, prefix: str) -> dict:
+    # Rebuilds the nested dictionary split by split_results.
+
+    results = dict()
+
+    for cur_name, cur_value in [*arrays.items(), *values.items()]:
+
+        if not cur_name.startswith(prefix + "/"):
+            continue
+
+        *parents, key = cur_name[len(prefix) + 1 :].split("/")
+        cur_dict = results
+
+        for cur_parent in parents:
+            cur_dict = cur_dict.setdefault(cur_parent, dict())
+
+        cur_dict[key] = cur_value
+
+    return results
+
+
+def save_model_info(
+    design_info: dict, target_file: str, metadata: dict, results=None
+) -> None:
+    """Saves what a Bayesian model needs besides its draws and design infos.
+
+    Args:
+        design_info: The model's design info, with the "env" and "obs" patsy
+            design infos, the "species_names" and, if the env covariates were
+            scaled, the "env_scaler".
+        target_file: The array store to write.
+        metadata: JSON-serialisable entries to save as well, e.g. the formulas.
+        results: A dictionary of named fit results, e.g. {"advi_results":
+            ...}. Their arrays are kept as arrays and their other entries as
+            JSON, leaving out those which are neither.
+    """
+
+    arrays = {"species_names": np.array(design_info["species_names"], dtype=str)}
+    metadata = {
+        "env_coef_names": list(design_info["env"].column_names),
+        "obs_coef_names": list(design_info["obs"].column_names),
+        **metadata,
+        "result_names": [],
+    }
+
+    if "env_scaler" in design_info:
+        arrays["env_scaler_mean"] = np.asarray(design_info["env_scaler"].mean_)
+        arrays["env_scaler_scale"] = np.asarray(design_info["env_scaler"].scale_)
+
+    for cur_name, cur_results in (results or dict()).items():
+        cur_arrays, metadata[cur_name] = split_results(cur_results, cur_name)
+        arrays.update(cur_arrays)
+        metadata["result_names"].append(cur_name)
+
+    save_array_store(target_file, arrays, metadata)
+
+
+def load_model_info(restore_folder: str) -> dict:
+    """Loads the model info saved by save_model_info.
+
+    Models saved before save_model_info have it in a pickle instead, which is
+    read if the array store is missing.
+
+    Returns:
+        A dictionary with the "species_names", the "env_coef_names" and
+        "obs_coef_names", the "env_scaler" if the env covariates were scaled,
+        and the metadata and named fit results saved.
+    """
+
+    if not os.path.isfile(join(restore_folder, MODEL_INFO_FILE)):
+        from ml_tools.utils import load_pickle_safely
+
+        return load_pickle_safely(join(restore_folder, LEGACY_MODEL_INFO_FILE))
+
+    # The model info is small, so it is read into memory.
+    arrays, metadata = load_array_store(
+        join(restore_folder, MODEL_INFO_FILE), mmap_mode=None
+    )
+
+    info = {x: y for x, y in metadata.items() if x != "result_names"}
+    info["species_names"] = pd.Index([str(x) for x in arrays["species_names"]])
+
+    if "env_scaler_mean" in arrays:
+        # Only the fitted attributes used in prediction are restored.
+        info["env_scaler"] = SimpleNamespace(
+            mean_=np.array(arrays["env_scaler_mean"]),
+            scale_=np.array(arrays["env_scaler_scale"]),
+        )
+
+    for cur_name in metadata["result_names"]:
+        info[cur_name] = join_results(arrays, metadata[cur_name], cur_name)
+
+    return info
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+from .max_lik_occu import MaxLikOccu
+
+
+class EMOccu(MaxLikOccu):
+    def __init__(
+        self,
+        env_formula,
+        det_formula,
+        verbose=False,
+        max_iter=2000,
+        tol=1e-4,
+        n_irls_steps=1,
+        species_batch_size=32,
+    ):
+        """Single-species occupancy detection models fit by EM.
+
+        This estimates the same model as MaxLikOccu, but instead of optimising
+        the likelihood directly, it alternates between computing the posterior
+        probability of occupancy of each cell and fitting two weighted logistic
+        regressions. Prediction, saving and restoring work as for MaxLikOccu.
+
+        Args:
+            env_formula: Patsy formula for the environmental covariates.
+            det_formula: Patsy formula for the detection covariates.
+            verbose: If True, shows progress while fitting.
+            max_iter: Maximum number of EM iterations.
+            tol: EM stops once the change in log likelihood of every species
+                in a batch is smaller than this.
+            n_irls_steps: Number of IRLS steps taken in each M-step.
+            species_batch_size: Number of species fit together.
+        """
+
+        # The options of MaxLikOccu not passed on keep their defaults: EM fits
+        # point estimates only, without bootstrap or covariance.
+        super().__init__(
+            env_formula,
+            det_formula,
+            verbose=verbose,
+            species_batch_size=species_batch_size,
+        )
+
+        self.max_iter = max_iter
+        self.tol = tol
+        self.n_irls_steps = n_irls_steps
+
+    def fit(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ) -> None:
+        from .functional.em_occu_model import fit
+
+        self.species_names = y_checklist.columns
+
+        self.fit_results = fit(
+            X_env,
+            X_checklist,
+            y_checklist.values,
+            checklist_cell_ids,
+            self.env_formula,
+            self.det_formula,
+            max_iter=self.max_iter,
+            tol=self.tol,
+            n_irls_steps=self.n_irls_steps,
+            species_batch_size=self.species_batch_size,
+            verbose=self.verbose,
+        )
+
+        self.env_design_info = self.fit_results[0]["env_design_info"]
+        self.obs_design_info = self.fit_results[0]["obs_design_info"]
+
+        self.stack_coefficients()
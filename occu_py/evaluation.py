@@ -0,0 +1,397 @@
+# Held-out metrics for all species at once, from matrices of predictions
+# [checklists x species] such as those of predict_marginal_probabilities_obs.
+#
+# compute_metrics computes them in memory, with the AUC from the ranks of the
+# predictions (the Mann-Whitney statistic), ranking all species together.
+# MetricsAccumulator computes the same metrics from chunks of checklists, for
+# test sets larger than memory. Its AUC counts the positives and negatives of
+# each species in fine bins of the predicted logit, which treats predictions
+# in the same bin (0.01 apart on the logit scale by default) as ties.
+# compute_metrics_from_store feeds it the chunks of prediction stores.
+#
+# Given the probabilities of presence as well, both also compute the
+# log likelihood of the checklists under the occupancy model, in which the
+# checklists of a cell share its presence or absence, using the functions in
+# occu_py.likelihoods.
+import numpy as np
+import pandas as pd
+from .precision import precision_scope
+
+
+def logit(probs, eps=1e-10):
+
+    probs = np.clip(probs, eps, 1 - eps)
+
+    return np.log(probs) - np.log1p(-probs)
+
+
+def log_sigmoid(logits):
+
+    return -np.logaddexp(0.0, -logits)
+
+
+def detection_logits(obs_probs, pres_probs, eps=1e-10):
+    # The logits of detection given presence, i.e. of obs_probs / pres_probs.
+
+    return logit(obs_probs / np.maximum(pres_probs, eps), eps)
+
+
+def rank_auc(y, probs, species_batch_size=256):
+    """Computes the AUC of each species from the ranks of its predictions.
+
+    Ties get their average rank. Species are ranked in batches of
+    species_batch_size at once.
+
+    Args:
+        y: Observed detections [checklists x species].
+        probs: Predictions [checklists x species].
+
+    Returns:
+        The AUC of each species, NaN for those with only one outcome in y.
+    """
+    from scipy.stats import rankdata
+
+    y = np.asarray(y, dtype=bool)
+    n_pos = y.sum(axis=0)
+    n_neg = y.shape[0] - n_pos
+
+    rank_sums = np.concatenate(
+        [
+            np.sum(
+                rankdata(probs[:, start : start + species_batch_size], axis=0)
+                * y[:, start : start + species_batch_size],
+                axis=0,
+            )
+            for start in range(0, y.shape[1], species_batch_size)
+        ]
+    )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auc = (rank_sums - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+    return np.where((n_pos > 0) & (n_neg > 0), auc, np.nan)
+
+
+def auc_from_counts(pos_counts, neg_counts):
+    """Computes the AUC of each species from binned counts of its predictions.
+
+    Args:
+        pos_counts: The number of positives in each bin, with bins in
+            increasing order of the prediction [species x bins].
+        neg_counts: The number of negatives, likewise.
+
+    Returns:
+        The AUC of each species, counting pairs in the same bin as ties; NaN
+        for those with only one outcome.
+    """
+
+    n_pos = pos_counts.sum(axis=1)
+    n_neg = neg_counts.sum(axis=1)
+
+    neg_below = np.cumsum(neg_counts, axis=1) - neg_counts
+    n_correct = np.sum(pos_counts * (neg_below + 0.5 * neg_counts), axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        auc = n_correct / (n_pos * n_neg)
+
+    return np.where((n_pos > 0) & (n_neg > 0), auc, np.nan)
+
+
+def occupancy_log_likelihood(y, obs_probs, pres_probs, cell_ids, eps=1e-10):
+    """Computes the log likelihood of the checklists under the occupancy model.
+
+    This uses compute_checklist_likelihood for all species at once, in double
+    precision.
+
+    Args:
+        y: Observed detections [checklists x species].
+        obs_probs: Predicted probabilities of detection [checklists x
+            species], i.e. of presence and detection.
+        pres_probs: Predicted probabilities of presence [checklists x
+            species]. These must be the same for all checklists of a cell.
+        cell_ids: The cell of each checklist [checklists].
+
+    Returns:
+        The log likelihood of each species, summed over cells.
+    """
+    from jax import vmap
+    from functools import partial
+    from .likelihoods import compute_checklist_likelihood
+
+    cell_ids = np.asarray(cell_ids)
+    cells, first_rows, cell_nums = np.unique(
+        cell_ids, return_index=True, return_inverse=True
+    )
+
+    pres_logits = logit(pres_probs[first_rows], eps)
+    obs_logits = detection_logits(obs_probs, pres_probs, eps)
+
+    per_species_lik = vmap(
+        partial(compute_checklist_likelihood, cell_nums=cell_nums, n_cells=len(cells)),
+        in_axes=(1, 1, 1),
+        out_axes=1,
+    )
+
+    with precision_scope("double"):
+        cell_liks = per_species_lik(
+            pres_logits, obs_logits, 1.0 - np.asarray(y, dtype=float)
+        )
+
+    return np.asarray(cell_liks).sum(axis=0)
+
+
+def compute_metrics(
+    y: pd.DataFrame,
+    obs_probs: pd.DataFrame,
+    pres_probs: pd.DataFrame = None,
+    cell_ids: np.ndarray = None,
+    eps=1e-10,
+):
+    """Computes per-species held-out metrics for checklist-level predictions.
+
+    Args:
+        y: Observed detections [checklists x species].
+        obs_probs: Predicted detection probabilities, same shape as y.
+        pres_probs: If given with cell_ids, the predicted probabilities of
+            presence in each checklist's cell, same shape as y.
+        cell_ids: The cell of each checklist.
+        eps: Probabilities are clipped to [eps, 1 - eps] for the log
+            likelihoods.
+
+    Returns:
+        A DataFrame indexed by species with the mean held-out log likelihood
+        per checklist ("log_lik"), the Brier score ("brier") and the AUC
+        ("auc"), which is NaN for species with only one outcome in y. If
+        pres_probs are given, "occu_log_lik" is the occupancy model's log
+        likelihood of the checklists (see occupancy_log_likelihood), divided by
+        the number of checklists.
+    """
+
+    species = pd.Index(obs_probs.columns, name="species")
+
+    y = np.asarray(y, dtype=float)
+    obs_probs = np.asarray(obs_probs, dtype=float)
+    clipped = np.clip(obs_probs, eps, 1 - eps)
+
+    metrics = pd.DataFrame(
+        {
+            "log_lik": np.mean(
+                y * np.log(clipped) + (1 - y) * np.log1p(-clipped), axis=0
+            ),
+            "brier": np.mean((obs_probs - y) ** 2, axis=0),
+            "auc": rank_auc(y, obs_probs),
+        },
+        index=species,
+    )
+
+    if pres_probs is not None:
+        metrics["occu_log_lik"] = (
+            occupancy_log_likelihood(
+                y, obs_probs, np.asarray(pres_probs, dtype=float), cell_ids, eps
+            )
+            / y.shape[0]
+        )
+
+    return metrics
+
+
+class MetricsAccumulator(object):
+    """Computes the metrics of compute_metrics from chunks of checklists.
+
+    Example:
+        accumulator = MetricsAccumulator(species_names)
+        for y, obs_probs in chunks:
+            accumulator.update(y, obs_probs)
+        metrics = accumulator.result()
+    """
+
+    def __init__(
+        self,
+        species_names,
+        n_cells=None,
+        n_auc_bins=4000,
+        max_abs_logit=20.0,
+        eps=1e-10,
+    ):
+        """
+        Args:
+            species_names: The names of the species, i.e. of the columns of the
+                chunks.
+            n_cells: If given, the occupancy log likelihood is computed as
+                well. The cell ids passed to update must then be below
+                n_cells. This keeps three arrays of [n_cells x species] floats.
+            n_auc_bins: The number of bins of the predicted logits for the AUC.
+            max_abs_logit: The bins span logits from -max_abs_logit to
+                max_abs_logit; predictions outside go into the outermost bins.
+            eps: As in compute_metrics.
+        """
+
+        self.species_names = pd.Index(species_names, name="species")
+        self.n_auc_bins = n_auc_bins
+        self.max_abs_logit = max_abs_logit
+        self.eps = eps
+
+        n_species = len(species_names)
+
+        self.n_checklists = 0
+        self.log_lik_sums = np.zeros(n_species)
+        self.squared_error_sums = np.zeros(n_species)
+        self.pos_counts = np.zeros((n_species, n_auc_bins), dtype=np.int64)
+        self.neg_counts = np.zeros((n_species, n_auc_bins), dtype=np.int64)
+
+        self.n_cells = n_cells
+
+        if n_cells is not None:
+            # Per cell: the logit of presence, the log likelihood of its
+            # checklists if present, and the number of detections.
+            self.pres_logits = np.full((n_cells, n_species), np.nan)
+            self.summed_liks = np.zeros((n_cells, n_species))
+            self.obs_per_cell = np.zeros((n_cells, n_species))
+
+    def update(self, y, obs_probs, pres_probs=None, cell_ids=None):
+        """Adds a chunk of checklists.
+
+        Args:
+            y: Observed detections [chunk_size x species].
+            obs_probs: Predicted detection probabilities, same shape as y.
+            pres_probs: The predicted probabilities of presence, same shape as
+                y. Required if n_cells was given.
+            cell_ids: The cell of each checklist. Required if n_cells was
+                given.
+        """
+
+        y = np.asarray(y, dtype=float)
+        obs_probs = np.asarray(obs_probs, dtype=float)
+
+        obs_logits = logit(obs_probs, self.eps)
+        n_species = y.shape[1]
+
+        self.n_checklists += y.shape[0]
+        self.log_lik_sums += np.sum(
+            y * log_sigmoid(obs_logits) + (1 - y) * log_sigmoid(-obs_logits), axis=0
+        )
+        self.squared_error_sums += np.sum((obs_probs - y) ** 2, axis=0)
+
+        # Count the bins of all species with a single bincount, offsetting the
+        # bins of each species.
+        bins = np.clip(
+            (obs_logits + self.max_abs_logit)
+            * (self.n_auc_bins / (2 * self.max_abs_logit)),
+            0,
+            self.n_auc_bins - 1,
+        ).astype(np.int64)
+        bins += np.arange(n_species) * self.n_auc_bins
+
+        for cur_counts, cur_mask in [
+            (self.pos_counts, y == 1),
+            (self.neg_counts, y == 0),
+        ]:
+            cur_counts += np.bincount(
+                bins[cur_mask], minlength=n_species * self.n_auc_bins
+            ).reshape(n_species, self.n_auc_bins)
+
+        if self.n_cells is not None:
+
+            cell_ids = np.asarray(cell_ids)
+            pres_probs = np.asarray(pres_probs, dtype=float)
+            det_logits = detection_logits(obs_probs, pres_probs, self.eps)
+
+            self.pres_logits[cell_ids] = logit(pres_probs, self.eps)
+
+            # As in compute_cell_likelihood_terms.
+            rel_log_probs = np.where(
+                y == 1, log_sigmoid(det_logits), log_sigmoid(-det_logits)
+            )
+            np.add.at(self.summed_liks, cell_ids, rel_log_probs)
+            np.add.at(self.obs_per_cell, cell_ids, y)
+
+    def result(self):
+        """Returns the metrics of all chunks added, as in compute_metrics."""
+
+        metrics = pd.DataFrame(
+            {
+                "log_lik": self.log_lik_sums / self.n_checklists,
+                "brier": self.squared_error_sums / self.n_checklists,
+                "auc": auc_from_counts(self.pos_counts, self.neg_counts),
+            },
+            index=self.species_names,
+        )
+
+        if self.n_cells is not None:
+            from .likelihoods import combine_cell_likelihood_terms
+
+            # Cells without checklists do not count.
+            has_checklists = ~np.isnan(self.pres_logits[:, 0])
+            pres_logits = self.pres_logits[has_checklists]
+
+            with precision_scope("double"):
+                cell_liks = combine_cell_likelihood_terms(
+                    log_sigmoid(-pres_logits),
+                    log_sigmoid(pres_logits) + self.summed_liks[has_checklists],
+                    self.obs_per_cell[has_checklists],
+                )
+
+            metrics["occu_log_lik"] = (
+                np.asarray(cell_liks).sum(axis=0) / self.n_checklists
+            )
+
+        return metrics
+
+
+def compute_metrics_from_store(
+    y: pd.DataFrame,
+    obs_probs_folder: str,
+    pres_probs_folder: str = None,
+    cell_ids: np.ndarray = None,
+    chunk_size=100000,
+    **kwargs,
+):
+    """Computes the metrics from prediction stores, reading chunk_size rows at
+    a time.
+
+    The stores are those written by predict_marginal_probabilities_to_store
+    (see occu_py.prediction_store), with one row per checklist in the order of
+    y, so that only one chunk of predictions is in memory at a time.
+
+    Args:
+        y: The observed detections [checklists x species]. Its columns must
+            include the species of the stores.
+        obs_probs_folder: The store of the predicted detection probabilities.
+        pres_probs_folder: If given with cell_ids, the store of the predicted
+            probabilities of presence, to compute the occupancy log likelihood.
+        cell_ids: The cell of each checklist.
+        chunk_size: The number of rows to read at a time.
+        kwargs: Passed on to MetricsAccumulator.
+
+    Returns:
+        The metrics, as in compute_metrics.
+    """
+    from .prediction_store import PredictionStore
+
+    stores = [PredictionStore(obs_probs_folder)]
+    species = stores[0].species_names
+
+    assert stores[0].shape[0] == y.shape[0], "The store and y differ in length."
+
+    if pres_probs_folder is not None:
+        stores.append(PredictionStore(pres_probs_folder))
+        assert stores[1].shape == stores[0].shape, "The stores differ in shape."
+        cell_nums, cells = pd.factorize(np.asarray(cell_ids))
+        kwargs["n_cells"] = len(cells)
+
+    y = y[species]
+    accumulator = MetricsAccumulator(species, **kwargs)
+
+    for start, chunks in zip(
+        range(0, y.shape[0], chunk_size),
+        zip(*[x.iter_chunks(chunk_size) for x in stores]),
+    ):
+
+        rows = slice(start, start + chunk_size)
+
+        if pres_probs_folder is None:
+            accumulator.update(y.iloc[rows], chunks[0])
+        else:
+            accumulator.update(y.iloc[rows], chunks[0], chunks[1], cell_nums[rows])
+
+    return accumulator.result()
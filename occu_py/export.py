@@ -0,0 +1,179 @@
+import itertools
+import numpy as np
+from .design import encode_design_info
+from .array_store import save_array_store
+from .draw_store import select_draws
+from .predictor_runtime import PREDICTOR_FORMAT, TRANSFORMS
+
+EXPORT_VERSION = 1
+
+
+def compile_design_recipe(design_info) -> dict:
+    """Compiles a patsy DesignInfo into a recipe for the numpy-only runtime.
+
+    Each column of the design matrix is the product of one column of each of
+    its factors: for numerical factors, a column of the evaluated code; for
+    categorical factors, a column of the contrast matrix, looked up by
+    category.
+
+    Args:
+        design_info: The fitted design info.
+
+    Returns:
+        A JSON-serialisable dictionary with the factors (their code, kind,
+        categories, variables and transform state) and the columns.
+
+    Raises:
+        NotImplementedError: If the design uses a stateful transform the
+            runtime does not support (only center, standardize and scale are).
+    """
+
+    encoded = encode_design_info(design_info)
+
+    for cur_factor, cur_info in design_info.factor_infos.items():
+
+        encoded_factor = encoded["factors"][cur_factor.code]
+        encoded_factor["eval_code"] = cur_info.state["eval_code"]
+
+        for cur_transform in encoded_factor["transforms"].values():
+            if cur_transform["class"] not in TRANSFORMS:
+                raise NotImplementedError(
+                    f"Cannot export {cur_factor.code}: the transform "
+                    f"{cur_transform['class']} is not supported."
+                )
+
+    columns = list()
+
+    for cur_subterms in design_info.term_codings.values():
+
+        for cur_subterm in cur_subterms:
+
+            pieces = list()
+
+            for cur_factor in cur_subterm.factors:
+
+                if cur_factor in cur_subterm.contrast_matrices:
+                    matrix = cur_subterm.contrast_matrices[cur_factor].matrix
+                    pieces.append(
+                        [
+                            {"code": cur_factor.code, "contrast": matrix[:, i].tolist()}
+                            for i in range(matrix.shape[1])
+                        ]
+                    )
+                else:
+                    n_columns = design_info.factor_infos[cur_factor].num_columns
+                    pieces.append(
+                        [
+                            {"code": cur_factor.code, "column": i}
+                            for i in range(n_columns)
+                        ]
+                    )
+
+            # As in patsy, the left-most factor varies fastest.
+            for cur_combination in itertools.product(*reversed(pieces)):
+                columns.append(list(reversed(cur_combination)))
+
+    assert len(columns) == len(design_info.column_names)
+
+    return {
+        "factors": encoded["factors"],
+        "columns": [
+            {"name": x, "factors": y} for x, y in zip(design_info.column_names, columns)
+        ],
+    }
+
+
+def fetch_coefficient_draws(model, n_draws):
+    # Returns the env coefficient draws, including the intercept, in the order
+    # of the env design matrix columns, and the obs coefficient draws.
+    # Both are [n_draws x n_coefs x n_species].
+
+    from .functional.hierarchical_checklist_model_mcmc import (
+        fetch_env_samples,
+        fetch_obs_samples,
+    )
+
+    draw_indices = select_draws(model.samples, n_draws)
+
+    env_slopes, env_intercepts = fetch_env_samples(model.samples, None, draw_indices)
+    obs_coefs = fetch_obs_samples(model.samples, None, draw_indices)
+
+    # Fold the scaling of the env covariates into the coefficients.
+    if "env_scaler" in model.design_info:
+
+        scaler = model.design_info["env_scaler"]
+        mean = scaler.mean_ if scaler.mean_ is not None else 0.0
+        scale = scaler.scale_ if scaler.scale_ is not None else 1.0
+
+        env_slopes = env_slopes / np.reshape(scale, (1, -1, 1))
+        env_intercepts = env_intercepts - np.einsum(
+            "c,dcs->ds", np.broadcast_to(mean, env_slopes.shape[1]), env_slopes
+        )
+
+    column_names = model.design_info["env"].column_names
+
+    # The models always have an intercept, whether or not the formula does; if
+    # it does not, the recipe gets an extra intercept column at the start.
+    intercept_index = (
+        column_names.index("Intercept") if "Intercept" in column_names else 0
+    )
+
+    env_coefs = np.insert(env_slopes, intercept_index, env_intercepts, axis=1)
+
+    return env_coefs, obs_coefs
+
+
+def export_predictor(model, target_file: str, n_draws=100, dtype=np.float64) -> None:
+    """Exports a fitted model for use with occu_py.predictor_runtime.
+
+    Maximum likelihood models (MaxLikOccu, EMOccu) are exported with their
+    point estimates. Bayesian models with posterior draws (MultiSpeciesOccuADVI,
+    MultiSpeciesOccuMCMC, MultiSpeciesOccuLaplace) are exported with n_draws
+    evenly spaced draws, over which the runtime averages its predictions.
+
+    Args:
+        model: The fitted model.
+        target_file: The file to write.
+        n_draws: The number of posterior draws to export.
+        dtype: The floating point type of the exported coefficients.
+    """
+
+    if hasattr(model, "env_coef_matrix"):
+
+        env_coefs = model.env_coef_matrix[None]
+        obs_coefs = model.obs_coef_matrix[None]
+        env_design_info = model.env_design_info
+        obs_design_info = model.obs_design_info
+        species_names = model.species_names
+
+    elif hasattr(model, "samples") and hasattr(model, "design_info"):
+
+        env_coefs, obs_coefs = fetch_coefficient_draws(model, n_draws)
+        env_design_info = model.design_info["env"]
+        obs_design_info = model.design_info["obs"]
+        species_names = model.design_info["species_names"]
+
+    else:
+
+        raise NotImplementedError(f"Exporting {type(model).__name__} is not supported.")
+
+    env_recipe = compile_design_recipe(env_design_info)
+
+    if env_coefs.shape[1] == len(env_recipe["columns"]) + 1:
+        env_recipe["columns"].insert(0, {"name": "Intercept", "factors": []})
+
+    metadata = {
+        "format": PREDICTOR_FORMAT,
+        "version": EXPORT_VERSION,
+        "model": type(model).__name__,
+        "env_recipe": env_recipe,
+        "obs_recipe": compile_design_recipe(obs_design_info),
+    }
+
+    arrays = {
+        "species_names": np.array([str(x) for x in species_names]),
+        "env_coefs": np.asarray(env_coefs, dtype=dtype),
+        "obs_coefs": np.asarray(obs_coefs, dtype=dtype),
+    }
+
+    save_array_store(target_file, arrays, metadata)
@@ -0,0 +1,234 @@
+# A disk cache of fitted models, so that refitting a model with the same
+# configuration to the same data (e.g. when rerunning an evaluation script for
+# plotting or analysis) restores the saved fit instead.
+#
+# Each fit is stored with the model's save_model in a folder named after a
+# fingerprint of the model's class and constructor arguments and of the data it
+# was fitted to. The data are hashed with pandas' vectorised row hashes, which
+# takes well under a second for a million checklists. Changes to the code of a
+# model are not part of the fingerprint, so the cache should be cleared after
+# changing how a model is fitted.
+#
+# The cache is kept under a disk quota by evicting the least recently used
+# fits, where the time of last use is the modification time of each entry's
+# info file.
+import os
+import json
+import time
+import shutil
+import inspect
+import hashlib
+import tempfile
+import numpy as np
+import pandas as pd
+from os.path import join
+from .checklist_model import ChecklistModel
+
+# Increase this to invalidate existing entries when the fingerprint changes.
+FINGERPRINT_VERSION = 1
+
+ENTRY_INFO_FILE = "fit_cache_entry.json"
+
+# Constructor arguments which do not change the fit.
+IGNORED_ARGUMENTS = ["verbose", "verbose_fit"]
+
+
+def get_model_config(model: ChecklistModel):
+    """Returns the constructor arguments of a model, as far as it stores them
+    under the same names, except for those in IGNORED_ARGUMENTS.
+    """
+
+    arg_names = list(inspect.signature(type(model).__init__).parameters)[1:]
+
+    return {
+        x: getattr(model, x)
+        for x in arg_names
+        if x not in IGNORED_ARGUMENTS and hasattr(model, x)
+    }
+
+
+def _update_with_frame(hasher, df: pd.DataFrame):
+
+    hasher.update(repr([list(df.columns), [str(x) for x in df.dtypes]]).encode())
+    hasher.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+
+
+def _update_with_array(hasher, x: np.ndarray):
+
+    x = np.ascontiguousarray(x)
+    hasher.update(repr([str(x.dtype), x.shape]).encode())
+    hasher.update(x.view(np.uint8).tobytes())
+
+
+def fingerprint_fit(
+    model: ChecklistModel,
+    X_env: pd.DataFrame,
+    X_checklist: pd.DataFrame,
+    y_checklist: pd.DataFrame,
+    checklist_cell_ids: np.ndarray,
+):
+    """Returns a fingerprint of fitting the model to the data.
+
+    This is a hash of the model's class, its configuration (see
+    get_model_config) and the data, including their column names and dtypes.
+
+    Returns:
+        The fingerprint as a hexadecimal string.
+    """
+
+    hasher = hashlib.blake2b(digest_size=16)
+
+    config = get_model_config(model)
+    model_type = f"{type(model).__module__}.{type(model).__qualname__}"
+
+    hasher.update(
+        json.dumps(
+            [FINGERPRINT_VERSION, model_type, config], sort_keys=True, default=repr
+        ).encode()
+    )
+
+    for cur_frame in [X_env, X_checklist, y_checklist]:
+        _update_with_frame(hasher, cur_frame)
+
+    _update_with_array(hasher, np.asarray(checklist_cell_ids))
+
+    return hasher.hexdigest()
+
+
+def get_folder_size(folder):
+    # The total size of the files in the folder and its subfolders, in bytes.
+
+    return sum(
+        os.path.getsize(join(cur_folder, cur_file))
+        for cur_folder, _, files in os.walk(folder)
+        for cur_file in files
+    )
+
+
+class FitCache(object):
+    """A disk cache of fitted models.
+
+    Attributes:
+        cache_dir: The folder the fits are stored in.
+        max_bytes: The disk quota of the cache.
+        n_hits: The number of fits restored from the cache.
+        n_misses: The number of fits that were not in the cache.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes=10 * 2**30):
+        """
+        Args:
+            cache_dir: The folder to store the fits in. It is created if it
+                does not exist.
+            max_bytes: The disk quota. After each new fit is stored, the least
+                recently used fits are removed until the cache takes at most
+                this many bytes.
+        """
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def fit(
+        self,
+        model: ChecklistModel,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ):
+        """Fits the model, or restores it if the same fit is in the cache.
+
+        Arguments are as for ChecklistModel.fit.
+
+        Returns:
+            A dictionary with the "fingerprint" of the fit, the time taken for
+            the original fit in "fit_seconds", and whether the fit was restored
+            from the cache in "hit".
+        """
+
+        fingerprint = fingerprint_fit(
+            model, X_env, X_checklist, y_checklist, checklist_cell_ids
+        )
+
+        entry_folder = join(self.cache_dir, fingerprint)
+        info_file = join(entry_folder, ENTRY_INFO_FILE)
+
+        if os.path.isfile(info_file):
+
+            model.restore_model(entry_folder)
+
+            # Mark the entry as recently used.
+            os.utime(info_file)
+            self.n_hits += 1
+
+            with open(info_file) as f:
+                return {**json.load(f), "hit": True}
+
+        start_time = time.time()
+        model.fit(X_env, X_checklist, y_checklist, checklist_cell_ids)
+
+        info = {
+            "fingerprint": fingerprint,
+            "model": type(model).__name__,
+            "config": {x: repr(y) for x, y in get_model_config(model).items()},
+            "fit_seconds": time.time() - start_time,
+        }
+
+        # Save to a temporary folder first, so that other processes never see
+        # a partly written entry.
+        temp_folder = tempfile.mkdtemp(prefix=".tmp-", dir=self.cache_dir)
+        model.save_model(temp_folder)
+
+        with open(join(temp_folder, ENTRY_INFO_FILE), "w") as f:
+            json.dump(info, f)
+
+        try:
+            os.rename(temp_folder, entry_folder)
+        except OSError:
+            # Another process stored the same fit in the meantime.
+            shutil.rmtree(temp_folder)
+
+        self.n_misses += 1
+        self.evict(keep=fingerprint)
+
+        return {**info, "hit": False}
+
+    def evict(self, keep=None):
+        """Removes the least recently used fits until the cache is within its
+        disk quota.
+
+        Args:
+            keep: The fingerprint of a fit which is never removed, e.g. the one
+                just stored. If it alone exceeds the quota, all other fits are
+                removed.
+        """
+
+        entries = list()
+
+        for cur_name in os.listdir(self.cache_dir):
+
+            cur_info_file = join(self.cache_dir, cur_name, ENTRY_INFO_FILE)
+
+            if os.path.isfile(cur_info_file):
+                entries.append(
+                    (
+                        os.path.getmtime(cur_info_file),
+                        get_folder_size(join(self.cache_dir, cur_name)),
+                        cur_name,
+                    )
+                )
+
+        total_bytes = sum(x[1] for x in entries)
+
+        for _, cur_size, cur_name in sorted(entries):
+
+            if total_bytes <= self.max_bytes:
+                break
+
+            if cur_name != keep:
+                shutil.rmtree(join(self.cache_dir, cur_name), ignore_errors=True)
+                total_bytes -= cur_size
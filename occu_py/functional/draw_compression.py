@@ -0,0 +1,206 @@
+# Compression of posterior draws into a small weighted set of representative
+# draws, so that predictions (e.g. for maps) only need to evaluate a few draws.
+#
+# The draws are selected greedily, based on their predictions on a validation
+# set. The target is the posterior mean of each prediction, stacked with, for
+# each quantile q, the fraction of draws at or below the posterior q quantile
+# of the prediction (about q). Each draw contributes its predictions and its
+# indicators of being at or below each quantile, so that weights matching the
+# target preserve both the mean and the quantiles. Starting from the draw
+# closest to the target, the draw which best explains the remaining difference
+# is added, and the weights of the selected draws are refit by non-negative
+# least squares, constrained to sum to one.
+#
+# The only guarantee is on the validation set: if a tolerance is given, draws
+# are added until the errors of the mean and of every quantile are all at most
+# the tolerance, and a warning is raised if n_representative draws do not
+# reach it. The weighted quantiles of few draws can only take the values of
+# those draws, so tight tolerances on the quantiles need more draws than on the
+# mean.
+import warnings
+import numpy as np
+from scipy.optimize import nnls
+
+# Weight of the sum-to-one constraint in the least squares problem.
+SUM_CONSTRAINT_WEIGHT = 1e3
+
+
+def log_sigmoid(x):
+
+    return -np.logaddexp(0.0, -x)
+
+
+def compute_draw_predictions(
+    env_covs,
+    env_slope_samples,
+    env_intercept_samples,
+    obs_covs=None,
+    obs_slope_samples=None,
+):
+    """Computes the predictions of each draw [n_draws x n_rows x n_species].
+
+    The predictions are probabilities of presence or, if the obs covariates
+    and coefficients are given, of observation.
+    """
+
+    log_probs = log_sigmoid(
+        np.einsum("nc,dcs->dns", env_covs, env_slope_samples)
+        + env_intercept_samples[:, None, :]
+    )
+
+    if obs_covs is not None:
+        log_probs += log_sigmoid(np.einsum("nc,dcs->dns", obs_covs, obs_slope_samples))
+
+    return np.exp(log_probs)
+
+
+def weighted_quantiles(draw_predictions, weights, quantiles):
+    """Computes quantiles of weighted draws [n_quantiles x n_rows x n_species].
+
+    The quantile q of each prediction is the smallest value whose cumulative
+    weight is at least q.
+    """
+
+    order = np.argsort(draw_predictions, axis=0)
+    sorted_predictions = np.take_along_axis(draw_predictions, order, axis=0)
+    cumulative_weights = np.cumsum(weights[order], axis=0)
+
+    result = list()
+
+    for cur_quantile in quantiles:
+        cur_index = np.argmax(cumulative_weights >= cur_quantile - 1e-12, axis=0)
+        result.append(np.take_along_axis(sorted_predictions, cur_index[None], 0)[0])
+
+    return np.stack(result)
+
+
+def fit_weights(draw_matrix, target):
+    # Non-negative weights, summing to one, for the columns of draw_matrix
+    # which best approximate target in the least squares sense.
+
+    n_selected = draw_matrix.shape[1]
+
+    augmented_matrix = np.concatenate(
+        [draw_matrix, SUM_CONSTRAINT_WEIGHT * np.ones((1, n_selected))]
+    )
+    augmented_target = np.concatenate([target, [SUM_CONSTRAINT_WEIGHT]])
+
+    weights, _ = nnls(augmented_matrix, augmented_target)
+
+    return weights / weights.sum()
+
+
+def compute_errors(
+    predictions, selected, weights, full_mean, full_quantiles, quantiles
+):
+    # The maximum absolute errors of the weighted mean and quantiles of the
+    # selected draws' predictions [n_draws x n_targets], compared to the mean
+    # and quantiles of all draws, which are computed once by the caller.
+
+    errors = {
+        "mean": float(
+            np.abs(
+                full_mean - np.tensordot(weights, predictions[selected], axes=1)
+            ).max()
+        )
+    }
+
+    subset_quantiles = weighted_quantiles(predictions[selected], weights, quantiles)
+
+    for cur_quantile, cur_full, cur_subset in zip(
+        quantiles, full_quantiles, subset_quantiles
+    ):
+        errors[cur_quantile] = float(np.abs(cur_full - cur_subset).max())
+
+    return errors
+
+
+def select_representative_draws(
+    draw_predictions, n_representative=50, tolerance=None, quantiles=(0.05, 0.5, 0.95)
+):
+    """Selects a weighted subset of draws preserving the predictive mean and
+    quantiles.
+
+    Args:
+        draw_predictions: The predictions of each draw on a validation set
+            [n_draws x n_rows x n_species], e.g. from compute_draw_predictions.
+        n_representative: The maximum number of draws to select.
+        tolerance: If given, draws are only added until the maximum absolute
+            errors of the weighted mean and of each quantile are all at most
+            this. A warning is raised if n_representative draws do not reach
+            it.
+        quantiles: The quantiles of the draws' predictions to preserve.
+
+    The draws are compared through a float32 matrix of (1 + n_quantiles) x
+    n_rows x n_species x n_draws entries, i.e. 4 bytes each: about 8GB for
+    1,000 draws of 1,000 rows and 500 species with three quantiles. For large
+    validation sets, subsample the rows first.
+
+    Returns:
+        A tuple of the indices of the selected draws, their weights and a
+        dictionary with the maximum absolute error of the weighted mean
+        ("mean") and of each quantile, compared to all draws.
+    """
+
+    n_draws = draw_predictions.shape[0]
+    predictions = np.reshape(draw_predictions, (n_draws, -1)).astype(np.float32)
+    n_predictions = predictions.shape[1]
+    full_mean = predictions.mean(axis=0)
+    full_quantiles = np.quantile(predictions, quantiles, axis=0)
+
+    # Each draw's predictions, followed by its indicators of being at or below
+    # each quantile [n_targets x n_draws]. The blocks are filled in place to
+    # avoid temporary copies of the whole matrix.
+    draw_matrix = np.empty(
+        ((1 + len(quantiles)) * n_predictions, n_draws), dtype=np.float32
+    )
+    draw_matrix[:n_predictions] = predictions.T
+
+    for i, cur_quantile in enumerate(full_quantiles, start=1):
+        rows = slice(i * n_predictions, (i + 1) * n_predictions)
+        np.less_equal(predictions.T, cur_quantile[:, None], out=draw_matrix[rows])
+
+    target = draw_matrix.mean(axis=1)
+
+    # Start from the draw closest to the target, with the squared distances
+    # expanded so that no copy of draw_matrix is made.
+    distances = np.einsum("ij,ij->j", draw_matrix, draw_matrix) - 2 * (
+        target @ draw_matrix
+    )
+    selected = [int(np.argmin(distances))]
+    weights = np.ones(1)
+    residual = target - draw_matrix[:, selected[0]]
+
+    while len(selected) < min(n_representative, n_draws):
+
+        if tolerance is not None and all(
+            x <= tolerance
+            for x in compute_errors(
+                predictions, selected, weights, full_mean, full_quantiles, quantiles
+            ).values()
+        ):
+            break
+
+        # As in the fully corrective Frank-Wolfe algorithm, add the draw which
+        # decreases the squared error the most to first order, then refit all
+        # the weights.
+        # The residual is cast so that draw_matrix is not copied to float64.
+        scores = draw_matrix.T @ residual.astype(np.float32)
+        scores[selected] = -np.inf
+
+        selected.append(int(np.argmax(scores)))
+        weights = fit_weights(draw_matrix[:, selected], target)
+        residual = target - draw_matrix[:, selected] @ weights
+
+    selected = np.array(selected)
+    errors = compute_errors(
+        predictions, selected, weights, full_mean, full_quantiles, quantiles
+    )
+
+    if tolerance is not None and any(x > tolerance for x in errors.values()):
+        warnings.warn(
+            f"{len(selected)} representative draws do not reach the tolerance "
+            f"of {tolerance}; the maximum absolute errors are {errors}."
+        )
+
+    return selected, weights, errors
@@ -0,0 +1,269 @@
+import numpy as np
+import pandas as pd
+import jax.numpy as jnp
+from patsy import dmatrix
+from functools import partial
+from jax import jit, vmap, lax, value_and_grad
+from jax.nn import sigmoid
+from typing import NamedTuple
+from tqdm import tqdm
+from occu_py.likelihoods import (
+    compute_cell_likelihood_terms,
+    combine_cell_likelihood_terms,
+    conditional_occupancy_from_terms,
+)
+from occu_py.utils import split_every
+from .max_lik_occu_model import likelihood_fun
+
+
+class EMResult(NamedTuple):
+
+    # Negative log likelihood at the final estimate.
+    fun: np.ndarray
+
+    # Gradient of the negative log likelihood at the final estimate.
+    jac: np.ndarray
+
+    # Number of EM iterations taken.
+    nit: int
+
+    # Whether the change in log likelihood dropped below the tolerance.
+    success: bool
+
+
+def e_step(env_logit, obs_logit, m, cell_ids, n_cells):
+    # Computes the posterior probability of occupancy for each cell, together
+    # with the log likelihood of the data, for a single species.
+
+    terms = compute_cell_likelihood_terms(env_logit, obs_logit, m, cell_ids, n_cells)
+
+    occupancy = conditional_occupancy_from_terms(*terms)
+    log_lik = jnp.sum(combine_cell_likelihood_terms(*terms))
+
+    return occupancy, log_lik
+
+
+def irls_step(X, coefs, targets, weights, ridge=1e-6):
+    # Carries out one Newton step of a weighted logistic regression with
+    # (possibly fractional) targets. X is [N x p], coefs [p], targets and
+    # weights [N].
+
+    probs = sigmoid(X @ coefs)
+
+    gradient = X.T @ (weights * (targets - probs))
+    hessian = (X.T * (weights * probs * (1 - probs))) @ X
+    hessian = hessian + ridge * jnp.eye(X.shape[1])
+
+    return coefs + jnp.linalg.solve(hessian, gradient)
+
+
+def em_iteration(
+    env_coefs, obs_coefs, y, X_env, X_checklist, cell_ids, n_cells, n_irls_steps=1
+):
+    # One EM iteration for a single species. Returns the updated coefficients
+    # and the log likelihood at the coefficients passed in.
+
+    occupancy, log_lik = e_step(
+        X_env @ env_coefs, X_checklist @ obs_coefs, 1 - y, cell_ids, n_cells
+    )
+
+    # Env M-step: logistic regression of the occupancy probabilities on the
+    # cell covariates.
+    ones = jnp.ones(n_cells)
+    env_coefs = lax.fori_loop(
+        0,
+        n_irls_steps,
+        lambda _, x: irls_step(X_env, x, occupancy, ones),
+        env_coefs,
+    )
+
+    # Detection M-step: logistic regression of the detections on the checklist
+    # covariates, with each checklist weighted by the probability that its cell
+    # is occupied.
+    checklist_weights = occupancy[cell_ids]
+    obs_coefs = lax.fori_loop(
+        0,
+        n_irls_steps,
+        lambda _, x: irls_step(X_checklist, x, y, checklist_weights),
+        obs_coefs,
+    )
+
+    return env_coefs, obs_coefs, log_lik
+
+
+def run_em(
+    X_env, X_checklist, y_checklist, cell_ids, n_cells, max_iter, tol, n_irls_steps
+):
+    # Runs EM for a batch of species at once. y_checklist is [K x S]. The
+    # iterations continue until the log likelihood of every species changes by
+    # less than tol, or until max_iter is reached.
+
+    n_species = y_checklist.shape[1]
+
+    iteration = vmap(
+        partial(
+            em_iteration,
+            X_env=X_env,
+            X_checklist=X_checklist,
+            cell_ids=cell_ids,
+            n_cells=n_cells,
+            n_irls_steps=n_irls_steps,
+        ),
+        in_axes=(1, 1, 1),
+        out_axes=(1, 1, 0),
+    )
+
+    def is_converged(log_lik, prev_log_lik):
+
+        return jnp.abs(log_lik - prev_log_lik) < tol
+
+    def cond_fun(state):
+
+        _, _, log_lik, prev_log_lik, i = state
+
+        return jnp.any(~is_converged(log_lik, prev_log_lik)) & (i < max_iter)
+
+    def body_fun(state):
+
+        env_coefs, obs_coefs, log_lik, _, i = state
+
+        new_env_coefs, new_obs_coefs, cur_log_lik = iteration(
+            env_coefs, obs_coefs, y_checklist
+        )
+
+        return new_env_coefs, new_obs_coefs, cur_log_lik, log_lik, i + 1
+
+    init_state = (
+        jnp.zeros((X_env.shape[1], n_species)),
+        jnp.zeros((X_checklist.shape[1], n_species)),
+        jnp.full(n_species, -jnp.inf),
+        jnp.full(n_species, jnp.inf),
+        0,
+    )
+
+    env_coefs, obs_coefs, log_lik, prev_log_lik, n_iter = lax.while_loop(
+        cond_fun, body_fun, init_state
+    )
+
+    return env_coefs, obs_coefs, is_converged(log_lik, prev_log_lik), n_iter
+
+
+def fit(
+    X_env: pd.DataFrame,
+    X_checklist: pd.DataFrame,
+    y_checklist: np.ndarray,
+    cell_ids: np.ndarray,
+    env_formula: str,
+    checklist_formula: str,
+    max_iter=2000,
+    tol=1e-4,
+    n_irls_steps=1,
+    species_batch_size=32,
+    verbose=False,
+):
+    """Fits single-species occupancy detection models using EM.
+
+    The E-step computes the posterior probability of occupancy of each cell in
+    closed form; the M-step consists of a weighted logistic regression for the
+    environment and one for the detection coefficients, each updated with
+    n_irls_steps IRLS steps. Species are processed in batches of
+    species_batch_size.
+
+    Returns:
+        A list with one entry per column in y_checklist, in the same format as
+        the output of max_lik_occu_model.fit.
+    """
+
+    env_design_mat = dmatrix(env_formula, X_env)
+    checklist_design_mat = dmatrix(checklist_formula, X_checklist)
+
+    env_covs = np.asarray(env_design_mat)
+    checklist_covs = np.asarray(checklist_design_mat)
+
+    n_cells = X_env.shape[0]
+
+    run_batch = jit(
+        partial(
+            run_em,
+            env_covs,
+            checklist_covs,
+            cell_ids=cell_ids,
+            n_cells=n_cells,
+            max_iter=max_iter,
+            tol=tol,
+            n_irls_steps=n_irls_steps,
+        )
+    )
+
+    # Used to report the objective and gradient at the solution in the same
+    # form as the direct optimisers.
+    def evaluate_solution(env_coefs, obs_coefs, y):
+
+        cur_lik = partial(
+            likelihood_fun,
+            m=1 - y,
+            X_env=env_covs,
+            X_checklist=checklist_covs,
+            checklist_cell_ids=cell_ids,
+            n_cells=n_cells,
+        )
+
+        value, gradient = value_and_grad(cur_lik)(
+            {"env_coefs": env_coefs, "obs_coefs": obs_coefs}
+        )
+
+        return -value, -jnp.concatenate([gradient["env_coefs"], gradient["obs_coefs"]])
+
+    evaluate_batch = jit(vmap(evaluate_solution, in_axes=(1, 1, 1)))
+
+    y_checklist = np.asarray(y_checklist)
+    n_species = y_checklist.shape[1]
+    batch_size = min(species_batch_size, n_species)
+
+    batches = list(split_every(batch_size, np.arange(n_species)))
+
+    if verbose:
+        batches = tqdm(batches)
+
+    results = list()
+
+    for cur_batch in batches:
+
+        cur_batch = list(cur_batch)
+        n_padding = batch_size - len(cur_batch)
+        cur_y = y_checklist[:, cur_batch + [cur_batch[-1]] * n_padding]
+
+        env_coefs, obs_coefs, converged, n_iter = run_batch(cur_y)
+
+        neg_log_liks, gradients = evaluate_batch(env_coefs, obs_coefs, cur_y)
+
+        for i in range(len(cur_batch)):
+
+            cur_opt_result = EMResult(
+                fun=np.asarray(neg_log_liks[i]),
+                jac=np.asarray(gradients[i]),
+                nit=int(n_iter),
+                success=bool(converged[i]),
+            )
+
+            results.append(
+                {
+                    "env_coefs": pd.Series(
+                        np.asarray(env_coefs[:, i]),
+                        index=env_design_mat.design_info.column_names,
+                    ),
+                    "obs_coefs": pd.Series(
+                        np.asarray(obs_coefs[:, i]),
+                        index=checklist_design_mat.design_info.column_names,
+                    ),
+                    "env_scaler": None,
+                    "env_formula": env_formula,
+                    "checklist_formula": checklist_formula,
+                    "optimisation_successful": cur_opt_result.success,
+                    "opt_result": cur_opt_result,
+                    "env_design_info": env_design_mat.design_info,
+                    "obs_design_info": checklist_design_mat.design_info,
+                }
+            )
+
+    return results
@@ -1,7 +1,6 @@
 import arviz as az
 import numpy as np
 from jax import jit, vmap
-from patsy import dmatrix, build_design_matrices
 import jax.numpy as jnp
 from jax_advi.advi import optimize_advi_mean_field
 from jax_advi.advi import get_posterior_draws
@@ -15,9 +14,13 @@ from .model import (
     calculate_likelihood,
     calculate_likelihood_for_loop,
 )
-from .hierarchical_checklist_model_mcmc import predict_obs, predict_env
-from sklearn.preprocessing import StandardScaler
-from ml_tools.patsy import remove_intercept_column
+from .hierarchical_checklist_model_mcmc import (
+    predict_obs,
+    predict_env,
+    design_env_covs,
+)
+from ..compact_design import compact_dmatrix
+from ..precision import get_precision_dtypes, get_design_dtype, cast_to
 
 
 def fit(
@@ -34,21 +37,18 @@ def fit(
     verbose=True,
     opt_method="trust-ncg",
     # opt_method="L-BFGS-B",
+    precision=None,
 ):
 
     # TODO: Currently this is the same as the MCMC version. If it stays that
     # way, should probably abstract away some stuff.
-    env_design_mat = dmatrix(env_formula, X_env)
-    checklist_design_mat = dmatrix(checklist_formula, X_checklist)
-
-    env_covs = np.asarray(env_design_mat)
-    checklist_covs = np.asarray(checklist_design_mat)
-
-    env_covs = remove_intercept_column(env_covs, env_design_mat.design_info)
-
-    if scale_env:
-        scaler = StandardScaler()
-        env_covs = scaler.fit_transform(env_covs)
+    design_dtype = get_design_dtype(precision)
+    env_covs, env_design_info, scaler = design_env_covs(
+        X_env, env_formula, scale_env, dtype=design_dtype
+    )
+    checklist_covs, checklist_design_info = compact_dmatrix(
+        checklist_formula, X_checklist, dtype=design_dtype
+    )
 
     n_env_covs = env_covs.shape[1]
     n_s = y_checklist.shape[1]
@@ -63,12 +63,13 @@ def fit(
             X_checklist=checklist_covs,
             y_checklist=y_checklist.values,
             cell_ids=checklist_cell_ids,
+            precision=precision,
         )(transform_non_centred(x))
     )
 
     design_info = {
-        "env": env_design_mat.design_info,
-        "obs": checklist_design_mat.design_info,
+        "env": env_design_info,
+        "obs": checklist_design_info,
         "species_names": y_checklist.columns,
     }
 
@@ -92,8 +93,11 @@ def fit(
         + draws["obs_coef_prior_means"]
     )
 
-    # Add a dimension "chain":
-    draws = {x: jnp.expand_dims(y, axis=0) for x, y in draws.items()}
+    # Add a dimension "chain", storing the draws in the compute precision:
+    compute_dtype, _ = get_precision_dtypes(precision)
+    draws = {
+        x: cast_to(jnp.expand_dims(y, axis=0), compute_dtype) for x, y in draws.items()
+    }
     az_trace = az.from_dict(posterior=draws)
 
     if scale_env:
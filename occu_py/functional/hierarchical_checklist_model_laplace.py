@@ -0,0 +1,338 @@
+import arviz as az
+import numpy as np
+import jax.numpy as jnp
+from jax import jit, vmap, hessian
+from jax.scipy.stats import norm
+from functools import partial
+from ml_tools.max_lik import find_map_estimate
+from ml_tools.jax import half_normal_logpdf
+from ..compact_design import compact_dmatrix
+from .model import (
+    calculate_prior_non_centered,
+    transform_non_centred,
+    calculate_likelihood_for_loop,
+    calculate_likelihood_single,
+)
+from ..utils import split_every
+from .hierarchical_checklist_model_mcmc import design_env_covs
+
+
+def constrain_theta(theta):
+    # The MAP and the Laplace approximation are computed with the prior sds on
+    # the log scale. This returns the constrained parameters and the log
+    # determinant of the Jacobian of the transformation.
+
+    theta = dict(theta)
+    log_sds = theta["obs_coef_prior_sds"]
+    theta["obs_coef_prior_sds"] = jnp.exp(log_sds)
+
+    return theta, jnp.sum(log_sds)
+
+
+def calculate_log_posterior(theta, X_env, X_checklist, y_checklist, cell_ids):
+
+    theta, log_det_jac = constrain_theta(theta)
+
+    prior = calculate_prior_non_centered(theta)
+    lik = calculate_likelihood_for_loop(
+        transform_non_centred(theta), X_env, X_checklist, y_checklist, cell_ids
+    )
+
+    return prior + lik + log_det_jac
+
+
+def split_species_params(theta_species, n_env_covs):
+    # theta_species contains, in order, a species' env slopes, its env
+    # intercept and its raw obs coefficients.
+
+    env_slopes = theta_species[:n_env_covs]
+    env_intercept = theta_species[n_env_covs]
+    obs_coefs_raw = theta_species[n_env_covs + 1 :]
+
+    return env_slopes, env_intercept, obs_coefs_raw
+
+
+def species_neg_log_posterior(
+    theta_species, theta_global, y, X_env, X_checklist, cell_ids
+):
+    # The terms of the negative log posterior involving a single species. These
+    # depend on the species' own parameters and on the shared parameters
+    # theta_global, which contains the obs coef prior means, followed by the
+    # log prior sds.
+
+    n_env_covs = X_env.shape[1]
+    n_obs_covs = X_checklist.shape[1]
+
+    env_slopes, env_intercept, obs_coefs_raw = split_species_params(
+        theta_species, n_env_covs
+    )
+
+    prior_means = theta_global[:n_obs_covs]
+    prior_sds = jnp.exp(theta_global[n_obs_covs:])
+
+    obs_coefs = obs_coefs_raw * prior_sds + prior_means
+
+    lik = calculate_likelihood_single(
+        X_checklist, X_env, obs_coefs, env_slopes, env_intercept, y, cell_ids
+    )
+
+    prior = (
+        jnp.sum(norm.logpdf(obs_coefs_raw, 0.0, 1.0))
+        + jnp.sum(norm.logpdf(env_slopes, 0.0, 1.0))
+        + norm.logpdf(env_intercept, 0.0, 10.0)
+    )
+
+    return -(lik + prior)
+
+
+def global_neg_log_posterior(theta_global, n_obs_covs):
+    # The terms of the negative log posterior involving only the shared
+    # parameters, including the Jacobian term for the log prior sds.
+
+    prior_means = theta_global[:n_obs_covs]
+    log_sds = theta_global[n_obs_covs:]
+
+    prior = jnp.sum(norm.logpdf(prior_means)) + jnp.sum(
+        half_normal_logpdf(jnp.exp(log_sds), 1.0)
+    )
+
+    return -(prior + jnp.sum(log_sds))
+
+
+def compute_hessian_blocks(
+    theta_species,
+    theta_global,
+    X_env,
+    X_checklist,
+    y_checklist,
+    cell_ids,
+    species_batch_size=32,
+):
+    """Computes the blocks of the Hessian of the negative log posterior.
+
+    Since the species are conditionally independent given the shared
+    parameters, the Hessian has an "arrow" structure: a dense block per
+    species, coupled only through the rows and columns of the shared
+    parameters.
+
+    Args:
+        theta_species: Species parameters at the mode [S x p_s].
+        theta_global: Shared parameters at the mode [p_g].
+        X_env: Env design matrix without intercept [N x n_env_covs].
+        X_checklist: Checklist design matrix [K x n_obs_covs].
+        y_checklist: Detections [K x S].
+        cell_ids: Cell index of each checklist [K].
+        species_batch_size: Number of species processed at once.
+
+    Returns:
+        A tuple of the species blocks A [S x p_s x p_s], the coupling blocks B
+        [S x p_s x p_g] and the shared block C [p_g x p_g].
+    """
+
+    n_species, n_species_params = theta_species.shape
+
+    def joint_hessian(cur_theta_species, cur_y):
+
+        combined = jnp.concatenate([cur_theta_species, theta_global])
+
+        to_differentiate = lambda x: species_neg_log_posterior(
+            x[:n_species_params],
+            x[n_species_params:],
+            cur_y,
+            X_env,
+            X_checklist,
+            cell_ids,
+        )
+
+        return hessian(to_differentiate)(combined)
+
+    batch_hessians = jit(vmap(joint_hessian, in_axes=(0, 1)))
+
+    A, B = list(), list()
+    C = hessian(partial(global_neg_log_posterior, n_obs_covs=X_checklist.shape[1]))(
+        theta_global
+    )
+
+    for cur_batch in split_every(species_batch_size, np.arange(n_species)):
+
+        cur_batch = np.array(cur_batch)
+
+        cur_hessians = batch_hessians(
+            theta_species[cur_batch], y_checklist[:, cur_batch]
+        )
+
+        A.append(np.asarray(cur_hessians[:, :n_species_params, :n_species_params]))
+        B.append(np.asarray(cur_hessians[:, :n_species_params, n_species_params:]))
+        C = C + jnp.sum(cur_hessians[:, n_species_params:, n_species_params:], axis=0)
+
+    return np.concatenate(A), np.concatenate(B), np.asarray(C)
+
+
+def symmetric_factor(matrix, min_eigval=1e-8):
+    # Returns the eigenvalues and eigenvectors of matrix (or of a stack of
+    # matrices), with the eigenvalues floored at min_eigval so that the result
+    # is positive definite.
+
+    eigvals, eigvecs = np.linalg.eigh(matrix)
+
+    return np.maximum(eigvals, min_eigval), eigvecs
+
+
+def draw_from_arrow_precision(mode_species, mode_global, A, B, C, n_draws, seed):
+    """Draws from a Gaussian whose precision matrix has arrow structure.
+
+    If the precision is H = L L^T with L = [[L_A, 0], [B^T L_A^-T, L_S]] and S
+    = C - B^T A^-1 B the Schur complement, then L^-T z with z standard normal
+    has covariance H^-1. This needs only the species blocks and a dense
+    factorisation of the (small) shared block.
+
+    Returns:
+        A tuple of draws of the species parameters [n_draws x S x p_s] and of
+        the shared parameters [n_draws x p_g].
+    """
+
+    np.random.seed(seed)
+
+    n_species, n_species_params = mode_species.shape
+    n_global_params = mode_global.shape[0]
+
+    # Each A_s = L_s L_s^T with L_s = V_s diag(sqrt(w_s)).
+    eigvals_A, eigvecs_A = symmetric_factor(A)
+    inv_sqrt_A = 1.0 / np.sqrt(eigvals_A)
+
+    # L_s^-1 B_s
+    scaled_B = inv_sqrt_A[:, :, None] * np.einsum("spq,spg->sqg", eigvecs_A, B)
+
+    schur = C - np.einsum("spg,sph->gh", scaled_B, scaled_B)
+    eigvals_S, eigvecs_S = symmetric_factor(schur)
+
+    z_global = np.random.randn(n_draws, n_global_params)
+    z_species = np.random.randn(n_draws, n_species, n_species_params)
+
+    global_deviations = (z_global / np.sqrt(eigvals_S)) @ eigvecs_S.T
+
+    rhs = z_species - np.einsum("spg,dg->dsp", scaled_B, global_deviations)
+    species_deviations = np.einsum(
+        "spq,dsq->dsp", eigvecs_A * inv_sqrt_A[:, None, :], rhs
+    )
+
+    return (
+        mode_species[None] + species_deviations,
+        mode_global[None] + global_deviations,
+    )
+
+
+def fit(
+    X_env,
+    X_checklist,
+    y_checklist,
+    checklist_cell_ids,
+    env_formula,
+    checklist_formula,
+    scale_env=True,
+    draws=1000,
+    seed=3,
+    gtol=1e-3,
+    species_batch_size=32,
+):
+
+    env_covs, env_design_info, scaler = design_env_covs(X_env, env_formula, scale_env)
+    checklist_covs, checklist_design_info = compact_dmatrix(
+        checklist_formula, X_checklist
+    )
+
+    n_env_covs = env_covs.shape[1]
+    n_s = y_checklist.shape[1]
+    n_check_covs = checklist_covs.shape[1]
+
+    y = y_checklist.values
+
+    theta_init = {
+        "env_slopes": jnp.zeros((n_env_covs, n_s)),
+        "env_intercepts": jnp.zeros(n_s),
+        "obs_coefs_raw": jnp.zeros((n_check_covs, n_s)),
+        "obs_coef_prior_means": jnp.zeros((n_check_covs, 1)),
+        "obs_coef_prior_sds": jnp.zeros((n_check_covs, 1)),
+    }
+
+    log_post = jit(
+        partial(
+            calculate_log_posterior,
+            X_env=env_covs,
+            X_checklist=checklist_covs,
+            y_checklist=y,
+            cell_ids=checklist_cell_ids,
+        )
+    )
+
+    mode, opt_result = find_map_estimate(
+        theta_init, log_post, opt_method="trust-ncg", gtol=gtol
+    )
+
+    mode_species = np.concatenate(
+        [
+            np.asarray(mode["env_slopes"]).T,
+            np.asarray(mode["env_intercepts"]).reshape(-1, 1),
+            np.asarray(mode["obs_coefs_raw"]).T,
+        ],
+        axis=1,
+    )
+
+    mode_global = np.concatenate(
+        [
+            np.asarray(mode["obs_coef_prior_means"])[:, 0],
+            np.asarray(mode["obs_coef_prior_sds"])[:, 0],
+        ]
+    )
+
+    A, B, C = compute_hessian_blocks(
+        jnp.asarray(mode_species),
+        jnp.asarray(mode_global),
+        env_covs,
+        checklist_covs,
+        y,
+        checklist_cell_ids,
+        species_batch_size=species_batch_size,
+    )
+
+    species_draws, global_draws = draw_from_arrow_precision(
+        mode_species, mode_global, A, B, C, draws, seed
+    )
+
+    env_slopes, env_intercepts, obs_coefs_raw = split_species_params(
+        np.moveaxis(species_draws, 2, 0), n_env_covs
+    )
+
+    draws = {
+        "env_slopes": np.moveaxis(env_slopes, 0, 1),
+        "env_intercepts": env_intercepts,
+        "obs_coefs_raw": np.moveaxis(obs_coefs_raw, 0, 1),
+        "obs_coef_prior_means": global_draws[:, :n_check_covs, None],
+        "obs_coef_prior_sds": np.exp(global_draws[:, n_check_covs:, None]),
+    }
+
+    draws["obs_coefs"] = (
+        draws["obs_coefs_raw"] * draws["obs_coef_prior_sds"]
+        + draws["obs_coef_prior_means"]
+    )
+
+    # Add a dimension "chain":
+    draws = {x: np.expand_dims(y, axis=0) for x, y in draws.items()}
+    az_trace = az.from_dict(posterior=draws)
+
+    design_info = {
+        "env": env_design_info,
+        "obs": checklist_design_info,
+        "species_names": y_checklist.columns,
+    }
+
+    if scale_env:
+        design_info["env_scaler"] = scaler
+
+    laplace_results = {
+        "map_estimate": {x: np.asarray(y) for x, y in constrain_theta(mode)[0].items()},
+        "optimisation_successful": opt_result.success,
+        "final_grad_norm": np.linalg.norm(opt_result.jac),
+    }
+
+    return az_trace, laplace_results, design_info
@@ -1,5 +1,3 @@
-from sklearn.preprocessing import StandardScaler
-from patsy import dmatrix, build_design_matrices
 import numpy as np
 from .model import (
     calculate_likelihood,
@@ -15,8 +13,22 @@ from jax.nn import log_sigmoid, sigmoid
 import pandas as pd
 import jax.numpy as jnp
 from jax.scipy.stats import norm
-from .utils import predict_env_from_samples, predict_obs_from_samples
-from ml_tools.patsy import remove_intercept_column
+from .utils import (
+    predict_env_from_samples,
+    predict_obs_from_samples,
+    predict_conditional_occupancy_from_samples,
+)
+from ..compact_design import (
+    compact_dmatrix,
+    build_compact_design,
+    fit_standard_scaler,
+    standardise_design,
+    as_dense,
+    SPARSE_THRESHOLD,
+)
+from ..precision import get_precision_dtypes, get_design_dtype
+from ..draw_store import fetch_draws, find_species_indices, select_draws
+from .draw_compression import compute_draw_predictions, select_representative_draws
 
 
 def fit(
@@ -31,21 +43,17 @@ def fit(
     tune=1000,
     thinning=1,
     chain_method="vectorized",
+    precision=None,
 ):
     from ml_tools.numpyro_mcmc import sample_nuts
 
-    env_design_mat = dmatrix(env_formula, X_env)
-    checklist_design_mat = dmatrix(checklist_formula, X_checklist)
-
-    env_covs = np.asarray(env_design_mat)
-    checklist_covs = np.asarray(checklist_design_mat)
-
-    # Workaround to remove intercept
-    env_covs = remove_intercept_column(env_covs, env_design_mat.design_info)
-
-    if scale_env:
-        scaler = StandardScaler()
-        env_covs = scaler.fit_transform(env_covs)
+    design_dtype = get_design_dtype(precision)
+    env_covs, env_design_info, scaler = design_env_covs(
+        X_env, env_formula, scale_env, dtype=design_dtype
+    )
+    checklist_covs, checklist_design_info = compact_dmatrix(
+        checklist_formula, X_checklist, dtype=design_dtype
+    )
 
     n_env_covs = env_covs.shape[1]
     n_s = y_checklist.shape[1]
@@ -60,6 +68,7 @@ def fit(
             X_checklist=checklist_covs,
             y_checklist=y_checklist.values,
             cell_ids=checklist_cell_ids,
+            precision=precision,
         )(transform_non_centred(x))
     )
 
@@ -75,9 +84,15 @@ def fit(
         use_tfp=False,
     )
 
+    # Store the draws in the compute precision.
+    compute_dtype, _ = get_precision_dtypes(precision)
+
+    if compute_dtype is not None:
+        samples = samples.map(lambda x: x.astype(compute_dtype), groups="posterior")
+
     design_info = {
-        "env": env_design_mat.design_info,
-        "obs": checklist_design_mat.design_info,
+        "env": env_design_info,
+        "obs": checklist_design_info,
         "species_names": y_checklist.columns,
     }
 
@@ -87,63 +102,286 @@ def fit(
     return samples, design_info
 
 
-def fetch_env_samples(samples):
-
-    env_slope_samples = samples.posterior["env_slopes"].values
-    env_intercept_samples = samples.posterior["env_intercepts"].values
+def fetch_env_samples(samples, species_indices=None, draw_indices=None):
 
-    # Concatenate across chains
-    # TODO: Maybe arviz has a nicer method for this?
-    env_slope_samples = flatten_chains(env_slope_samples)
-    env_intercept_samples = flatten_chains(env_intercept_samples)
+    env_slope_samples = fetch_draws(
+        samples, "env_slopes", species_indices, draw_indices
+    )
+    env_intercept_samples = fetch_draws(
+        samples, "env_intercepts", species_indices, draw_indices
+    )
 
     return env_slope_samples, env_intercept_samples
 
 
+def fetch_obs_samples(samples, species_indices=None, draw_indices=None):
+
+    # The obs coefs are derived from the raw coefs and their prior parameters,
+    # which are shared across species.
+    transformed = transform_non_centred(
+        {
+            x: fetch_draws(samples, x, species_indices, draw_indices)
+            for x in ["obs_coefs_raw", "obs_coef_prior_means", "obs_coef_prior_sds"]
+        }
+    )
+
+    return transformed["obs_coefs"]
+
+
 def flatten_chains(draws):
 
     return np.reshape(draws, (-1, *draws.shape[2:]))
 
 
-def predict_env(X_env, samples, design_info):
+def design_env_covs(X_env, env_formula, scale_env=True, dtype=np.float64):
+    # Builds the env design for fitting as a CompactDesign of the given dtype
+    # without the intercept column, since the models have an intercept per
+    # species, and with sparse indicators. Returns the design, its patsy design
+    # info and the scaler used to standardise it (None if scale_env is False).
+
+    env_covs, env_design_info = compact_dmatrix(
+        env_formula,
+        X_env,
+        sparse_threshold=SPARSE_THRESHOLD,
+        drop_intercept=True,
+        dtype=dtype,
+    )
+
+    if not scale_env:
+        return env_covs, env_design_info, None
+
+    scaler = fit_standard_scaler(env_covs)
+    env_covs = standardise_design(env_covs, scaler.mean_, scaler.scale_)
 
-    design_mat = build_design_matrices([design_info["env"]], X_env)[0]
-    env_covs = np.asarray(design_mat)
-    env_covs = remove_intercept_column(env_covs, design_mat.design_info)
+    return env_covs, env_design_info, scaler
+
+
+def build_env_covs(X_env, design_info):
+
+    env_covs = build_compact_design(
+        design_info["env"],
+        X_env,
+        sparse_threshold=SPARSE_THRESHOLD,
+        drop_intercept=True,
+    )
 
     if "env_scaler" in design_info:
-        env_covs = design_info["env_scaler"].transform(env_covs)
+        scaler = design_info["env_scaler"]
+        env_covs = standardise_design(env_covs, scaler.mean_, scaler.scale_)
 
-    env_slope_samples, env_intercept_samples = fetch_env_samples(samples)
+    return env_covs
 
-    prob = predict_env_from_samples(env_covs, env_slope_samples, env_intercept_samples)
 
-    return pd.DataFrame(prob, index=X_env.index, columns=design_info["species_names"])
+def select_prediction_draws(samples, n_draws=None, representative_draws=None):
+    # Returns the indices of the draws to predict with and their weights (None
+    # for equal weights).
 
+    if representative_draws is None:
+        return select_draws(samples, n_draws), None
 
-def predict_obs(X_env, X_obs, samples, design_info):
+    assert n_draws is None, "n_draws cannot be used with representative draws."
 
-    env_design_mat = build_design_matrices([design_info["env"]], X_env)[0]
-    env_covs = np.asarray(env_design_mat)
+    return representative_draws["indices"], representative_draws["weights"]
 
-    env_covs = remove_intercept_column(env_covs, env_design_mat.design_info)
 
-    if "env_scaler" in design_info:
-        env_covs = design_info["env_scaler"].transform(env_covs)
+def predict_env(
+    X_env,
+    samples,
+    design_info,
+    species=None,
+    n_draws=None,
+    representative_draws=None,
+):
+    """Predicts the probability of presence, averaged over posterior draws.
+
+    Args:
+        X_env: The environmental covariates.
+        samples: The draws, as an arviz InferenceData or a DrawStore.
+        design_info: The design info returned by fit.
+        species: The names of the species to predict. All species are
+            predicted if None. With a DrawStore, only their draws are read.
+        n_draws: The number of evenly spaced draws to average over. All draws
+            are used if None.
+        representative_draws: If given, predictions are averaged over these
+            draws only, as returned by compress_posterior.
+
+    Returns:
+        A DataFrame of probabilities [n_rows x n_species].
+    """
+
+    species_indices = find_species_indices(design_info["species_names"], species)
+    draw_indices, draw_weights = select_prediction_draws(
+        samples, n_draws, representative_draws
+    )
 
-    env_slope_samples, env_intercept_samples = fetch_env_samples(samples)
+    env_covs = build_env_covs(X_env, design_info)
 
-    obs_design_mat = build_design_matrices([design_info["obs"]], X_obs)[0]
-    obs_covs = np.asarray(obs_design_mat)
+    env_slope_samples, env_intercept_samples = fetch_env_samples(
+        samples, species_indices, draw_indices
+    )
 
-    transformed_samples = transform_non_centred(
-        {x: y.values for x, y in samples.posterior.items()}
+    prob = predict_env_from_samples(
+        env_covs, env_slope_samples, env_intercept_samples, draw_weights
     )
 
-    obs_slope_samples = flatten_chains(transformed_samples["obs_coefs"])
+    return pd.DataFrame(
+        prob,
+        index=X_env.index,
+        columns=design_info["species_names"] if species is None else species,
+    )
+
+
+def predict_obs(
+    X_env,
+    X_obs,
+    samples,
+    design_info,
+    species=None,
+    n_draws=None,
+    representative_draws=None,
+):
+    """Predicts the probability of observation on checklists.
+
+    The arguments are as for predict_env, with X_obs the checklist covariates
+    and X_env the environmental covariates of each checklist's cell.
+    """
+
+    species_indices = find_species_indices(design_info["species_names"], species)
+    draw_indices, draw_weights = select_prediction_draws(
+        samples, n_draws, representative_draws
+    )
+
+    env_covs = build_env_covs(X_env, design_info)
+
+    env_slope_samples, env_intercept_samples = fetch_env_samples(
+        samples, species_indices, draw_indices
+    )
+
+    obs_covs = build_compact_design(design_info["obs"], X_obs)
+
+    obs_slope_samples = fetch_obs_samples(samples, species_indices, draw_indices)
 
     result = predict_obs_from_samples(
-        env_covs, env_slope_samples, env_intercept_samples, obs_covs, obs_slope_samples
+        env_covs,
+        env_slope_samples,
+        env_intercept_samples,
+        obs_covs,
+        obs_slope_samples,
+        draw_weights,
+    )
+
+    return pd.DataFrame(
+        result, columns=design_info["species_names"] if species is None else species
+    )
+
+
+def predict_conditional_occupancy(
+    X_env,
+    X_obs,
+    y_checklist,
+    checklist_cell_ids,
+    samples,
+    design_info,
+    species=None,
+    n_draws=None,
+    representative_draws=None,
+):
+    """Predicts the probability of presence in each cell given the checklists
+    observed there, averaged over posterior draws; see
+    predict_conditional_occupancy_from_samples.
+
+    The arguments are as for predict_env, with X_env the environmental
+    covariates of the cells, X_obs the checklist covariates, y_checklist the
+    detections on the checklists (with a column for each species predicted)
+    and checklist_cell_ids the cell of each checklist, indexing X_env.
+
+    Returns:
+        A DataFrame of probabilities [n_cells x n_species].
+    """
+
+    species_names = design_info["species_names"] if species is None else species
+    species_indices = find_species_indices(design_info["species_names"], species)
+    draw_indices, draw_weights = select_prediction_draws(
+        samples, n_draws, representative_draws
+    )
+
+    env_covs = build_env_covs(X_env, design_info)
+    obs_covs = build_compact_design(design_info["obs"], X_obs)
+
+    env_slope_samples, env_intercept_samples = fetch_env_samples(
+        samples, species_indices, draw_indices
+    )
+    obs_slope_samples = fetch_obs_samples(samples, species_indices, draw_indices)
+
+    occupancy = predict_conditional_occupancy_from_samples(
+        env_covs,
+        env_slope_samples,
+        env_intercept_samples,
+        obs_covs,
+        obs_slope_samples,
+        y_checklist[species_names],
+        checklist_cell_ids,
+        None if draw_weights is None else np.asarray(draw_weights),
+    )
+
+    return pd.DataFrame(occupancy, index=X_env.index, columns=species_names)
+
+
+def compress_posterior(
+    X_env,
+    samples,
+    design_info,
+    X_obs=None,
+    n_representative=50,
+    tolerance=None,
+    quantiles=(0.05, 0.5, 0.95),
+):
+    """Selects a small weighted set of draws representing the posterior.
+
+    The draws are chosen such that the weighted mean and quantiles of their
+    predictions on the validation set given are close to those of all draws;
+    see functional.draw_compression for details and the guarantee given.
+
+    Args:
+        X_env: The environmental covariates of the validation set.
+        samples: The draws, as an arviz InferenceData or a DrawStore.
+        design_info: The design info returned by fit.
+        X_obs: If given, the draws are chosen based on the probabilities of
+            observation on these checklists (with X_env the covariates of each
+            checklist's cell) rather than those of presence.
+        n_representative: The maximum number of draws to select.
+        tolerance: If given, fewer draws are selected if the maximum absolute
+            errors of the mean prediction and of each quantile are at most
+            this; a warning is raised if n_representative draws do not reach
+            it.
+        quantiles: The quantiles of the predictions to preserve.
+
+    Returns:
+        A dictionary with the "indices" of the selected draws, their
+        "weights" and the maximum absolute "errors" of the mean and of each
+        quantile on the validation set.
+    """
+
+    # The validation set is small, so its design can be dense.
+    env_covs = as_dense(build_env_covs(X_env, design_info))
+    env_slope_samples, env_intercept_samples = fetch_env_samples(samples)
+
+    if X_obs is None:
+        draw_predictions = compute_draw_predictions(
+            env_covs, env_slope_samples, env_intercept_samples
+        )
+    else:
+        obs_covs = as_dense(build_compact_design(design_info["obs"], X_obs))
+        draw_predictions = compute_draw_predictions(
+            env_covs,
+            env_slope_samples,
+            env_intercept_samples,
+            obs_covs,
+            fetch_obs_samples(samples),
+        )
+
+    indices, weights, errors = select_representative_draws(
+        draw_predictions, n_representative, tolerance, quantiles
     )
 
-    return pd.DataFrame(result, columns=design_info["species_names"])
+    return {"indices": indices, "weights": weights, "errors": errors}
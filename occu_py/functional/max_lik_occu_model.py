@@ -2,25 +2,98 @@ import numpy as np
 import pandas as pd
 import jax.numpy as jnp
 from ml_tools.max_lik import find_map_estimate
-from patsy import dmatrix, build_design_matrices
 from functools import partial
-from jax import jit
+from jax import jit, vmap, hessian, device_put
+from jax.flatten_util import ravel_pytree
+from jax.tree_util import tree_map
 from occu_py.likelihoods import compute_checklist_likelihood
-from sklearn.preprocessing import StandardScaler
+from occu_py.utils import split_every
+from tqdm import tqdm
+from .newton import maximise_newton
+from ..precision import get_precision_dtypes, get_design_dtype, cast_to
+from ..compilation_cache import bucket_size
+from ..compact_design import (
+    compact_dmatrix,
+    build_compact_design,
+    design_dot,
+    pad_design,
+    fit_standard_scaler,
+    standardise_design,
+    register_pytree,
+    SPARSE_THRESHOLD,
+)
 
+# The designs are passed to the jitted fits as arguments.
+register_pytree()
 
-def likelihood_fun(theta, m, X_env, X_checklist, checklist_cell_ids, n_cells):
 
-    env_logit = X_env @ theta["env_coefs"]
-    obs_logit = X_checklist @ theta["obs_coefs"]
+def likelihood_fun(
+    theta,
+    m,
+    X_env,
+    X_checklist,
+    checklist_cell_ids,
+    n_cells,
+    cell_weights=None,
+    precision=None,
+):
+
+    compute_dtype, accumulation_dtype = get_precision_dtypes(precision)
+
+    env_logit = design_dot(
+        X_env, cast_to(theta["env_coefs"], compute_dtype), accumulation_dtype
+    )
+    obs_logit = design_dot(
+        X_checklist, cast_to(theta["obs_coefs"], compute_dtype), accumulation_dtype
+    )
 
     likelihood = compute_checklist_likelihood(
-        env_logit, obs_logit, m, checklist_cell_ids, n_cells
+        env_logit, obs_logit, m, checklist_cell_ids, n_cells, accumulation_dtype
     )
 
+    # Cells are the independent units in the model, so weights (e.g. for the
+    # bootstrap) apply to the per-cell likelihood terms.
+    if cell_weights is not None:
+        likelihood = likelihood * cell_weights
+
     return jnp.sum(likelihood)
 
 
+def pad_to_buckets(env_covs, checklist_covs, y_checklist, cell_ids):
+    """Pads the data of a fit to bucketed sizes.
+
+    So that fits to data of similar size compile to the same executables (see
+    occu_py.compilation_cache), the numbers of cells, checklists and non-zero
+    sparse env entries are padded to the sizes given by bucket_size. The padded
+    checklists have no observations and belong to a padded cell, and the
+    padded cells get zero weight, so that the likelihood is unchanged.
+
+    Returns:
+        A tuple of the padded env design, checklist design, y_checklist and
+        cell ids, and the cell weights, which are one for the cells and zero
+        for the padding.
+    """
+
+    n_cells, n_checklists = env_covs.shape[0], checklist_covs.shape[0]
+
+    # Leave room for at least one padded cell to hold the padded checklists.
+    n_padded_cells = bucket_size(n_cells + 1)
+    n_padded_checklists = bucket_size(n_checklists)
+    n_padding = n_padded_checklists - n_checklists
+
+    env_covs = pad_design(
+        env_covs, n_padded_cells, bucket_size(env_covs.sparse_values.shape[0])
+    )
+    checklist_covs = pad_design(checklist_covs, n_padded_checklists)
+    y_checklist = np.pad(np.asarray(y_checklist), ((0, n_padding), (0, 0)))
+    cell_ids = np.pad(np.asarray(cell_ids), (0, n_padding), constant_values=n_cells)
+
+    cell_weights = np.zeros(n_padded_cells)
+    cell_weights[:n_cells] = 1.0
+
+    return env_covs, checklist_covs, y_checklist, cell_ids, cell_weights
+
+
 def fit(
     X_env: pd.DataFrame,
     X_checklist: pd.DataFrame,
@@ -30,17 +103,20 @@ def fit(
     checklist_formula: str,
     scale_env_data=False,
     gtol=1e-3,
+    precision=None,
 ):
 
-    env_design_mat = dmatrix(env_formula, X_env)
-    checklist_design_mat = dmatrix(checklist_formula, X_checklist)
-
-    env_covs = np.asarray(env_design_mat)
-    checklist_covs = np.asarray(checklist_design_mat)
+    design_dtype = get_design_dtype(precision)
+    env_covs, env_design_info = compact_dmatrix(
+        env_formula, X_env, sparse_threshold=SPARSE_THRESHOLD, dtype=design_dtype
+    )
+    checklist_covs, checklist_design_info = compact_dmatrix(
+        checklist_formula, X_checklist, dtype=design_dtype
+    )
 
     if scale_env_data:
-        scaler = StandardScaler()
-        env_covs = scaler.fit_transform(env_covs)
+        scaler = fit_standard_scaler(env_covs)
+        env_covs = standardise_design(env_covs, scaler.mean_, scaler.scale_)
     else:
         scaler = None
 
@@ -57,6 +133,7 @@ def fit(
             X_checklist=checklist_covs,
             checklist_cell_ids=cell_ids,
             n_cells=X_env.shape[0],
+            precision=precision,
         )
     )
 
@@ -65,12 +142,12 @@ def fit(
     )
 
     env_coef_results = pd.Series(
-        np.array(fit_result["env_coefs"]), index=env_design_mat.design_info.column_names
+        np.array(fit_result["env_coefs"]), index=env_design_info.column_names
     )
 
     obs_coef_results = pd.Series(
         np.array(fit_result["obs_coefs"]),
-        index=checklist_design_mat.design_info.column_names,
+        index=checklist_design_info.column_names,
     )
 
     return {
@@ -81,28 +158,372 @@ def fit(
         "checklist_formula": checklist_formula,
         "optimisation_successful": opt_result.success,
         "opt_result": opt_result,
-        "env_design_info": env_design_mat.design_info,
-        "obs_design_info": checklist_design_mat.design_info,
+        "env_design_info": env_design_info,
+        "obs_design_info": checklist_design_info,
     }
 
 
+def fit_newton(
+    X_env: pd.DataFrame,
+    X_checklist: pd.DataFrame,
+    y_checklist: np.ndarray,
+    cell_ids: np.ndarray,
+    env_formula: str,
+    checklist_formula: str,
+    gtol=1e-3,
+    max_iter=250,
+    species_batch_size=32,
+    verbose=False,
+    precision=None,
+):
+    """Fits many species at once using the on-device Newton solver.
+
+    Species are fitted in batches of species_batch_size using a vmapped
+    version of maximise_newton, so that the whole optimisation for a batch runs
+    without returning to the host. The final batch is padded to the full size
+    to avoid recompiling, and the data are padded to bucketed sizes (see
+    pad_to_buckets), so that fits to data of similar size can load the compiled
+    batch from the persistent compilation cache.
+
+    The numerical precision (see occu_py.precision) is None by default, i.e.
+    that of JAX's global setting; otherwise, this should be called within
+    precision_scope(precision).
+
+    Returns:
+        A list with one entry per column in y_checklist, each in the same
+        format as the output of fit.
+    """
+
+    design_dtype = get_design_dtype(precision)
+    env_covs, env_design_info = compact_dmatrix(
+        env_formula, X_env, sparse_threshold=SPARSE_THRESHOLD, dtype=design_dtype
+    )
+    checklist_covs, checklist_design_info = compact_dmatrix(
+        checklist_formula, X_checklist, dtype=design_dtype
+    )
+
+    theta = {
+        "env_coefs": jnp.zeros(env_covs.shape[1]),
+        "obs_coefs": jnp.zeros(checklist_covs.shape[1]),
+    }
+
+    *data, y_checklist, cell_ids, cell_weights = pad_to_buckets(
+        env_covs, checklist_covs, y_checklist, cell_ids
+    )
+    data = device_put((*data, cell_ids, cell_weights))
+    n_cells = cell_weights.shape[0]
+
+    # The data are arguments rather than constants, so that the compiled
+    # function only depends on their shapes.
+    def fit_species(cur_y, cur_env_covs, cur_checklist_covs, cur_ids, cur_weights):
+
+        cur_lik = partial(
+            likelihood_fun,
+            m=1 - cur_y,
+            X_env=cur_env_covs,
+            X_checklist=cur_checklist_covs,
+            checklist_cell_ids=cur_ids,
+            n_cells=n_cells,
+            cell_weights=cur_weights,
+            precision=precision,
+        )
+
+        return maximise_newton(cur_lik, theta, gtol=gtol, max_iter=max_iter)
+
+    fit_batch = jit(vmap(fit_species, in_axes=(0, None, None, None, None)))
+
+    n_species = y_checklist.shape[1]
+    batch_size = min(species_batch_size, n_species)
+
+    batches = list(split_every(batch_size, np.arange(n_species)))
+
+    if verbose:
+        batches = tqdm(batches)
+
+    results = list()
+
+    for cur_batch in batches:
+
+        cur_batch = list(cur_batch)
+        n_padding = batch_size - len(cur_batch)
+        cur_y = y_checklist[:, cur_batch + [cur_batch[-1]] * n_padding]
+
+        fit_result, opt_result = fit_batch(cur_y.T, *data)
+
+        for i in range(len(cur_batch)):
+
+            cur_opt_result = tree_map(lambda x: np.asarray(x[i]), opt_result)
+
+            env_coef_results = pd.Series(
+                np.asarray(fit_result["env_coefs"][i]),
+                index=env_design_info.column_names,
+            )
+
+            obs_coef_results = pd.Series(
+                np.asarray(fit_result["obs_coefs"][i]),
+                index=checklist_design_info.column_names,
+            )
+
+            results.append(
+                {
+                    "env_coefs": env_coef_results,
+                    "obs_coefs": obs_coef_results,
+                    "env_scaler": None,
+                    "env_formula": env_formula,
+                    "checklist_formula": checklist_formula,
+                    "optimisation_successful": bool(cur_opt_result.success),
+                    "opt_result": cur_opt_result,
+                    "env_design_info": env_design_info,
+                    "obs_design_info": checklist_design_info,
+                }
+            )
+
+    return results
+
+
+def fit_bootstrap(
+    X_env: pd.DataFrame,
+    X_checklist: pd.DataFrame,
+    y_checklist: np.ndarray,
+    cell_ids: np.ndarray,
+    env_formula: str,
+    checklist_formula: str,
+    init_env_coefs: np.ndarray,
+    init_obs_coefs: np.ndarray,
+    n_bootstrap=100,
+    seed=2,
+    gtol=1e-3,
+    max_iter=100,
+    species_batch_size=4,
+    verbose=False,
+    precision=None,
+):
+    """Runs a Poisson bootstrap for many species at once.
+
+    Each replicate reweights the cells with independent Poisson(1) weights,
+    which approximates resampling cells with replacement. The same weights are
+    used for all species. All replicates of a batch of species are fitted
+    together with a vmapped maximise_newton, starting from the point estimates.
+
+    Args:
+        init_env_coefs: Point estimates of the env coefs [S x n_env_coefs].
+        init_obs_coefs: Point estimates of the obs coefs [S x n_obs_coefs].
+        n_bootstrap: The number of bootstrap replicates.
+        seed: Random seed for the bootstrap weights.
+
+    Other arguments are as for fit_newton.
+
+    Returns:
+        A dictionary with the bootstrap draws of "env_coefs" [S x n_bootstrap x
+        n_env_coefs] and "obs_coefs" [S x n_bootstrap x n_obs_coefs], and the
+        convergence flags "successful" [S x n_bootstrap].
+    """
+
+    design_dtype = get_design_dtype(precision)
+    env_covs, _ = compact_dmatrix(
+        env_formula, X_env, sparse_threshold=SPARSE_THRESHOLD, dtype=design_dtype
+    )
+    checklist_covs, _ = compact_dmatrix(
+        checklist_formula, X_checklist, dtype=design_dtype
+    )
+
+    *data, y_checklist, cell_ids, cell_weights = pad_to_buckets(
+        env_covs, checklist_covs, y_checklist, cell_ids
+    )
+    data = device_put((*data, cell_ids))
+    n_cells = cell_weights.shape[0]
+
+    # The padded cells keep a weight of zero, as in cell_weights.
+    np.random.seed(seed)
+    weights = np.zeros((n_bootstrap, n_cells))
+    weights[:, : X_env.shape[0]] = np.random.poisson(
+        1.0, size=(n_bootstrap, X_env.shape[0])
+    )
+
+    def fit_replicate(
+        theta_init, cur_y, cur_weights, cur_env_covs, cur_checklist_covs, cur_ids
+    ):
+
+        cur_lik = partial(
+            likelihood_fun,
+            m=1 - cur_y,
+            X_env=cur_env_covs,
+            X_checklist=cur_checklist_covs,
+            checklist_cell_ids=cur_ids,
+            n_cells=n_cells,
+            cell_weights=cur_weights,
+            precision=precision,
+        )
+
+        return maximise_newton(cur_lik, theta_init, gtol=gtol, max_iter=max_iter)
+
+    # The inner vmap is over replicates, the outer one over species.
+    fit_batch = jit(
+        vmap(
+            vmap(fit_replicate, in_axes=(None, None, 0, None, None, None)),
+            in_axes=(0, 1, None, None, None, None),
+        )
+    )
+
+    n_species = y_checklist.shape[1]
+    batch_size = min(species_batch_size, n_species)
+
+    batches = list(split_every(batch_size, np.arange(n_species)))
+
+    if verbose:
+        batches = tqdm(batches)
+
+    results = {"env_coefs": list(), "obs_coefs": list(), "successful": list()}
+
+    for cur_batch in batches:
+
+        cur_batch = list(cur_batch)
+        n_padding = batch_size - len(cur_batch)
+        cur_indices = cur_batch + [cur_batch[-1]] * n_padding
+
+        theta_init = {
+            "env_coefs": jnp.asarray(init_env_coefs[cur_indices]),
+            "obs_coefs": jnp.asarray(init_obs_coefs[cur_indices]),
+        }
+
+        fit_result, opt_result = fit_batch(
+            theta_init, y_checklist[:, cur_indices], weights, *data
+        )
+
+        n_valid = len(cur_batch)
+
+        results["env_coefs"].append(np.asarray(fit_result["env_coefs"][:n_valid]))
+        results["obs_coefs"].append(np.asarray(fit_result["obs_coefs"][:n_valid]))
+        results["successful"].append(np.asarray(opt_result.success[:n_valid]))
+
+    return {x: np.concatenate(y) for x, y in results.items()}
+
+
+def compute_covariances(
+    X_env: pd.DataFrame,
+    X_checklist: pd.DataFrame,
+    y_checklist: np.ndarray,
+    cell_ids: np.ndarray,
+    env_formula: str,
+    checklist_formula: str,
+    env_coefs: np.ndarray,
+    obs_coefs: np.ndarray,
+    species_batch_size=32,
+    min_eigval=1e-8,
+    precision=None,
+):
+    """Computes the asymptotic covariance of the maximum likelihood estimates.
+
+    This is the inverse of the observed information, i.e. of the negative
+    Hessian of likelihood_fun at the estimates. The Hessians of a batch of
+    species are computed together with a vmapped exact Hessian.
+
+    Args:
+        env_coefs: The estimated env coefs [S x n_env_coefs].
+        obs_coefs: The estimated obs coefs [S x n_obs_coefs].
+        min_eigval: Eigenvalues of the observed information are floored at
+            this value before inverting, in case it is not positive definite.
+
+    Other arguments are as for fit_newton.
+
+    Returns:
+        The covariance matrices [S x p x p], where p = n_env_coefs +
+        n_obs_coefs and the env coefs come first.
+    """
+
+    design_dtype = get_design_dtype(precision)
+    env_covs, _ = compact_dmatrix(
+        env_formula, X_env, sparse_threshold=SPARSE_THRESHOLD, dtype=design_dtype
+    )
+    checklist_covs, _ = compact_dmatrix(
+        checklist_formula, X_checklist, dtype=design_dtype
+    )
+
+    *data, y_checklist, cell_ids, cell_weights = pad_to_buckets(
+        env_covs, checklist_covs, y_checklist, cell_ids
+    )
+    data = device_put((*data, cell_ids, cell_weights))
+    n_cells = cell_weights.shape[0]
+
+    def species_information(
+        cur_env_coefs,
+        cur_obs_coefs,
+        cur_y,
+        cur_env_covs,
+        cur_checklist_covs,
+        cur_ids,
+        cur_weights,
+    ):
+
+        cur_lik = partial(
+            likelihood_fun,
+            m=1 - cur_y,
+            X_env=cur_env_covs,
+            X_checklist=cur_checklist_covs,
+            checklist_cell_ids=cur_ids,
+            n_cells=n_cells,
+            cell_weights=cur_weights,
+            precision=precision,
+        )
+
+        theta = {"env_coefs": cur_env_coefs, "obs_coefs": cur_obs_coefs}
+        flat_theta, unravel = ravel_pytree(theta)
+
+        return -hessian(lambda x: cur_lik(unravel(x)))(flat_theta)
+
+    batch_information = jit(
+        vmap(species_information, in_axes=(0, 0, 1, None, None, None, None))
+    )
+
+    n_species = y_checklist.shape[1]
+    batch_size = min(species_batch_size, n_species)
+
+    covariances = list()
+
+    for cur_batch in split_every(batch_size, np.arange(n_species)):
+
+        cur_batch = list(cur_batch)
+        n_padding = batch_size - len(cur_batch)
+        cur_indices = cur_batch + [cur_batch[-1]] * n_padding
+
+        cur_information = np.asarray(
+            batch_information(
+                env_coefs[cur_indices],
+                obs_coefs[cur_indices],
+                y_checklist[:, cur_indices],
+                *data,
+            )
+        )[: len(cur_batch)]
+
+        eigvals, eigvecs = np.linalg.eigh(cur_information)
+        eigvals = np.maximum(eigvals, min_eigval)
+
+        covariances.append(
+            np.einsum("spq,sq,srq->spr", eigvecs, 1.0 / eigvals, eigvecs)
+        )
+
+    return np.concatenate(covariances)
+
+
 def predict_env_logit(X_env, design_info, env_coefs, scaler=None):
 
-    env_design_mat = np.asarray(build_design_matrices([design_info], X_env)[0])
+    env_design = build_compact_design(
+        design_info, X_env, sparse_threshold=SPARSE_THRESHOLD
+    )
 
     if scaler is not None:
-        env_design_mat = scaler.transform(env_design_mat)
+        env_design = standardise_design(env_design, scaler.mean_, scaler.scale_)
 
-    env_logit = env_design_mat @ env_coefs
+    env_logit = design_dot(env_design, env_coefs)
 
     return env_logit
 
 
 def predict_obs_logit(X_obs, design_info, obs_coefs):
 
-    obs_design_mat = np.asarray(build_design_matrices([design_info], X_obs)[0])
+    obs_design = build_compact_design(design_info, X_obs)
 
-    obs_logit = obs_design_mat @ obs_coefs
+    obs_logit = design_dot(obs_design, obs_coefs)
 
     return obs_logit
 
@@ -6,6 +6,8 @@ from jax_advi.constraints import constrain_positive
 from occu_py.likelihoods import compute_checklist_likelihood
 from ml_tools.jax import half_normal_logpdf
 from occu_py.utils import split_every
+from occu_py.compact_design import design_dot
+from occu_py.precision import get_precision_dtypes, cast_to
 
 theta_constraints = {
     "obs_coef_prior_sds": constrain_positive,
@@ -20,21 +22,40 @@ def calculate_likelihood_single(
     cur_env_intercept,
     cur_y,
     cell_ids,
+    precision=None,
 ):
 
     cell_ids = jnp.array(cell_ids)
 
-    obs_logits = X_checklist @ cur_obs_coefs
-    env_logits = X_env @ cur_env_slopes + cur_env_intercept
+    # See occu_py.precision: the products take inputs in compute_dtype and
+    # accumulate in accumulation_dtype, as do the per-cell sums.
+    compute_dtype, accumulation_dtype = get_precision_dtypes(precision)
+
+    cur_obs_coefs, cur_env_slopes, cur_env_intercept = [
+        cast_to(x, compute_dtype)
+        for x in [cur_obs_coefs, cur_env_slopes, cur_env_intercept]
+    ]
+
+    obs_logits = design_dot(X_checklist, cur_obs_coefs, accumulation_dtype)
+    env_logits = (
+        design_dot(X_env, cur_env_slopes, accumulation_dtype) + cur_env_intercept
+    )
 
     cur_lik = compute_checklist_likelihood(
-        env_logits, obs_logits, 1 - cur_y, cell_ids, env_logits.shape[0]
+        env_logits,
+        obs_logits,
+        1 - cur_y,
+        cell_ids,
+        env_logits.shape[0],
+        accumulation_dtype,
     )
 
     return jnp.sum(cur_lik)
 
 
-def calculate_likelihood(theta, X_env, X_checklist, y_checklist, cell_ids):
+def calculate_likelihood(
+    theta, X_env, X_checklist, y_checklist, cell_ids, precision=None
+):
 
     curried_lik = lambda cur_obs_coefs, cur_env_slopes, cur_env_intercept, cur_y: calculate_likelihood_single(
         X_checklist,
@@ -44,6 +65,7 @@ def calculate_likelihood(theta, X_env, X_checklist, y_checklist, cell_ids):
         cur_env_intercept,
         cur_y,
         cell_ids,
+        precision,
     )
 
     lik = vmap(curried_lik)(
@@ -57,7 +79,7 @@ def calculate_likelihood(theta, X_env, X_checklist, y_checklist, cell_ids):
 
 
 def calculate_likelihood_for_loop(
-    theta, X_env, X_checklist, y_checklist, cell_ids, batch_size=8
+    theta, X_env, X_checklist, y_checklist, cell_ids, batch_size=8, precision=None
 ):
 
     curried_lik = lambda cur_obs_coefs, cur_env_slopes, cur_env_intercept, cur_y: calculate_likelihood_single(
@@ -68,6 +90,7 @@ def calculate_likelihood_for_loop(
         cur_env_intercept,
         cur_y,
         cell_ids,
+        precision,
     )
 
     vmapped = vmap(curried_lik)
@@ -0,0 +1,126 @@
+import jax.numpy as jnp
+from jax import lax, grad, hessian
+from jax.flatten_util import ravel_pytree
+from typing import NamedTuple
+
+
+class NewtonResult(NamedTuple):
+
+    # Optimum found, as a flat vector.
+    x: jnp.ndarray
+
+    # Objective, gradient and Hessian at x. Like scipy, these refer to the
+    # function being minimised, i.e. the negative of the one maximised.
+    fun: jnp.ndarray
+    jac: jnp.ndarray
+    hess: jnp.ndarray
+
+    # Number of iterations taken.
+    nit: jnp.ndarray
+
+    # Whether the gradient norm dropped below gtol.
+    success: jnp.ndarray
+
+
+def maximise_newton(
+    fun,
+    theta_init,
+    gtol=1e-3,
+    max_iter=100,
+    init_damping=1e-4,
+    min_damping=1e-8,
+    max_damping=1e12,
+):
+    """Maximises fun using a damped Newton method with exact Hessians.
+
+    The whole optimisation runs inside a single lax.while_loop, so it can be
+    jitted and vmapped (e.g. over species). Each step solves (H + shift * I) p
+    = -g, where the shift makes the system positive definite and is at least
+    the current damping. As in a trust-region method, the damping is adapted
+    by comparing the actual reduction in the objective to the one predicted by
+    the quadratic model, and steps that do not reduce the objective are
+    rejected. This is only sensible for problems with few parameters, since
+    the Hessian is formed and decomposed explicitly.
+
+    Args:
+        fun: The function to maximise. Takes a pytree shaped like theta_init.
+        theta_init: Initial value of the parameters [pytree].
+        gtol: Convergence is declared once the gradient norm falls below this.
+        max_iter: Maximum number of Newton iterations.
+        init_damping: Initial damping added to the Hessian diagonal.
+        min_damping: Lower bound on the damping.
+        max_damping: The optimisation stops if the damping exceeds this.
+
+    Returns:
+        A tuple of the optimum [pytree shaped like theta_init] and a
+        NewtonResult.
+    """
+
+    flat_init, unravel = ravel_pytree(theta_init)
+
+    to_minimise = lambda x: -fun(unravel(x))
+    grad_fun = grad(to_minimise)
+    hess_fun = hessian(to_minimise)
+
+    def is_converged(g):
+
+        return jnp.linalg.norm(g) <= gtol
+
+    def cond_fun(state):
+
+        x, f, g, H, damping, i = state
+
+        return (~is_converged(g)) & (i < max_iter) & (damping < max_damping)
+
+    def body_fun(state):
+
+        x, f, g, H, damping, i = state
+
+        # Shift the eigenvalues of H so that the system is positive definite,
+        # with the smallest eigenvalue at least equal to the damping.
+        eigvals, eigvecs = jnp.linalg.eigh(H)
+        shift = jnp.maximum(damping, damping - jnp.min(eigvals))
+        step = -eigvecs @ ((eigvecs.T @ g) / (eigvals + shift))
+
+        x_new = x + step
+        f_new = to_minimise(x_new)
+
+        # Compare the actual reduction to the one predicted by the quadratic
+        # model to decide whether to accept the step and how to adapt the
+        # damping.
+        predicted = -(g @ step + 0.5 * step @ H @ step)
+        ratio = (f - f_new) / predicted
+
+        accept = jnp.isfinite(f_new) & (f_new < f) & (ratio > 1e-4)
+
+        x, f, g, H = lax.cond(
+            accept,
+            lambda _: (x_new, f_new, grad_fun(x_new), hess_fun(x_new)),
+            lambda _: (x, f, g, H),
+            None,
+        )
+
+        damping = jnp.where(
+            accept & (ratio > 0.75),
+            jnp.maximum(damping * 0.3, min_damping),
+            jnp.where(accept & (ratio > 0.25), damping, damping * 4.0),
+        )
+
+        return x, f, g, H, damping, i + 1
+
+    init_state = (
+        flat_init,
+        to_minimise(flat_init),
+        grad_fun(flat_init),
+        hess_fun(flat_init),
+        jnp.asarray(init_damping, dtype=flat_init.dtype),
+        0,
+    )
+
+    x, f, g, H, _, n_iter = lax.while_loop(cond_fun, body_fun, init_state)
+
+    result = NewtonResult(
+        x=x, fun=f, jac=g, hess=H, nit=n_iter, success=is_converged(g)
+    )
+
+    return unravel(x), result
@@ -0,0 +1,196 @@
+# Functions for predicting with the coefficients of maximum likelihood models,
+# and with the coefficient draws of the presence-absence model. These only need
+# numpy, scipy and patsy, so that fitted models can be restored and used for
+# prediction without loading JAX.
+import numpy as np
+from scipy.special import expit
+from ..compact_design import build_compact_design, design_dot, SPARSE_THRESHOLD
+
+# The draws are averaged in batches such that the intermediate
+# [n_rows x n_draws x n_species] arrays have at most this many elements.
+MAX_CHUNK_ELEMENTS = 2**22
+
+
+def draw_from_covariances(means, covariances, n_draws, seed):
+    """Draws from independent Gaussians, one per species.
+
+    Args:
+        means: The means [S x p].
+        covariances: The covariance matrices [S x p x p].
+        n_draws: The number of draws per species.
+        seed: The random seed to use.
+
+    Returns:
+        The draws [S x n_draws x p].
+    """
+
+    np.random.seed(seed)
+
+    # The covariances come from an eigendecomposition, so they may be
+    # singular up to rounding; the eigendecomposition is safe to use here.
+    eigvals, eigvecs = np.linalg.eigh(covariances)
+    scales = eigvecs * np.sqrt(np.maximum(eigvals, 0.0))[:, None, :]
+
+    z = np.random.randn(means.shape[0], n_draws, means.shape[1])
+
+    return means[:, None, :] + np.einsum("spq,sdq->sdp", scales, z)
+
+
+def stack_coefficients(fit_results, key):
+    # Stacks the coefficients of the species' fit results into a matrix
+    # [n_coefs x n_species].
+
+    return np.stack([np.asarray(x[key]) for x in fit_results], axis=1)
+
+
+def log_sigmoid_in_place(logits):
+    # Computes log_sigmoid(x) = -log(1 + exp(-x)) without allocating any
+    # temporary arrays.
+
+    np.negative(logits, out=logits)
+    np.logaddexp(0.0, logits, out=logits)
+    np.negative(logits, out=logits)
+
+    return logits
+
+
+def predict_log_marginal_probabilities(
+    X_env,
+    env_design_info,
+    env_coef_matrix,
+    X_obs=None,
+    obs_design_info=None,
+    obs_coef_matrix=None,
+    chunk_size=10000,
+    dtype=np.float32,
+):
+    """Predicts the log probabilities of presence (or of observation) for all
+    species at once.
+
+    The rows are processed in chunks of chunk_size. For each chunk, the design
+    matrix is built once and multiplied with the coefficients of all species;
+    the design matrices are built in their compact form (see compact_design),
+    with sparse env indicators.
+
+    Args:
+        X_env: The environmental covariates.
+        env_design_info: The patsy design info of the env design matrix.
+        env_coef_matrix: The env coefficients [n_env_coefs x n_species].
+        X_obs: If given, the log probability of observation is returned
+            instead, i.e. that of presence plus that of detection.
+        obs_design_info: The patsy design info of the obs design matrix.
+        obs_coef_matrix: The obs coefficients [n_obs_coefs x n_species].
+        chunk_size: The number of rows to process at once.
+        dtype: The floating point type of the computation and the result.
+
+    Returns:
+        The log probabilities [n_rows x n_species].
+    """
+
+    n_rows = X_env.shape[0]
+
+    env_coef_matrix = np.asarray(env_coef_matrix, dtype=dtype)
+    log_probs = np.empty((n_rows, env_coef_matrix.shape[1]), dtype=dtype)
+
+    if X_obs is not None:
+        obs_coef_matrix = np.asarray(obs_coef_matrix, dtype=dtype)
+
+    for start in range(0, n_rows, chunk_size):
+
+        rows = slice(start, start + chunk_size)
+
+        env_design = build_compact_design(
+            env_design_info,
+            X_env.iloc[rows],
+            dtype=dtype,
+            sparse_threshold=SPARSE_THRESHOLD,
+        )
+
+        cur_log_probs = log_sigmoid_in_place(design_dot(env_design, env_coef_matrix))
+
+        if X_obs is not None:
+
+            obs_design = build_compact_design(
+                obs_design_info, X_obs.iloc[rows], dtype=dtype
+            )
+
+            cur_log_probs += log_sigmoid_in_place(
+                design_dot(obs_design, obs_coef_matrix)
+            )
+
+        log_probs[rows] = cur_log_probs
+
+    return log_probs
+
+
+def predict_mean_probabilities_from_draws(
+    X_env,
+    env_design_info,
+    env_slope_draws,
+    env_intercept_draws,
+    chunk_size=10000,
+    draw_batch_size=None,
+    dtype=np.float32,
+):
+    """Predicts the probabilities of presence averaged over coefficient draws.
+
+    The rows are processed in chunks of chunk_size, and the draws in batches of
+    draw_batch_size. For each chunk of rows, the design is built once, and the
+    draws of each batch are multiplied with it at once, so that only a [chunk
+    x draw batch x species] array of logits is held in memory.
+
+    Args:
+        X_env: The environmental covariates.
+        env_design_info: The patsy design info of the env design, whose
+            intercept column is left out.
+        env_slope_draws: The slope draws [n_species x n_draws x n_env_coefs].
+        env_intercept_draws: The intercept draws [n_species x n_draws].
+        chunk_size: The number of rows to process at once.
+        draw_batch_size: The number of draws to process at once. By default,
+            this is chosen such that the logits have at most
+            MAX_CHUNK_ELEMENTS elements.
+        dtype: The floating point type of the computation and the result.
+
+    Returns:
+        The probabilities [n_rows x n_species].
+    """
+
+    n_species, n_draws, n_coefs = env_slope_draws.shape
+    n_rows = X_env.shape[0]
+
+    if draw_batch_size is None:
+        draw_batch_size = max(1, MAX_CHUNK_ELEMENTS // (chunk_size * n_species))
+
+    probs = np.zeros((n_rows, n_species), dtype=dtype)
+
+    for start in range(0, n_rows, chunk_size):
+
+        rows = slice(start, start + chunk_size)
+
+        env_design = build_compact_design(
+            env_design_info,
+            X_env.iloc[rows],
+            dtype=dtype,
+            sparse_threshold=SPARSE_THRESHOLD,
+            drop_intercept=True,
+        )
+
+        for draw_start in range(0, n_draws, draw_batch_size):
+
+            draws = slice(draw_start, draw_start + draw_batch_size)
+
+            # [n_coefs x (n_batch_draws * n_species)], with the draws varying
+            # slowest.
+            coefs = np.asarray(env_slope_draws[:, draws], dtype=dtype)
+            coefs = coefs.transpose(2, 1, 0).reshape(n_coefs, -1)
+
+            logits = design_dot(env_design, coefs).reshape(
+                env_design.shape[0], -1, n_species
+            )
+            logits += np.asarray(env_intercept_draws[:, draws], dtype=dtype).T
+
+            probs[rows] += expit(logits, out=logits).sum(axis=1)
+
+    probs /= n_draws
+
+    return probs
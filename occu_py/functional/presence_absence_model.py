@@ -1,4 +1,5 @@
 import numpy as np
+import pandas as pd
 import jax.numpy as jnp
 from patsy import dmatrix, build_design_matrices
 from ml_tools.patsy import remove_intercept_column
@@ -7,6 +8,9 @@ from jax.scipy.stats import norm
 from jax_advi.advi import optimize_advi_mean_field
 from functools import partial
 from scipy.special import expit
+from ..compact_design import design_dot
+from ..utils import split_every
+from .hierarchical_checklist_model_mcmc import design_env_covs
 
 
 def compute_likelihood(theta, y, X):
@@ -38,7 +42,9 @@ def fit(formula, X_df, y, prior_sd=1.0, intercept_prior_sd=10.0, M=100, verbose=
 
     theta_shape_dict = {"beta_env": (X_env_mat.shape[1],), "intercept": ()}
     cur_lik = partial(compute_likelihood, y=y, X=X_env_mat)
-    cur_prior = partial(compute_prior, prior_sd=prior_sd)
+    cur_prior = partial(
+        compute_prior, prior_sd=prior_sd, intercept_prior_sd=intercept_prior_sd
+    )
 
     result = optimize_advi_mean_field(
         theta_shape_dict, cur_prior, cur_lik, verbose=verbose, M=M
@@ -64,3 +70,147 @@ def predict(X_new, draws, design_info):
     ).mean(axis=0)
 
     return probs
+
+
+def count_detections_per_cell(y_checklist, checklist_cell_ids):
+    # The probability of a detection only depends on the cell, so the
+    # likelihood of the checklists only depends on the number of checklists
+    # and detections in each cell. Returns the cells with checklists, their
+    # number of checklists [n_used_cells] and of detections [n_used_cells x
+    # n_species].
+
+    counts = pd.DataFrame(np.asarray(y_checklist, dtype=float)).groupby(
+        np.asarray(checklist_cell_ids)
+    )
+
+    return (
+        counts.size().index.values,
+        counts.size().values.astype(float),
+        counts.sum().values,
+    )
+
+
+def compute_likelihood_multi(theta, X, n_detections, n_checklists):
+    # The likelihood of all species from the counts of count_detections_per_cell,
+    # with X the env design of the cells [n_cells x n_env_covs].
+
+    env_logits = design_dot(X, theta["env_slopes"]) + theta["env_intercepts"]
+
+    lik_terms = n_detections * log_sigmoid(env_logits) + (
+        n_checklists[:, None] - n_detections
+    ) * log_sigmoid(-env_logits)
+
+    return jnp.sum(lik_terms)
+
+
+def compute_prior_multi(theta, prior_sd, intercept_prior_sd):
+
+    return jnp.sum(norm.logpdf(theta["env_slopes"], 0.0, prior_sd)) + jnp.sum(
+        norm.logpdf(theta["env_intercepts"], 0.0, intercept_prior_sd)
+    )
+
+
+def fit_multi(
+    X_env,
+    y_checklist,
+    checklist_cell_ids,
+    formula,
+    prior_sd=1.0,
+    intercept_prior_sd=10.0,
+    M=100,
+    n_draws=1000,
+    species_batch_size=32,
+    seed=3,
+    verbose=False,
+):
+    """Fits the presence-absence model to many species at once.
+
+    The model is that of fit, with each checklist's detections treated as
+    presence or absence in its cell. The env design is built once, for the
+    cells with checklists, and shared by all species: the likelihood of a
+    batch of species is a single product of the design with their
+    coefficients, using the number of checklists and detections in each
+    cell. The species of a batch are fitted in a single mean-field ADVI
+    optimisation. Their objectives are independent, so this is equivalent to
+    fitting them one at a time, but needs one optimisation per batch rather
+    than per species.
+
+    Args:
+        X_env: The environmental covariates of the cells.
+        y_checklist: The detections [n_checklists x n_species].
+        checklist_cell_ids: The cell of each checklist, indexing X_env.
+        formula: Patsy formula for the environmental covariates.
+        prior_sd: The prior sd of the slopes.
+        intercept_prior_sd: The prior sd of the intercepts.
+        M: The number of draws used to estimate the ELBO.
+        n_draws: The number of posterior draws to return.
+        species_batch_size: The number of species fitted together. Memory use
+            grows with M * n_cells * species_batch_size.
+        seed: The random seed of the ADVI.
+        verbose: If True, shows the progress of the optimisation.
+
+    Returns:
+        A dictionary with the "draws" of the "env_slopes" [n_species x n_draws
+        x n_env_covs] and of the "env_intercepts" [n_species x n_draws], the
+        "design_info" of the env design, the "species_names" and whether the
+        optimisation of each species' batch was "successful".
+    """
+
+    cells_used, n_checklists, n_detections = count_detections_per_cell(
+        y_checklist, checklist_cell_ids
+    )
+
+    # The design info is built on all cells, so that its categories and
+    # stateful transforms (e.g. center) match those used in prediction, and
+    # only then restricted to the cells with checklists.
+    env_covs, design_info, _ = design_env_covs(X_env, formula, scale_env=False)
+    env_covs = env_covs[cells_used]
+
+    n_species = n_detections.shape[1]
+    batch_size = min(species_batch_size, n_species)
+
+    draws = {"env_slopes": list(), "env_intercepts": list()}
+    successful = list()
+
+    for cur_batch in split_every(batch_size, np.arange(n_species)):
+
+        theta_shape_dict = {
+            "env_slopes": (env_covs.shape[1], len(cur_batch)),
+            "env_intercepts": (len(cur_batch),),
+        }
+
+        cur_lik = partial(
+            compute_likelihood_multi,
+            X=env_covs,
+            n_detections=n_detections[:, cur_batch],
+            n_checklists=n_checklists,
+        )
+        cur_prior = partial(
+            compute_prior_multi,
+            prior_sd=prior_sd,
+            intercept_prior_sd=intercept_prior_sd,
+        )
+
+        result = optimize_advi_mean_field(
+            theta_shape_dict,
+            cur_prior,
+            cur_lik,
+            n_draws=n_draws,
+            verbose=verbose,
+            M=M,
+            seed=seed,
+        )
+
+        # Species-major, i.e. [n_species x n_draws x ...].
+        draws["env_slopes"].append(
+            np.transpose(result["draws"]["env_slopes"], (2, 0, 1))
+        )
+        draws["env_intercepts"].append(np.asarray(result["draws"]["env_intercepts"]).T)
+        successful.extend([bool(result["opt_result"].success)] * len(cur_batch))
+
+    return {
+        "draws": {x: np.concatenate(y) for x, y in draws.items()},
+        "design_info": design_info,
+        "species_names": list(pd.DataFrame(y_checklist).columns),
+        "successful": np.array(successful),
+    }
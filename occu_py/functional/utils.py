@@ -1,10 +1,35 @@
+import numpy as np
 import jax.numpy as jnp
-from jax import jit
+from jax import jit, vmap
 from jax.nn import sigmoid, log_sigmoid
-from occu_py.utils import evaluate_on_chunks
+from functools import partial
+from occu_py.utils import evaluate_on_chunks, split_every
+from occu_py.compact_design import as_dense
+from occu_py.likelihoods import compute_conditional_occupancy
 
+# Rows are predicted in chunks such that the intermediate
+# [n_draws x n_rows x n_species] arrays have at most this many elements.
+MAX_CHUNK_ELEMENTS = 2**22
 
-def predict_env_from_samples(env_covs, env_slope_samples, env_intercept_samples):
+
+def choose_chunk_size(slope_samples):
+
+    n_draws, _, n_species = slope_samples.shape
+
+    return max(1, MAX_CHUNK_ELEMENTS // (n_draws * n_species))
+
+
+def average_over_draws(draw_probs, draw_weights=None):
+
+    if draw_weights is None:
+        return jnp.mean(draw_probs, axis=0)
+
+    return jnp.sum(draw_probs * draw_weights[:, None, None], axis=0)
+
+
+def predict_env_from_samples(
+    env_covs, env_slope_samples, env_intercept_samples, draw_weights=None
+):
     @jit
     def predict(X):
 
@@ -12,17 +37,28 @@ def predict_env_from_samples(env_covs, env_slope_samples, env_intercept_samples)
             "nc,dcs->dns", X, env_slope_samples
         ) + env_intercept_samples.reshape(env_slope_samples.shape[0], 1, -1)
 
-        prob = jnp.mean(sigmoid(logits), axis=0)
+        prob = average_over_draws(sigmoid(logits), draw_weights)
 
         return prob
 
-    prob = evaluate_on_chunks(predict, 2, env_covs, is_df=False)
+    # Compact env designs are densified one chunk at a time.
+    prob = evaluate_on_chunks(
+        lambda X: predict(as_dense(X)),
+        choose_chunk_size(env_slope_samples),
+        env_covs,
+        is_df=False,
+    )
 
     return prob
 
 
 def predict_obs_from_samples(
-    env_covs, env_slope_samples, env_intercept_samples, obs_covs, obs_slope_samples
+    env_covs,
+    env_slope_samples,
+    env_intercept_samples,
+    obs_covs,
+    obs_slope_samples,
+    draw_weights=None,
 ):
     @jit
     def predict(X_env, X_obs):
@@ -33,10 +69,162 @@ def predict_obs_from_samples(
 
         obs_logits = jnp.einsum("nc,dcs->dns", X_obs, obs_slope_samples)
 
-        prob = jnp.exp(log_sigmoid(env_logits) + log_sigmoid(obs_logits)).mean(axis=0)
+        prob = average_over_draws(
+            jnp.exp(log_sigmoid(env_logits) + log_sigmoid(obs_logits)), draw_weights
+        )
 
         return prob
 
-    result = evaluate_on_chunks(predict, 2, env_covs, obs_covs, is_df=False)
+    # As are compact checklist designs.
+    result = evaluate_on_chunks(
+        lambda X_env, X_obs: predict(as_dense(X_env), as_dense(X_obs)),
+        choose_chunk_size(env_slope_samples),
+        env_covs,
+        obs_covs,
+        is_df=False,
+    )
+
+    return result
+
+
+def pad_batch(indices, batch_size):
+    # Pads a batch of indices to batch_size by repeating its last entry, so
+    # that the final batch has the same shape as the others and does not
+    # need recompiling.
+
+    indices = list(indices)
+
+    return np.array(indices + [indices[-1]] * (batch_size - len(indices)))
+
+
+def predict_conditional_occupancy_from_samples(
+    env_covs,
+    env_slope_samples,
+    env_intercept_samples,
+    obs_covs,
+    obs_slope_samples,
+    y_checklist,
+    checklist_cell_ids,
+    draw_weights=None,
+    species_batch_size=32,
+    draw_batch_size=None,
+):
+    """Computes the probability of presence in each cell given its checklists,
+    averaged over posterior draws.
+
+    For each draw, this is the posterior probability of presence given the
+    detections and non-detections on the cell's checklists (see
+    likelihoods.compute_conditional_occupancy): one if the species was
+    detected, and otherwise lower than its marginal probability of presence
+    the more checklists failed to detect it. Cells without checklists get the
+    marginal probability.
+
+    The draws and species are processed in batches, each in a single pass
+    vmapped over both, and the weighted sum over draws is accumulated batch by
+    batch, so that only the logits of one batch are held in memory.
+
+    Args:
+        env_covs: The env design of the cells [n_cells x n_env_covs].
+        env_slope_samples: The env slopes [n_draws x n_env_covs x n_species].
+        env_intercept_samples: The env intercepts [n_draws x n_species].
+        obs_covs: The checklist design [n_checklists x n_obs_covs].
+        obs_slope_samples: The obs coefs [n_draws x n_obs_covs x n_species].
+        y_checklist: The detections [n_checklists x n_species].
+        checklist_cell_ids: The cell of each checklist, indexing env_covs.
+        draw_weights: The weight of each draw. Draws are weighted equally if
+            None.
+        species_batch_size: The number of species processed at once.
+        draw_batch_size: The number of draws processed at once. By default,
+            this is chosen such that the checklist logits of a batch have at
+            most MAX_CHUNK_ELEMENTS elements.
+
+    Returns:
+        The conditional probabilities of presence [n_cells x n_species].
+    """
+
+    n_draws, _, n_species = env_slope_samples.shape
+    n_cells = env_covs.shape[0]
+    n_checklists = obs_covs.shape[0]
+
+    if draw_weights is None:
+        draw_weights = np.full(n_draws, 1.0 / n_draws)
+
+    species_batch_size = min(species_batch_size, n_species)
+
+    if draw_batch_size is None:
+        draw_batch_size = max(
+            1, MAX_CHUNK_ELEMENTS // (n_checklists * species_batch_size)
+        )
+
+    draw_batch_size = min(draw_batch_size, n_draws)
+
+    # Over species, then over draws, with the checklists' missingness shared
+    # by the draws.
+    occupancy_fun = vmap(
+        vmap(
+            partial(compute_conditional_occupancy, n_cells=n_cells),
+            in_axes=(1, 1, 1, None),
+        ),
+        in_axes=(0, 0, None, None),
+    )
+
+    @jit
+    def batch_occupancy(
+        env_covs,
+        obs_covs,
+        env_slopes,
+        env_intercepts,
+        obs_slopes,
+        m,
+        cell_ids,
+        weights,
+    ):
+        # Returns the weighted sum over the batch's draws [n_cells x species].
+
+        env_logits = jnp.einsum("nc,dcs->dns", env_covs, env_slopes) + jnp.expand_dims(
+            env_intercepts, 1
+        )
+        obs_logits = jnp.einsum("nc,dcs->dns", obs_covs, obs_slopes)
+
+        # [draws x species x cells]
+        occupancy = occupancy_fun(env_logits, obs_logits, m, cell_ids)
+
+        return jnp.einsum("dsn,d->ns", occupancy, weights)
+
+    # The data are arguments rather than constants of the compiled function.
+    env_covs = jnp.asarray(as_dense(env_covs))
+    obs_covs = jnp.asarray(as_dense(obs_covs))
+    cell_ids = jnp.asarray(checklist_cell_ids)
+    m = 1 - np.asarray(y_checklist)
+
+    result = np.zeros((n_cells, n_species))
+
+    for cur_species in split_every(species_batch_size, np.arange(n_species)):
+
+        n_batch_species = len(cur_species)
+        cur_species = pad_batch(cur_species, species_batch_size)
+        cur_m = jnp.asarray(m[:, cur_species])
+
+        for cur_draws in split_every(draw_batch_size, np.arange(n_draws)):
+
+            # Padded draws get zero weight.
+            cur_weights = np.zeros(draw_batch_size)
+            cur_weights[: len(cur_draws)] = draw_weights[cur_draws]
+            cur_draws = pad_batch(cur_draws, draw_batch_size)
+
+            batch_sum = batch_occupancy(
+                env_covs,
+                obs_covs,
+                np.asarray(env_slope_samples)[cur_draws][..., cur_species],
+                np.asarray(env_intercept_samples)[cur_draws][..., cur_species],
+                np.asarray(obs_slope_samples)[cur_draws][..., cur_species],
+                cur_m,
+                cell_ids,
+                cur_weights,
+            )
+
+            result[:, cur_species[:n_batch_species]] += np.asarray(batch_sum)[
+                :, :n_batch_species
+            ]
 
     return result
@@ -1,18 +1,24 @@
 import jax.numpy as jnp
 from jax.scipy.special import logsumexp
-from jax.nn import log_sigmoid
+from jax.nn import log_sigmoid, sigmoid
 
 
-def compute_checklist_likelihood(pres_abs_logit, obs_logit, m, cell_nums, n_cells):
-    # This computes the log probability of observing the data m (the missingness
-    # indicator, 1 if no observation, 0 if observation) given the probability of
-    # presence in the cell on the logit scale and the probability of observing the
-    # species if present on the logit scale.
-    # The pres_abs_logit is on the grid cell scale. Since there can be
-    # multiple observations per grid cell, the "cell_nums" array should match
-    # them up. Specifically, entry cell_nums[i] should contain the index j so
-    # that it belongs to the grid cell whose presence probability is in
-    # pres_abs_logit[j]. n_cells is the total number of cells.
+def compute_cell_likelihood_terms(
+    pres_abs_logit, obs_logit, m, cell_nums, n_cells, accumulation_dtype=None
+):
+    # Computes the per-cell terms making up the checklist likelihood. See
+    # compute_checklist_likelihood for a description of the arguments.
+    # Returns:
+    # lik_term_1: the log probability that the species is absent from the cell.
+    # lik_term_2: the log probability that the species is present and that the
+    # checklists in the cell turned out as they did.
+    # obs_per_cell: the number of checklists in the cell reporting the species.
+
+    if accumulation_dtype is not None:
+        # Evaluate the terms, and sum them over the checklists of each cell, in
+        # higher precision than the logits may have been computed in.
+        pres_abs_logit = pres_abs_logit.astype(accumulation_dtype)
+        obs_logit = obs_logit.astype(accumulation_dtype)
 
     log_prob_pres = log_sigmoid(pres_abs_logit)
     log_prob_abs = log_sigmoid(-pres_abs_logit)
@@ -26,12 +32,63 @@ def compute_checklist_likelihood(pres_abs_logit, obs_logit, m, cell_nums, n_cell
     lik_term_1 = log_prob_abs
     lik_term_2 = log_prob_pres + summed_liks
 
-    lik_if_at_least_one_obs = lik_term_2
-    lik_if_all_missing = logsumexp(jnp.stack([lik_term_1, lik_term_2], axis=1), axis=1)
-
     not_miss = 1 - m
 
     obs_per_cell = jnp.bincount(cell_nums, weights=not_miss, length=n_cells)
+
+    return lik_term_1, lik_term_2, obs_per_cell
+
+
+def combine_cell_likelihood_terms(lik_term_1, lik_term_2, obs_per_cell):
+
+    lik_if_at_least_one_obs = lik_term_2
+    lik_if_all_missing = logsumexp(jnp.stack([lik_term_1, lik_term_2], axis=1), axis=1)
+
     log_lik = jnp.where(obs_per_cell == 0, lik_if_all_missing, lik_if_at_least_one_obs)
 
     return log_lik
+
+
+def conditional_occupancy_from_terms(lik_term_1, lik_term_2, obs_per_cell):
+
+    # If the species was never reported, this is the posterior probability of
+    # presence given the observed non-detections; otherwise it is present.
+    prob_if_all_missing = sigmoid(lik_term_2 - lik_term_1)
+
+    return jnp.where(obs_per_cell == 0, prob_if_all_missing, 1.0)
+
+
+def compute_checklist_likelihood(
+    pres_abs_logit, obs_logit, m, cell_nums, n_cells, accumulation_dtype=None
+):
+    # This computes the log probability of observing the data m (the missingness
+    # indicator, 1 if no observation, 0 if observation) given the probability of
+    # presence in the cell on the logit scale and the probability of observing the
+    # species if present on the logit scale.
+    # The pres_abs_logit is on the grid cell scale. Since there can be
+    # multiple observations per grid cell, the "cell_nums" array should match
+    # them up. Specifically, entry cell_nums[i] should contain the index j so
+    # that it belongs to the grid cell whose presence probability is in
+    # pres_abs_logit[j]. n_cells is the total number of cells. If
+    # accumulation_dtype is given, the terms and their per-cell sums are
+    # computed in this dtype (e.g. float64 for float32 logits).
+
+    terms = compute_cell_likelihood_terms(
+        pres_abs_logit, obs_logit, m, cell_nums, n_cells, accumulation_dtype
+    )
+
+    return combine_cell_likelihood_terms(*terms)
+
+
+def compute_conditional_occupancy(
+    pres_abs_logit, obs_logit, m, cell_nums, n_cells, accumulation_dtype=None
+):
+    # This computes the probability that the species is present in each cell
+    # given the checklists observed there. Arguments are as for
+    # compute_checklist_likelihood.
+
+    terms = compute_cell_likelihood_terms(
+        pres_abs_logit, obs_logit, m, cell_nums, n_cells, accumulation_dtype
+    )
+
+    return conditional_occupancy_from_terms(*terms)
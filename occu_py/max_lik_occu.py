@@ -1,30 +1,90 @@
 from .checklist_model import ChecklistModel
 import numpy as np
 import pandas as pd
-import jax.numpy as jnp
-from .likelihoods import compute_checklist_likelihood
-from functools import partial
-from tqdm import tqdm
-from sklearn.preprocessing import StandardScaler
-from jax.nn import log_sigmoid, sigmoid
 import os
+import warnings
 from os.path import join
-from typing import Callable
-import pickle
-from .functional.max_lik_occu_model import fit, predict_env_logit, predict_obs_logit
-from ml_tools.patsy import create_formula, save_design_info, restore_design_info
+from .functional.prediction import (
+    draw_from_covariances,
+    stack_coefficients,
+    log_sigmoid_in_place,
+    predict_log_marginal_probabilities,
+)
+from .design import save_design_info_json, load_design_info
 from glob import glob
-import jax
+from .array_store import save_array_store, load_array_store
+from .compact_design import build_compact_design, design_dot, SPARSE_THRESHOLD
+from .precision import precision_scope
+
+MODEL_FILE = "max_lik_occu_model.bin"
+
+# A warning is raised when predicting quantiles for species with more than this
+# fraction of bootstrap replicates which did not converge.
+MAX_FAILED_DRAW_FRACTION = 0.1
 
 
 class MaxLikOccu(ChecklistModel):
-    def __init__(self, env_formula, det_formula, verbose=False):
+    def __init__(
+        self,
+        env_formula,
+        det_formula,
+        verbose=False,
+        solver="trust-ncg",
+        species_batch_size=32,
+        n_bootstrap=0,
+        bootstrap_seed=2,
+        compute_covariance=False,
+        n_coef_draws=1000,
+        coef_draw_seed=2,
+        precision=None,
+    ):
+        """Single-species occupancy detection models fit by maximum likelihood.
+
+        Args:
+            env_formula: Patsy formula for the environmental covariates.
+            det_formula: Patsy formula for the detection covariates.
+            verbose: If True, shows progress while fitting.
+            solver: Either "trust-ncg", which fits each species in turn using
+                scipy, or "newton", which fits batches of species at once using
+                a jitted damped Newton solver that runs entirely in JAX.
+            species_batch_size: Number of species fit together when using the
+                "newton" solver.
+            n_bootstrap: If greater than zero, this many Poisson bootstrap
+                replicates are fitted after the point estimates, which allows
+                predict_marginal_probability_quantiles to be used.
+            bootstrap_seed: Random seed for the bootstrap weights.
+            compute_covariance: If True, the covariance matrix of each
+                species' coefficients is estimated from the observed
+                information, and n_coef_draws draws from the resulting normal
+                approximation are used by
+                predict_marginal_probability_quantiles. This is much cheaper
+                than the bootstrap. It cannot be combined with n_bootstrap.
+            n_coef_draws: The number of coefficient draws per species when
+                compute_covariance is True.
+            coef_draw_seed: Random seed for these draws.
+            precision: The numerical precision of the fit, either "single"
+                (float32 designs and products, with float64 sums) or
+                "double"; see occu_py.precision. If None, JAX's global setting
+                is used.
+        """
+
+        assert solver in ["trust-ncg", "newton"]
+        assert precision in [None, "single", "double"]
+        assert not (n_bootstrap > 0 and compute_covariance)
 
         self.fit_results = None
         self.species_names = None
         self.env_formula = env_formula
         self.det_formula = det_formula
         self.verbose = verbose
+        self.solver = solver
+        self.species_batch_size = species_batch_size
+        self.n_bootstrap = n_bootstrap
+        self.bootstrap_seed = bootstrap_seed
+        self.compute_covariance = compute_covariance
+        self.n_coef_draws = n_coef_draws
+        self.coef_draw_seed = coef_draw_seed
+        self.precision = precision
 
     def fit(
         self,
@@ -33,12 +93,115 @@ class MaxLikOccu(ChecklistModel):
         y_checklist: pd.DataFrame,
         checklist_cell_ids: np.ndarray,
     ) -> None:
+        from .functional.max_lik_occu_model import (
+            fit_newton,
+            fit_bootstrap,
+            compute_covariances,
+        )
 
-        self.X_env = X_env
-        self.X_checklist = X_checklist
+        with precision_scope(self.precision):
+
+            self.fit_results = list()
+            self.species_names = y_checklist.columns
+
+            if self.solver == "newton":
+
+                self.fit_results = fit_newton(
+                    X_env,
+                    X_checklist,
+                    y_checklist.values,
+                    checklist_cell_ids,
+                    self.env_formula,
+                    self.det_formula,
+                    species_batch_size=self.species_batch_size,
+                    verbose=self.verbose,
+                    precision=self.precision,
+                )
+
+            else:
+
+                self.fit_species_by_species(
+                    X_env, X_checklist, y_checklist, checklist_cell_ids
+                )
+
+            self.env_design_info = self.fit_results[0]["env_design_info"]
+            self.obs_design_info = self.fit_results[0]["obs_design_info"]
+
+            self.stack_coefficients()
+
+            if self.n_bootstrap > 0:
+
+                bootstrap_draws = fit_bootstrap(
+                    X_env,
+                    X_checklist,
+                    y_checklist.values,
+                    checklist_cell_ids,
+                    self.env_formula,
+                    self.det_formula,
+                    np.stack([x["env_coefs"].values for x in self.fit_results]),
+                    np.stack([x["obs_coefs"].values for x in self.fit_results]),
+                    n_bootstrap=self.n_bootstrap,
+                    seed=self.bootstrap_seed,
+                    verbose=self.verbose,
+                    precision=self.precision,
+                )
+
+                successful = bootstrap_draws["successful"]
+
+                for i, cur_fit_result in enumerate(self.fit_results):
+                    cur_fit_result["env_coef_draws"] = bootstrap_draws["env_coefs"][i]
+                    cur_fit_result["obs_coef_draws"] = bootstrap_draws["obs_coefs"][i]
+                    cur_fit_result["draws_successful"] = successful[i]
+
+            if self.compute_covariance:
+
+                covariances = compute_covariances(
+                    X_env,
+                    X_checklist,
+                    y_checklist.values,
+                    checklist_cell_ids,
+                    self.env_formula,
+                    self.det_formula,
+                    np.stack([x["env_coefs"].values for x in self.fit_results]),
+                    np.stack([x["obs_coefs"].values for x in self.fit_results]),
+                    species_batch_size=self.species_batch_size,
+                    precision=self.precision,
+                )
+
+                for cur_fit_result, cur_cov in zip(self.fit_results, covariances):
+                    cur_fit_result["coef_cov"] = cur_cov
+                    cur_fit_result["n_coef_draws"] = self.n_coef_draws
+                    cur_fit_result["coef_draw_seed"] = self.coef_draw_seed
+
+                self.add_draws_from_covariances()
+
+    def add_draws_from_covariances(self):
+        # Draws coefficients from the normal approximation given by each
+        # species' covariance matrix. These are not saved, but redrawn (with the
+        # same seed) when the model is restored.
+
+        n_env_coefs = len(self.fit_results[0]["env_coefs"])
+
+        means = np.stack(
+            [np.concatenate([x["env_coefs"], x["obs_coefs"]]) for x in self.fit_results]
+        )
 
-        self.fit_results = list()
-        self.species_names = y_checklist.columns
+        draws = draw_from_covariances(
+            means,
+            np.stack([x["coef_cov"] for x in self.fit_results]),
+            int(self.fit_results[0]["n_coef_draws"]),
+            int(self.fit_results[0]["coef_draw_seed"]),
+        )
+
+        for cur_fit_result, cur_draws in zip(self.fit_results, draws):
+            cur_fit_result["env_coef_draws"] = cur_draws[:, :n_env_coefs]
+            cur_fit_result["obs_coef_draws"] = cur_draws[:, n_env_coefs:]
+
+    def fit_species_by_species(
+        self, X_env, X_checklist, y_checklist, checklist_cell_ids
+    ):
+        from tqdm import tqdm
+        from .functional.max_lik_occu_model import fit
 
         iterator = tqdm(self.species_names) if self.verbose else self.species_names
 
@@ -54,6 +217,7 @@ class MaxLikOccu(ChecklistModel):
                 self.env_formula,
                 self.det_formula,
                 scale_env_data=False,
+                precision=self.precision,
             )
 
             # Make sure JAX clears its memory:
@@ -69,88 +233,296 @@ class MaxLikOccu(ChecklistModel):
 
             self.fit_results.append(fit_result)
 
-        self.env_design_info = self.fit_results[0]["env_design_info"]
-        self.obs_design_info = self.fit_results[0]["obs_design_info"]
+    def stack_coefficients(self):
+        # Stores the coefficients of all species as matrices [n_coefs x
+        # n_species] for prediction.
 
-    def predict_marginal_probabilities_direct(self, X: pd.DataFrame) -> np.ndarray:
+        self.env_coef_matrix = stack_coefficients(self.fit_results, "env_coefs")
+        self.obs_coef_matrix = stack_coefficients(self.fit_results, "obs_coefs")
 
-        predictions = list()
+    def predict_marginal_probabilities_direct(
+        self, X: pd.DataFrame, chunk_size=10000, dtype=np.float32
+    ) -> np.ndarray:
+        """Predicts the probability of presence of each species.
 
-        for cur_species_name, cur_fit_result in zip(
-            self.species_names, self.fit_results
-        ):
+        Args:
+            X: The environmental covariates.
+            chunk_size: The number of rows predicted at once.
+            dtype: The floating point type of the computation.
 
-            cur_prediction = predict_env_logit(
-                X, self.env_design_info, cur_fit_result["env_coefs"]
-            )
+        Returns:
+            A DataFrame of probabilities [n_rows x n_species].
+        """
 
-            cur_prob_pres = sigmoid(cur_prediction)
-            predictions.append(cur_prob_pres)
+        log_probs = predict_log_marginal_probabilities(
+            X,
+            self.env_design_info,
+            self.env_coef_matrix,
+            chunk_size=chunk_size,
+            dtype=dtype,
+        )
+
+        return pd.DataFrame(
+            np.exp(log_probs, out=log_probs), columns=self.species_names
+        )
 
-        predictions = np.stack(predictions, axis=1)
+    def predict_marginal_probabilities_obs(
+        self, X: pd.DataFrame, X_obs: pd.DataFrame, chunk_size=10000, dtype=np.float32
+    ):
+        """Predicts the probability of observing each species on a checklist.
 
-        return pd.DataFrame(predictions, columns=self.species_names)
+        Args:
+            X: The environmental covariates of each checklist's cell.
+            X_obs: The checklist covariates.
+            chunk_size: The number of rows predicted at once.
+            dtype: The floating point type of the computation.
 
-    def predict_marginal_probabilities_obs(self, X: pd.DataFrame, X_obs: pd.DataFrame):
+        Returns:
+            A DataFrame of probabilities [n_rows x n_species].
+        """
 
-        predictions = list()
+        log_probs = predict_log_marginal_probabilities(
+            X,
+            self.env_design_info,
+            self.env_coef_matrix,
+            X_obs=X_obs,
+            obs_design_info=self.obs_design_info,
+            obs_coef_matrix=self.obs_coef_matrix,
+            chunk_size=chunk_size,
+            dtype=dtype,
+        )
 
-        for cur_species_name, cur_fit_result in zip(
-            self.species_names, self.fit_results
-        ):
+        return pd.DataFrame(
+            np.exp(log_probs, out=log_probs), columns=self.species_names
+        )
 
-            cur_env_prediction = predict_env_logit(
-                X, self.env_design_info, cur_fit_result["env_coefs"]
+    def predict_conditional_occupancy(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ) -> pd.DataFrame:
+        """Predicts the probability of presence in each cell given the
+        checklists observed there, at the maximum likelihood estimates.
+
+        See ChecklistModel.predict_conditional_occupancy for the arguments.
+        """
+        from .functional.utils import predict_conditional_occupancy_from_samples
+
+        env_design = build_compact_design(
+            self.env_design_info, X_env, sparse_threshold=SPARSE_THRESHOLD
+        )
+        obs_design = build_compact_design(self.obs_design_info, X_checklist)
+
+        # The estimates are a single draw. The env design includes the
+        # intercept column, so the intercepts are zero.
+        occupancy = predict_conditional_occupancy_from_samples(
+            env_design,
+            self.env_coef_matrix[None],
+            np.zeros((1, len(self.species_names))),
+            obs_design,
+            self.obs_coef_matrix[None],
+            y_checklist[self.species_names],
+            checklist_cell_ids,
+            species_batch_size=self.species_batch_size,
+        )
+
+        return pd.DataFrame(occupancy, index=X_env.index, columns=self.species_names)
+
+    def predict_marginal_probability_quantiles(
+        self, X: pd.DataFrame, X_obs=None, quantiles=(0.025, 0.5, 0.975)
+    ):
+        """Predicts quantiles of the probabilities using the coefficient draws.
+
+        Args:
+            X: The environmental covariates.
+            X_obs: If given, the quantiles are those of the probability of
+                observation (as in predict_marginal_probabilities_obs) rather
+                than that of presence.
+            quantiles: The quantiles to compute.
+
+        Returns:
+            A dictionary mapping each quantile to a DataFrame of predictions.
+            Bootstrap replicates which did not converge are left out; the
+            quantiles of species without any converged replicate are NaN.
+        """
+
+        if "env_coef_draws" not in self.fit_results[0]:
+            raise ValueError(
+                "Quantiles need coefficient draws. Please fit with n_bootstrap > 0 "
+                "or compute_covariance=True."
             )
 
-            cur_obs_prediction = predict_obs_logit(
-                X_obs, self.obs_design_info, cur_fit_result["obs_coefs"]
+        env_design = build_compact_design(
+            self.env_design_info, X, sparse_threshold=SPARSE_THRESHOLD
+        )
+
+        if X_obs is not None:
+            obs_design = build_compact_design(self.obs_design_info, X_obs)
+
+        predictions = {x: list() for x in quantiles}
+        poorly_converged = list()
+
+        for cur_species, cur_fit_result in zip(self.species_names, self.fit_results):
+
+            # Only bootstrap draws have convergence flags.
+            cur_successful = np.asarray(
+                cur_fit_result.get(
+                    "draws_successful",
+                    np.ones(cur_fit_result["env_coef_draws"].shape[0], dtype=bool),
+                ),
+                dtype=bool,
             )
 
-            cur_log_prob_obs = log_sigmoid(cur_env_prediction) + log_sigmoid(
-                cur_obs_prediction
+            if np.mean(~cur_successful) > MAX_FAILED_DRAW_FRACTION:
+                poorly_converged.append(cur_species)
+
+            if not np.any(cur_successful):
+                cur_quantiles = np.full((len(quantiles), X.shape[0]), np.nan)
+
+                for cur_quantile, cur_prediction in zip(quantiles, cur_quantiles):
+                    predictions[cur_quantile].append(cur_prediction)
+
+                continue
+
+            # These are [n_rows x n_draws]
+            cur_log_prob = log_sigmoid_in_place(
+                design_dot(
+                    env_design, cur_fit_result["env_coef_draws"][cur_successful].T
+                )
             )
-            predictions.append(np.exp(cur_log_prob_obs))
 
-        predictions = np.stack(predictions, axis=1)
+            if X_obs is not None:
+                cur_log_prob += log_sigmoid_in_place(
+                    design_dot(
+                        obs_design, cur_fit_result["obs_coef_draws"][cur_successful].T
+                    )
+                )
+
+            cur_quantiles = np.quantile(np.exp(cur_log_prob), quantiles, axis=1)
+
+            for cur_quantile, cur_prediction in zip(quantiles, cur_quantiles):
+                predictions[cur_quantile].append(cur_prediction)
+
+        if len(poorly_converged) > 0:
+            warnings.warn(
+                f"More than {MAX_FAILED_DRAW_FRACTION:.0%} of the bootstrap "
+                f"replicates did not converge for {len(poorly_converged)} "
+                f"species ({', '.join(str(x) for x in poorly_converged[:10])}"
+                f"{', ...' if len(poorly_converged) > 10 else ''}); their "
+                "quantiles only use the replicates which did."
+            )
 
-        return pd.DataFrame(predictions, columns=self.species_names)
+        return {
+            x: pd.DataFrame(np.stack(y, axis=1), columns=self.species_names)
+            for x, y in predictions.items()
+        }
 
     def save_model(self, target_folder: str) -> None:
 
         os.makedirs(target_folder, exist_ok=True)
 
-        # Save the results files
-        for i, (cur_results, cur_species) in enumerate(
-            zip(self.fit_results, self.species_names)
-        ):
-            np.savez(
-                os.path.join(target_folder, f"results_file_{i}"),
-                species_name=cur_species,
-                env_coefs=cur_results["env_coefs"],
-                obs_coefs=cur_results["obs_coefs"],
-                successful=cur_results["optimisation_successful"],
-                env_formula=self.env_formula,
-                det_formula=self.det_formula,
-                final_grad_norm=np.linalg.norm(cur_results["opt_result"].jac),
+        # Restored models no longer have the optimisation results.
+        grad_norms = [
+            (
+                x["final_grad_norm"]
+                if "final_grad_norm" in x
+                else np.linalg.norm(x["opt_result"].jac)
+            )
+            for x in self.fit_results
+        ]
+
+        arrays = {
+            "species_names": np.array(self.species_names, dtype=str),
+            "env_coefs": self.env_coef_matrix,
+            "obs_coefs": self.obs_coef_matrix,
+            "successful": np.array(
+                [bool(x["optimisation_successful"]) for x in self.fit_results]
+            ),
+            "final_grad_norm": np.array(grad_norms, dtype=float),
+        }
+
+        metadata = {
+            "env_formula": str(self.env_formula),
+            "det_formula": str(self.det_formula),
+            "env_coef_names": list(self.env_design_info.column_names),
+            "obs_coef_names": list(self.obs_design_info.column_names),
+        }
+
+        if "coef_cov" in self.fit_results[0]:
+
+            # Only the upper triangle of the covariance matrices is stored; the
+            # draws are recreated from it on restoring.
+            upper = np.triu_indices(self.fit_results[0]["coef_cov"].shape[0])
+            arrays["coef_cov_triu"] = np.stack(
+                [x["coef_cov"][upper] for x in self.fit_results]
             )
+            metadata["n_coef_draws"] = int(self.fit_results[0]["n_coef_draws"])
+            metadata["coef_draw_seed"] = int(self.fit_results[0]["coef_draw_seed"])
+
+        elif "env_coef_draws" in self.fit_results[0]:
+
+            for cur_key in ["env_coef_draws", "obs_coef_draws", "draws_successful"]:
+                arrays[cur_key] = np.stack([x[cur_key] for x in self.fit_results])
+
+        save_array_store(join(target_folder, MODEL_FILE), arrays, metadata)
 
         # Save the design infos
-        save_design_info(
-            self.X_env,
-            self.env_formula,
-            self.env_design_info,
-            join(target_folder, "design_info_env.pkl"),
+        save_design_info_json(
+            self.env_design_info, join(target_folder, "design_info_env.json")
         )
 
-        save_design_info(
-            self.X_checklist,
-            self.det_formula,
-            self.obs_design_info,
-            join(target_folder, "design_info_obs.pkl"),
+        save_design_info_json(
+            self.obs_design_info, join(target_folder, "design_info_obs.json")
         )
 
-    def restore_model(self, load_folder: str) -> None:
+    def load_fit_results(self, load_folder: str):
+        # Loads the fit results from the single-file store written by
+        # save_model. The arrays are memory-mapped, and each species' results
+        # are views into them.
+
+        arrays, metadata = load_array_store(join(load_folder, MODEL_FILE))
+
+        self.env_formula = metadata["env_formula"]
+        self.det_formula = metadata["det_formula"]
+
+        per_species_keys = [
+            x
+            for x in [
+                "coef_cov_triu",
+                "env_coef_draws",
+                "obs_coef_draws",
+                "draws_successful",
+            ]
+            if x in arrays
+        ]
+
+        fit_results = list()
+
+        for i, cur_species in enumerate(arrays["species_names"]):
+
+            cur_results = {
+                "species_name": cur_species,
+                "env_coefs": arrays["env_coefs"][:, i],
+                "obs_coefs": arrays["obs_coefs"][:, i],
+                "optimisation_successful": arrays["successful"][i],
+                "final_grad_norm": arrays["final_grad_norm"][i],
+            }
+
+            cur_results.update({x: arrays[x][i] for x in per_species_keys})
+
+            if "coef_cov_triu" in arrays:
+                cur_results["n_coef_draws"] = metadata["n_coef_draws"]
+                cur_results["coef_draw_seed"] = metadata["coef_draw_seed"]
+
+            fit_results.append(cur_results)
+
+        return fit_results
+
+    def load_fit_results_per_species(self, load_folder: str):
+        # Loads the fit results from the older format, which stored one npz
+        # file per species.
 
         all_results_files = glob(join(load_folder, "*.npz"))
 
@@ -164,18 +536,40 @@ class MaxLikOccu(ChecklistModel):
 
         sorted_files = sorted(all_results_files, key=find_number)
 
-        loaded = [np.load(x) for x in sorted_files]
+        loaded = [dict(np.load(x)) for x in sorted_files]
 
-        self.env_formula = loaded[0]["env_formula"]
-        self.det_formula = loaded[0]["det_formula"]
+        for cur_results in loaded:
+            cur_results["optimisation_successful"] = cur_results.pop("successful")
 
-        self.env_design_info = restore_design_info(
-            join(load_folder, "design_info_env.pkl")
-        )
+        self.env_formula = str(loaded[0]["env_formula"])
+        self.det_formula = str(loaded[0]["det_formula"])
 
-        self.obs_design_info = restore_design_info(
-            join(load_folder, "design_info_obs.pkl")
-        )
+        return loaded
+
+    def restore_model(self, load_folder: str) -> None:
+
+        if os.path.isfile(join(load_folder, MODEL_FILE)):
+            loaded = self.load_fit_results(load_folder)
+        else:
+            loaded = self.load_fit_results_per_species(load_folder)
+
+        self.env_design_info = load_design_info(load_folder, "design_info_env")
+
+        self.obs_design_info = load_design_info(load_folder, "design_info_obs")
 
         self.fit_results = loaded
         self.species_names = [str(x["species_name"]) for x in loaded]
+
+        self.stack_coefficients()
+
+        if "coef_cov_triu" in loaded[0]:
+
+            n_coefs = len(loaded[0]["env_coefs"]) + len(loaded[0]["obs_coefs"])
+            upper = np.triu_indices(n_coefs)
+
+            for cur_results in loaded:
+                cov = np.zeros((n_coefs, n_coefs))
+                cov[upper] = cur_results["coef_cov_triu"]
+                cur_results["coef_cov"] = np.triu(cov, 1).T + cov
+
+            self.add_draws_from_covariances()
@@ -1,28 +1,58 @@
 from .checklist_model import ChecklistModel
 import numpy as np
-from typing import Callable
 import pandas as pd
-from tqdm import tqdm
-from .functional.hierarchical_checklist_model import fit
-from .functional.hierarchical_checklist_model_mcmc import predict_env, predict_obs
-from patsy import dmatrix
-from jax_advi.advi import get_pickleable_subset
-from ml_tools.utils import save_pickle_safely, load_pickle_safely
+import os
 from os import makedirs
 from os.path import join
-from sklearn.preprocessing import StandardScaler
-from ml_tools.patsy import save_design_info, restore_design_info
-import arviz as az
+from .design import save_design_info_json, load_design_info
+from .precision import precision_scope
+from .draw_store import (
+    DrawStore,
+    save_draw_store,
+    save_representative_draws,
+    load_representative_draws,
+    fetch_draws,
+    save_model_info,
+    load_model_info,
+    DRAW_STORE_FILE,
+    REPRESENTATIVE_DRAWS_FILE,
+    MODEL_INFO_FILE,
+)
 
 
 class MultiSpeciesOccuADVI(ChecklistModel):
-    def __init__(self, env_formula, obs_formula, M=20, n_draws=1000, verbose_fit=True):
+    def __init__(
+        self,
+        env_formula,
+        obs_formula,
+        M=20,
+        n_draws=1000,
+        verbose_fit=True,
+        precision=None,
+    ):
+        """Multi-species occupancy detection model fit by mean-field ADVI.
+
+        Args:
+            env_formula: Patsy formula for the environmental covariates.
+            obs_formula: Patsy formula for the detection covariates.
+            M: Number of draws used to estimate the ADVI objective.
+            n_draws: Number of draws to take from the approximation.
+            verbose_fit: Whether to show the optimisation's progress.
+            precision: The numerical precision of the fit, either "single"
+                (float32 designs, products and draws, with float64 sums) or
+                "double"; see occu_py.precision. If None, JAX's global setting
+                is used.
+        """
+
+        assert precision in [None, "single", "double"]
 
         self.M = M
         self.n_draws = n_draws
         self.verbose_fit = verbose_fit
         self.env_formula = env_formula
         self.obs_formula = obs_formula
+        self.representative_draws = None
+        self.precision = precision
 
     def fit(
         self,
@@ -31,104 +61,209 @@ class MultiSpeciesOccuADVI(ChecklistModel):
         y_checklist: pd.DataFrame,
         checklist_cell_ids: np.ndarray,
     ):
+        from .functional.hierarchical_checklist_model import fit
+
+        with precision_scope(self.precision):
+            self.samples, self.advi_results, self.design_info = fit(
+                X_env,
+                X_checklist,
+                y_checklist,
+                checklist_cell_ids,
+                self.env_formula,
+                self.obs_formula,
+                scale_env=False,
+                draws=self.n_draws,
+                M=self.M,
+                verbose=self.verbose_fit,
+                precision=self.precision,
+            )
+
+        self.representative_draws = None
+
+    def predict_marginal_probabilities_direct(
+        self, X: pd.DataFrame, species=None, n_draws=None
+    ) -> pd.DataFrame:
+        from .functional.hierarchical_checklist_model_mcmc import predict_env
+
+        return predict_env(
+            X,
+            self.samples,
+            self.design_info,
+            species=species,
+            n_draws=n_draws,
+            representative_draws=self.representative_draws,
+        )
+
+    def predict_marginal_probabilities_obs(
+        self, X: pd.DataFrame, X_obs: pd.DataFrame, species=None, n_draws=None
+    ) -> pd.DataFrame:
+        from .functional.hierarchical_checklist_model_mcmc import predict_obs
+
+        return predict_obs(
+            X,
+            X_obs,
+            self.samples,
+            self.design_info,
+            species=species,
+            n_draws=n_draws,
+            representative_draws=self.representative_draws,
+        )
 
-        # For pickling later, if required
-        self.X_env = X_env
-        self.X_checklist = X_checklist
+    def predict_conditional_occupancy(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+        species=None,
+        n_draws=None,
+    ) -> pd.DataFrame:
+        from .functional.hierarchical_checklist_model_mcmc import (
+            predict_conditional_occupancy,
+        )
 
-        self.samples, self.advi_results, self.design_info = fit(
+        return predict_conditional_occupancy(
             X_env,
             X_checklist,
             y_checklist,
             checklist_cell_ids,
-            self.env_formula,
-            self.obs_formula,
-            scale_env=False,
-            draws=self.n_draws,
-            M=self.M,
-            verbose=self.verbose_fit,
+            self.samples,
+            self.design_info,
+            species=species,
+            n_draws=n_draws,
+            representative_draws=self.representative_draws,
         )
 
-    def predict_marginal_probabilities_direct(self, X: pd.DataFrame) -> pd.DataFrame:
+    def compress_posterior(
+        self, X: pd.DataFrame, X_obs=None, n_representative=50, tolerance=None
+    ) -> dict:
+        """Selects a small weighted set of draws to predict with.
 
-        return predict_env(X, self.samples, self.design_info)
+        Subsequent predictions only use the selected draws, which makes them
+        faster. See compress_posterior in
+        functional.hierarchical_checklist_model_mcmc for the arguments.
 
-    def predict_marginal_probabilities_obs(
-        self, X: pd.DataFrame, X_obs: pd.DataFrame
-    ) -> pd.DataFrame:
+        Returns:
+            The maximum absolute errors of the mean prediction and of its
+            quantiles on the validation set.
+        """
+        from .functional.hierarchical_checklist_model_mcmc import compress_posterior
 
-        return predict_obs(X, X_obs, self.samples, self.design_info)
+        self.representative_draws = compress_posterior(
+            X,
+            self.samples,
+            self.design_info,
+            X_obs=X_obs,
+            n_representative=n_representative,
+            tolerance=tolerance,
+        )
+
+        return self.representative_draws["errors"]
+
+    def save_model(
+        self, target_folder: str, n_saved_draws=None, draw_dtype=np.float32
+    ) -> None:
+        """Saves the model to files in the target folder.
 
-    def save_model(self, target_folder: str) -> None:
+        Args:
+            target_folder: Where to save the model.
+            n_saved_draws: If given, only this many evenly spaced draws are
+                saved, which makes predictions from the restored model faster.
+            draw_dtype: The floating point type of the saved draws; None
+                keeps their current type.
+        """
+        from jax_advi.advi import get_pickleable_subset
+
+        # The indices of the representative draws refer to all draws.
+        assert (
+            self.representative_draws is None or n_saved_draws is None
+        ), "Cannot thin a compressed posterior."
 
         makedirs(target_folder, exist_ok=True)
-        # Keep this for legacy
-        save_pickle_safely(
+        save_model_info(
+            self.design_info,
+            join(target_folder, MODEL_INFO_FILE),
             {
-                "env_coef_names": self.design_info["env"].column_names,
-                "obs_coef_names": self.design_info["obs"].column_names,
-                "env_scaler": None
-                if "env_scaler" not in self.design_info
-                else self.design_info["env_scaler"],
-                "species_names": self.design_info["species_names"],
-                "advi_results": get_pickleable_subset(self.advi_results),
-                "env_formula": self.env_formula,
-                "obs_formula": self.obs_formula,
+                "env_formula": str(self.env_formula),
+                "obs_formula": str(self.obs_formula),
             },
-            join(target_folder, "design_info.pkl"),
+            {"advi_results": get_pickleable_subset(self.advi_results)},
+        )
+        if self.representative_draws is not None:
+            save_representative_draws(
+                self.representative_draws,
+                join(target_folder, REPRESENTATIVE_DRAWS_FILE),
+            )
+
+        save_draw_store(
+            self.samples,
+            self.design_info["species_names"],
+            join(target_folder, DRAW_STORE_FILE),
+            n_draws=n_saved_draws,
+            dtype=draw_dtype,
         )
-        self.samples.to_netcdf(join(target_folder, "draws.netcdf"))
 
         # Save the design infos
-        save_design_info(
-            self.X_env,
-            self.env_formula,
-            self.design_info["env"],
-            join(target_folder, "design_info_env.pkl"),
+        save_design_info_json(
+            self.design_info["env"], join(target_folder, "design_info_env.json")
         )
 
-        save_design_info(
-            self.X_checklist,
-            self.obs_formula,
-            self.design_info["obs"],
-            join(target_folder, "design_info_obs.pkl"),
+        save_design_info_json(
+            self.design_info["obs"], join(target_folder, "design_info_obs.json")
         )
 
     def restore_model(self, restore_folder: str) -> None:
 
-        self.samples = az.from_netcdf(join(restore_folder, "draws.netcdf"))
+        if os.path.isfile(join(restore_folder, DRAW_STORE_FILE)):
+            # The draws are read from disk as they are needed.
+            self.samples = DrawStore(join(restore_folder, DRAW_STORE_FILE))
+        else:
+            # Models saved before the draw store was introduced
+            import arviz as az
 
-        env_design_info = restore_design_info(
-            join(restore_folder, "design_info_env.pkl")
-        )
+            self.samples = az.from_netcdf(join(restore_folder, "draws.netcdf"))
 
-        obs_design_info = restore_design_info(
-            join(restore_folder, "design_info_obs.pkl")
-        )
+        if os.path.isfile(join(restore_folder, REPRESENTATIVE_DRAWS_FILE)):
+            self.representative_draws = load_representative_draws(
+                join(restore_folder, REPRESENTATIVE_DRAWS_FILE)
+            )
+        else:
+            self.representative_draws = None
 
-        other_design_info = load_pickle_safely(join(restore_folder, "design_info.pkl"))
+        env_design_info = load_design_info(restore_folder, "design_info_env")
 
-        self.env_formula = other_design_info["env_formula"]
-        self.obs_formula = other_design_info["obs_formula"]
+        obs_design_info = load_design_info(restore_folder, "design_info_obs")
+
+        model_info = load_model_info(restore_folder)
+
+        self.env_formula = model_info["env_formula"]
+        self.obs_formula = model_info["obs_formula"]
+        self.advi_results = model_info["advi_results"]
 
         self.design_info = {
             "env": env_design_info,
             "obs": obs_design_info,
-            "species_names": other_design_info["species_names"],
+            "species_names": model_info["species_names"],
         }
 
+        # Older models saved a scaler of None if the env covariates were not
+        # scaled.
+        if model_info.get("env_scaler") is not None:
+            self.design_info["env_scaler"] = model_info["env_scaler"]
+
     def get_draw_dfs(self):
+        from .functional.hierarchical_checklist_model_mcmc import (
+            fetch_env_samples,
+            fetch_obs_samples,
+        )
 
-        posterior = self.samples.posterior
+        env_coef_draws, env_intercept_draws = fetch_env_samples(self.samples)
+        obs_coef_draws = fetch_obs_samples(self.samples)
 
         env_intercept_draws = pd.DataFrame(
-            posterior.env_intercepts[0].values,
-            columns=self.design_info["species_names"],
+            env_intercept_draws, columns=self.design_info["species_names"]
         )
 
-        obs_coef_draws = posterior.obs_coefs[0].values
-        env_coef_draws = posterior.env_slopes[0].values
-
         obs_coef_draws_by_species = {
             x: pd.DataFrame(
                 obs_coef_draws[:, :, i], columns=self.design_info["obs"].column_names
@@ -146,8 +281,8 @@ class MultiSpeciesOccuADVI(ChecklistModel):
             for i, x in enumerate(self.design_info["species_names"])
         }
 
-        obs_prior_mean_draws = posterior.obs_coef_prior_means[0].values
-        obs_prior_sds_draws = posterior.obs_coef_prior_sds[0].values
+        obs_prior_mean_draws = fetch_draws(self.samples, "obs_coef_prior_means")
+        obs_prior_sds_draws = fetch_draws(self.samples, "obs_coef_prior_sds")
 
         prior_mean_draws = pd.DataFrame(
             obs_prior_mean_draws[:, :, 0], columns=self.design_info["obs"].column_names
@@ -0,0 +1,242 @@
+from .checklist_model import ChecklistModel
+import numpy as np
+import pandas as pd
+import os
+from os import makedirs
+from os.path import join
+from .design import save_design_info_json, load_design_info
+from .draw_store import (
+    DrawStore,
+    save_draw_store,
+    save_representative_draws,
+    load_representative_draws,
+    save_model_info,
+    load_model_info,
+    DRAW_STORE_FILE,
+    REPRESENTATIVE_DRAWS_FILE,
+    MODEL_INFO_FILE,
+)
+
+
+class MultiSpeciesOccuLaplace(ChecklistModel):
+    def __init__(
+        self, env_formula, obs_formula, n_draws=1000, species_batch_size=32, seed=3
+    ):
+        """Multi-species occupancy detection model fit by a Laplace approximation.
+
+        The posterior is approximated by a Gaussian centred at the MAP of the
+        non-centred hierarchical model, with the Hessian of the negative log
+        posterior as its precision. The Hessian's block structure (species
+        blocks coupled only through the shared obs coef prior parameters) is
+        used to compute and sample from it cheaply. Draws are stored in the
+        same format as for MultiSpeciesOccuADVI.
+
+        Args:
+            env_formula: Patsy formula for the environmental covariates.
+            obs_formula: Patsy formula for the detection covariates.
+            n_draws: Number of draws to take from the approximation.
+            species_batch_size: Number of species whose Hessian blocks are
+                computed at once.
+            seed: Random seed for the draws.
+        """
+
+        self.env_formula = env_formula
+        self.obs_formula = obs_formula
+        self.n_draws = n_draws
+        self.species_batch_size = species_batch_size
+        self.seed = seed
+        self.representative_draws = None
+
+    def fit(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ):
+        from .functional.hierarchical_checklist_model_laplace import fit
+
+        self.samples, self.laplace_results, self.design_info = fit(
+            X_env,
+            X_checklist,
+            y_checklist,
+            checklist_cell_ids,
+            self.env_formula,
+            self.obs_formula,
+            scale_env=False,
+            draws=self.n_draws,
+            seed=self.seed,
+            species_batch_size=self.species_batch_size,
+        )
+
+        self.representative_draws = None
+
+    def predict_marginal_probabilities_direct(
+        self, X: pd.DataFrame, species=None, n_draws=None
+    ) -> pd.DataFrame:
+        from .functional.hierarchical_checklist_model_mcmc import predict_env
+
+        return predict_env(
+            X,
+            self.samples,
+            self.design_info,
+            species=species,
+            n_draws=n_draws,
+            representative_draws=self.representative_draws,
+        )
+
+    def predict_marginal_probabilities_obs(
+        self, X: pd.DataFrame, X_obs: pd.DataFrame, species=None, n_draws=None
+    ) -> pd.DataFrame:
+        from .functional.hierarchical_checklist_model_mcmc import predict_obs
+
+        return predict_obs(
+            X,
+            X_obs,
+            self.samples,
+            self.design_info,
+            species=species,
+            n_draws=n_draws,
+            representative_draws=self.representative_draws,
+        )
+
+    def predict_conditional_occupancy(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+        species=None,
+        n_draws=None,
+    ) -> pd.DataFrame:
+        from .functional.hierarchical_checklist_model_mcmc import (
+            predict_conditional_occupancy,
+        )
+
+        return predict_conditional_occupancy(
+            X_env,
+            X_checklist,
+            y_checklist,
+            checklist_cell_ids,
+            self.samples,
+            self.design_info,
+            species=species,
+            n_draws=n_draws,
+            representative_draws=self.representative_draws,
+        )
+
+    def compress_posterior(
+        self, X: pd.DataFrame, X_obs=None, n_representative=50, tolerance=None
+    ) -> dict:
+        """Selects a small weighted set of draws to predict with.
+
+        Subsequent predictions only use the selected draws, which makes them
+        faster. See compress_posterior in
+        functional.hierarchical_checklist_model_mcmc for the arguments.
+
+        Returns:
+            The maximum absolute errors of the mean prediction and of its
+            quantiles on the validation set.
+        """
+        from .functional.hierarchical_checklist_model_mcmc import compress_posterior
+
+        self.representative_draws = compress_posterior(
+            X,
+            self.samples,
+            self.design_info,
+            X_obs=X_obs,
+            n_representative=n_representative,
+            tolerance=tolerance,
+        )
+
+        return self.representative_draws["errors"]
+
+    def save_model(
+        self, target_folder: str, n_saved_draws=None, draw_dtype=np.float32
+    ) -> None:
+        """Saves the model to files in the target folder.
+
+        Args:
+            target_folder: Where to save the model.
+            n_saved_draws: If given, only this many evenly spaced draws are
+                saved, which makes predictions from the restored model faster.
+            draw_dtype: The floating point type of the saved draws; None
+                keeps their current type.
+        """
+
+        # The indices of the representative draws refer to all draws.
+        assert (
+            self.representative_draws is None or n_saved_draws is None
+        ), "Cannot thin a compressed posterior."
+
+        makedirs(target_folder, exist_ok=True)
+        save_model_info(
+            self.design_info,
+            join(target_folder, MODEL_INFO_FILE),
+            {
+                "env_formula": str(self.env_formula),
+                "obs_formula": str(self.obs_formula),
+            },
+            {"laplace_results": self.laplace_results},
+        )
+        if self.representative_draws is not None:
+            save_representative_draws(
+                self.representative_draws,
+                join(target_folder, REPRESENTATIVE_DRAWS_FILE),
+            )
+
+        save_draw_store(
+            self.samples,
+            self.design_info["species_names"],
+            join(target_folder, DRAW_STORE_FILE),
+            n_draws=n_saved_draws,
+            dtype=draw_dtype,
+        )
+
+        # Save the design infos
+        save_design_info_json(
+            self.design_info["env"], join(target_folder, "design_info_env.json")
+        )
+
+        save_design_info_json(
+            self.design_info["obs"], join(target_folder, "design_info_obs.json")
+        )
+
+    def restore_model(self, restore_folder: str) -> None:
+
+        if os.path.isfile(join(restore_folder, DRAW_STORE_FILE)):
+            # The draws are read from disk as they are needed.
+            self.samples = DrawStore(join(restore_folder, DRAW_STORE_FILE))
+        else:
+            # Models saved before the draw store was introduced
+            import arviz as az
+
+            self.samples = az.from_netcdf(join(restore_folder, "draws.netcdf"))
+
+        if os.path.isfile(join(restore_folder, REPRESENTATIVE_DRAWS_FILE)):
+            self.representative_draws = load_representative_draws(
+                join(restore_folder, REPRESENTATIVE_DRAWS_FILE)
+            )
+        else:
+            self.representative_draws = None
+
+        env_design_info = load_design_info(restore_folder, "design_info_env")
+
+        obs_design_info = load_design_info(restore_folder, "design_info_obs")
+
+        model_info = load_model_info(restore_folder)
+
+        self.env_formula = model_info["env_formula"]
+        self.obs_formula = model_info["obs_formula"]
+        self.laplace_results = model_info["laplace_results"]
+
+        self.design_info = {
+            "env": env_design_info,
+            "obs": obs_design_info,
+            "species_names": model_info["species_names"],
+        }
+
+        # Older models saved a scaler of None if the env covariates were not
+        # scaled.
+        if model_info.get("env_scaler") is not None:
+            self.design_info["env_scaler"] = model_info["env_scaler"]
@@ -1,34 +1,67 @@
 from .checklist_model import ChecklistModel
 import numpy as np
-from typing import Callable
 import pandas as pd
-from tqdm import tqdm
 from patsy import dmatrix, build_design_matrices
-from jax_advi.advi import get_pickleable_subset
-from ml_tools.utils import save_pickle_safely, load_pickle_safely
+import os
 from os import makedirs
-from os.path import join
-from sklearn.preprocessing import StandardScaler
-from ml_tools.stan import load_stan_model_cached
-from scipy.special import expit
-from jax.nn import log_sigmoid
-from occu_py.utils import evaluate_on_chunks
-from .functional.utils import predict_env_from_samples, predict_obs_from_samples
-from ml_tools.patsy import (
-    remove_intercept_column,
-    save_design_info,
-    restore_design_info,
-)
+from os.path import join, dirname
+from .design import save_design_info_json, load_design_info
+from .array_store import save_array_store, load_array_store
+
+# The Stan models shipped with the package
+LOOP_MODEL_FILE = join(dirname(__file__), "checklist_model.stan")
+GROUPED_MODEL_FILE = join(dirname(__file__), "checklist_model_grouped.stan")
+
+FIT_RESULTS_FILE = "fit_results.bin"
+
+# Models saved before FIT_RESULTS_FILE pickled their fit results here.
+LEGACY_FIT_RESULTS_FILE = "fit_results.pkl"
+
+
+def group_checklists_by_cell(checklist_cell_ids, n_cells):
+    """Computes the cell-grouped checklist layout used by the grouped model.
+
+    Args:
+        checklist_cell_ids: The (zero-based) cell index of each checklist.
+        n_cells: The total number of cells.
+
+    Returns:
+        A tuple of the order in which to arrange the checklists so that they
+        are sorted by cell, and the (one-based) index of the first checklist of
+        each cell in that order, with a final entry one past the last
+        checklist.
+    """
+
+    order = np.argsort(checklist_cell_ids, kind="stable")
+    counts = np.bincount(checklist_cell_ids, minlength=n_cells)
+    cell_starts = np.concatenate([[1], 1 + np.cumsum(counts)]).astype(int)
+
+    return order, cell_starts
 
 
 class MultiSpeciesOccuStan(ChecklistModel):
     def __init__(self, model_file, env_formula, obs_formula, is_test_run=False):
+        """Multi-species occupancy detection model fit with Stan.
+
+        Args:
+            model_file: The Stan model to use, e.g. LOOP_MODEL_FILE or
+                GROUPED_MODEL_FILE.
+            env_formula: Patsy formula for the environmental covariates.
+            obs_formula: Patsy formula for the detection covariates.
+            is_test_run: If True, only runs a few iterations.
+
+        The checklists are passed in the cell-grouped layout if model_file is
+        GROUPED_MODEL_FILE.
+        """
+        from ml_tools.stan import load_stan_model_cached
 
         self.scaler = None
+        self.model_file = model_file
         self.stan_model = load_stan_model_cached(model_file)
         self.env_formula = env_formula
         self.obs_formula = obs_formula
         self.is_test_run = is_test_run
+        self.grouped = os.path.samefile(model_file, GROUPED_MODEL_FILE)
 
     def fit(
         self,
@@ -37,9 +70,7 @@ class MultiSpeciesOccuStan(ChecklistModel):
         y_checklist: pd.DataFrame,
         checklist_cell_ids: np.ndarray,
     ):
-
-        self.X_env = X_env
-        self.X_checklist = X_checklist
+        from ml_tools.patsy import remove_intercept_column
 
         self.species_names = y_checklist.columns
 
@@ -70,12 +101,25 @@ class MultiSpeciesOccuStan(ChecklistModel):
             "y": y_checklist.values.astype(int),
         }
 
+        if self.grouped:
+
+            order, cell_starts = group_checklists_by_cell(
+                checklist_cell_ids, X_env.shape[0]
+            )
+
+            del model_data["cell_ids"]
+            model_data["obs_covs"] = obs_covs[order]
+            model_data["y"] = model_data["y"][order]
+            model_data["cell_starts"] = cell_starts
+
         if self.is_test_run:
             self.fit_results = self.stan_model.sampling(data=model_data, iter=10)
         else:
             self.fit_results = self.stan_model.sampling(data=model_data, thin=4)
 
     def predict_marginal_probabilities_direct(self, X: pd.DataFrame) -> pd.DataFrame:
+        from ml_tools.patsy import remove_intercept_column
+        from .functional.utils import predict_env_from_samples
 
         X_design = np.asarray(build_design_matrices([self.env_design_info], X)[0])
         X_design = remove_intercept_column(X_design, self.env_design_info)
@@ -89,6 +133,8 @@ class MultiSpeciesOccuStan(ChecklistModel):
     def predict_marginal_probabilities_obs(
         self, X: pd.DataFrame, X_obs: pd.DataFrame
     ) -> pd.DataFrame:
+        from ml_tools.patsy import remove_intercept_column
+        from .functional.utils import predict_obs_from_samples
 
         env_covs = np.asarray(build_design_matrices([self.env_design_info], X)[0])
         obs_covs = np.asarray(build_design_matrices([self.obs_design_info], X_obs)[0])
@@ -104,39 +150,76 @@ class MultiSpeciesOccuStan(ChecklistModel):
 
         return pd.DataFrame(probs, columns=self.species_names)
 
+    def predict_conditional_occupancy(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ) -> pd.DataFrame:
+        from ml_tools.patsy import remove_intercept_column
+        from .functional.utils import predict_conditional_occupancy_from_samples
+
+        env_covs = np.asarray(build_design_matrices([self.env_design_info], X_env)[0])
+        obs_covs = np.asarray(
+            build_design_matrices([self.obs_design_info], X_checklist)[0]
+        )
+        env_covs = remove_intercept_column(env_covs, self.env_design_info)
+
+        occupancy = predict_conditional_occupancy_from_samples(
+            env_covs,
+            self.fit_results["env_slopes"],
+            self.fit_results["env_intercepts"],
+            obs_covs,
+            self.fit_results["obs_coefs"],
+            y_checklist[self.species_names],
+            checklist_cell_ids,
+        )
+
+        return pd.DataFrame(occupancy, index=X_env.index, columns=self.species_names)
+
     def save_model(self, target_folder: str) -> None:
 
         makedirs(target_folder, exist_ok=True)
 
-        to_pickle = {
-            "fit_result": self.fit_results.extract(),
-            "obs_cov_names": self.obs_cov_names,
-            "env_cov_names": self.env_cov_names,
-            "species_names": self.species_names,
-            "env_formula": self.env_formula,
-            "obs_formula": self.obs_formula,
-        }
-
-        save_pickle_safely(to_pickle, join(target_folder, "fit_results.pkl"))
+        # The draws of each parameter are stored as arrays, the rest as JSON.
+        save_array_store(
+            join(target_folder, FIT_RESULTS_FILE),
+            {
+                **self.fit_results.extract(),
+                "species_names": np.array(self.species_names, dtype=str),
+            },
+            {
+                "obs_cov_names": list(self.obs_cov_names),
+                "env_cov_names": list(self.env_cov_names),
+                "env_formula": str(self.env_formula),
+                "obs_formula": str(self.obs_formula),
+            },
+        )
 
         # Save the design infos
-        save_design_info(
-            self.X_env,
-            self.env_formula,
-            self.env_design_info,
-            join(target_folder, "design_info_env.pkl"),
+        save_design_info_json(
+            self.env_design_info, join(target_folder, "design_info_env.json")
         )
 
-        save_design_info(
-            self.X_checklist,
-            self.obs_formula,
-            self.obs_design_info,
-            join(target_folder, "design_info_obs.pkl"),
+        save_design_info_json(
+            self.obs_design_info, join(target_folder, "design_info_obs.json")
         )
 
     def restore_model(self, load_folder: str) -> None:
 
-        fit_results = load_pickle_safely(join(load_folder, "fit_results.pkl"))
+        if os.path.isfile(join(load_folder, FIT_RESULTS_FILE)):
+            # The draws are memory-mapped.
+            arrays, fit_results = load_array_store(join(load_folder, FIT_RESULTS_FILE))
+            fit_results["species_names"] = [str(x) for x in arrays["species_names"]]
+            fit_results["fit_result"] = {
+                x: y for x, y in arrays.items() if x != "species_names"
+            }
+        else:
+            # Models saved before the array store was introduced
+            from ml_tools.utils import load_pickle_safely
+
+            fit_results = load_pickle_safely(join(load_folder, LEGACY_FIT_RESULTS_FILE))
 
         self.fit_results = fit_results["fit_result"]
         self.obs_cov_names = fit_results["obs_cov_names"]
@@ -145,9 +228,5 @@ class MultiSpeciesOccuStan(ChecklistModel):
         self.env_formula = fit_results["env_formula"]
         self.obs_formula = fit_results["obs_formula"]
 
-        self.env_design_info = restore_design_info(
-            join(load_folder, "design_info_env.pkl")
-        )
-        self.obs_design_info = restore_design_info(
-            join(load_folder, "design_info_obs.pkl")
-        )
+        self.env_design_info = load_design_info(load_folder, "design_info_env")
+        self.obs_design_info = load_design_info(load_folder, "design_info_obs")
@@ -0,0 +1,167 @@
+from .checklist_model import ChecklistModel
+import os
+import numpy as np
+import pandas as pd
+from os.path import join
+from .array_store import save_array_store, load_array_store
+from .design import save_design_info_json, load_design_info
+from .functional.prediction import predict_mean_probabilities_from_draws
+
+MODEL_FILE = "presence_absence_model.bin"
+
+
+class MultiSpeciesPresenceAbsence(ChecklistModel):
+    def __init__(
+        self,
+        env_formula,
+        prior_sd=1.0,
+        intercept_prior_sd=10.0,
+        M=100,
+        n_draws=1000,
+        species_batch_size=32,
+        seed=3,
+        verbose=False,
+    ):
+        """Presence-absence models without detection, one per species, fit by
+        mean-field ADVI.
+
+        This is the baseline which treats a detection on a checklist as a
+        presence in its cell and a non-detection as an absence, so that the
+        probability of observing a species is its probability of presence.
+        The species are fitted together in batches with a shared env design;
+        see functional.presence_absence_model.fit_multi.
+
+        Args:
+            env_formula: Patsy formula for the environmental covariates.
+            prior_sd: The prior sd of the env slopes.
+            intercept_prior_sd: The prior sd of the intercepts.
+            M: The number of draws used to estimate the ELBO.
+            n_draws: The number of posterior draws to predict with.
+            species_batch_size: The number of species fitted together.
+            seed: The random seed of the ADVI.
+            verbose: If True, shows the progress of the optimisation.
+        """
+
+        self.env_formula = env_formula
+        self.prior_sd = prior_sd
+        self.intercept_prior_sd = intercept_prior_sd
+        self.M = M
+        self.n_draws = n_draws
+        self.species_batch_size = species_batch_size
+        self.seed = seed
+        self.verbose = verbose
+
+    def fit(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ) -> None:
+        from .functional.presence_absence_model import fit_multi
+
+        fit_result = fit_multi(
+            X_env,
+            y_checklist,
+            checklist_cell_ids,
+            self.env_formula,
+            prior_sd=self.prior_sd,
+            intercept_prior_sd=self.intercept_prior_sd,
+            M=self.M,
+            n_draws=self.n_draws,
+            species_batch_size=self.species_batch_size,
+            seed=self.seed,
+            verbose=self.verbose,
+        )
+
+        self.draws = fit_result["draws"]
+        self.env_design_info = fit_result["design_info"]
+        self.species_names = fit_result["species_names"]
+        self.successful = fit_result["successful"]
+
+    def predict_marginal_probabilities_direct(
+        self, X: pd.DataFrame, chunk_size=10000, draw_batch_size=None
+    ) -> pd.DataFrame:
+        """Predicts the probability of presence of each species.
+
+        Args:
+            X: The environmental covariates.
+            chunk_size: The number of rows predicted at once.
+            draw_batch_size: The number of draws averaged at once; see
+                functional.prediction.predict_mean_probabilities_from_draws.
+
+        Returns:
+            A DataFrame of probabilities [n_rows x n_species].
+        """
+
+        probs = predict_mean_probabilities_from_draws(
+            X,
+            self.env_design_info,
+            self.draws["env_slopes"],
+            self.draws["env_intercepts"],
+            chunk_size=chunk_size,
+            draw_batch_size=draw_batch_size,
+        )
+
+        return pd.DataFrame(probs, index=X.index, columns=self.species_names)
+
+    def predict_marginal_probabilities_obs(
+        self, X: pd.DataFrame, X_obs: pd.DataFrame, chunk_size=10000
+    ) -> pd.DataFrame:
+        # Without a detection model, the probability of observing a species on
+        # a checklist is that of its presence.
+
+        return self.predict_marginal_probabilities_direct(
+            X, chunk_size=chunk_size
+        ).set_axis(X_obs.index)
+
+    def predict_conditional_occupancy(
+        self,
+        X_env: pd.DataFrame,
+        X_checklist: pd.DataFrame,
+        y_checklist: pd.DataFrame,
+        checklist_cell_ids: np.ndarray,
+    ) -> pd.DataFrame:
+
+        # The model treats every non-detection as an absence, so it cannot tell
+        # a species that was missed from one that is absent.
+        raise NotImplementedError(
+            "The presence-absence model has no detection process, so it does not "
+            "predict conditional occupancy."
+        )
+
+    def save_model(self, target_folder: str, draw_dtype=np.float32) -> None:
+        """Saves the model to files in the target folder.
+
+        Args:
+            target_folder: Where to save the model.
+            draw_dtype: The floating point type of the saved draws.
+        """
+
+        os.makedirs(target_folder, exist_ok=True)
+
+        save_array_store(
+            join(target_folder, MODEL_FILE),
+            {
+                "species_names": np.array(self.species_names, dtype=str),
+                "env_slopes": self.draws["env_slopes"].astype(draw_dtype),
+                "env_intercepts": self.draws["env_intercepts"].astype(draw_dtype),
+                "successful": self.successful,
+            },
+            {"env_formula": str(self.env_formula)},
+        )
+
+        save_design_info_json(
+            self.env_design_info, join(target_folder, "design_info_env.json")
+        )
+
+    def restore_model(self, restore_folder: str) -> None:
+
+        # The draws are memory-mapped.
+        arrays, metadata = load_array_store(join(restore_folder, MODEL_FILE))
+
+        self.env_formula = metadata["env_formula"]
+        self.species_names = list(arrays["species_names"])
+        self.successful = arrays["successful"]
+        self.draws = {x: arrays[x] for x in ["env_slopes", "env_intercepts"]}
+        self.env_design_info = load_design_info(restore_folder, "design_info_env")
@@ -0,0 +1,75 @@
+# Numerical precision of a model, chosen per model rather than with JAX's
+# process-wide jax_enable_x64 switch.
+#
+# With "single" precision, the design matrices are stored in float32 and the
+# matrix products with the coefficients take float32 inputs, but accumulate in
+# float64, as do the products in the gradient and the per-cell sums of the
+# likelihood (over possibly thousands of checklists). Accumulating the
+# gradient in float32 leaves it too noisy for the Newton solver to converge.
+# With "double" precision, everything is float64. Both need JAX's 64-bit mode,
+# which precision_scope enables only while the model is fitted. A precision of
+# None leaves everything to the global setting, as before.
+import numpy as np
+from contextlib import nullcontext
+
+# The compute and accumulation dtypes of each precision.
+PRECISIONS = {
+    "single": (np.float32, np.float64),
+    "double": (np.float64, np.float64),
+}
+
+
+def get_precision_dtypes(precision=None):
+    """Returns the compute and accumulation dtypes of a precision.
+
+    Both are None if precision is None.
+
+    Raises:
+        ValueError: If the precision is not one of PRECISIONS.
+    """
+
+    if precision is None:
+        return None, None
+
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision {precision}; expected one of {list(PRECISIONS)}."
+        )
+
+    return PRECISIONS[precision]
+
+
+def get_design_dtype(precision=None):
+    # The dtype to store design matrices in: float64 unless a precision says
+    # otherwise.
+
+    compute_dtype, _ = get_precision_dtypes(precision)
+
+    return np.float64 if compute_dtype is None else compute_dtype
+
+
+def cast_to(x, dtype=None):
+    # Casts a numpy or JAX array to dtype, unless dtype is None.
+
+    return x if dtype is None else x.astype(dtype)
+
+
+def precision_scope(precision=None):
+    """Returns a context in which JAX can compute in the given precision.
+
+    This enables JAX's 64-bit mode within the context, unless precision is
+    None.
+    """
+
+    if precision is None:
+        return nullcontext()
+
+    get_precision_dtypes(precision)
+
+    try:
+        from jax import enable_x64
+    except ImportError:
+        # Older versions of JAX
+        from jax.experimental import enable_x64
+
+    return enable_x64(True)
@@ -0,0 +1,188 @@
+# Predictions [rows x species] stored in binary form, written chunk by chunk as
+# they are produced and read back selectively. A store is a folder with the
+# predictions as a .npy file in Fortran (column-major) order, so that the
+# predictions of each species are contiguous on disk, the row index as a second
+# .npy file, and a JSON file with the species names.
+#
+# The .npy file is memory-mapped both for writing and reading, so neither needs
+# to hold all predictions in memory, and reading a few species only touches
+# their columns. The JSON file is written when all rows have been written, and
+# readers check that it is there, so that an interrupted prediction is never
+# mistaken for a complete one. For 100000 checklists x 256 species (see
+# scripts/benchmark_prediction_store.py), predicting into a store takes 0.9s
+# and 100MB, of which 0.8s are the prediction, while DataFrame.to_csv takes 13s
+# and 290MB; reading four species back takes 1ms rather than 0.6s.
+import os
+import json
+import numpy as np
+import pandas as pd
+from os.path import join
+
+PREDICTIONS_FILE = "predictions.npy"
+INDEX_FILE = "index.npy"
+INFO_FILE = "prediction_store.json"
+
+
+class PredictionStoreWriter(object):
+    """Writes predictions to a store, chunk of rows by chunk of rows."""
+
+    def __init__(self, target_folder: str, species_names, index, dtype=np.float32):
+        """
+        Args:
+            target_folder: The folder of the store. It is created if it does
+                not exist; an existing store in it is overwritten.
+            species_names: The names of the columns.
+            index: The index of the rows, e.g. that of the covariates the
+                predictions are made for.
+            dtype: The floating point type to store the predictions as.
+        """
+
+        os.makedirs(target_folder, exist_ok=True)
+
+        # Remove the info file first, so that the old store is invalid while
+        # the new one is written.
+        if os.path.isfile(join(target_folder, INFO_FILE)):
+            os.remove(join(target_folder, INFO_FILE))
+
+        index = pd.Index(index)
+
+        self.target_folder = target_folder
+        self.species_names = [str(x) for x in species_names]
+        self.index_name = index.name
+
+        index_values = np.asarray(index)
+
+        # Strings are stored with a fixed-width unicode dtype, since object
+        # arrays cannot be memory-mapped.
+        if index_values.dtype == object:
+            index_values = index_values.astype(str)
+
+        np.save(join(target_folder, INDEX_FILE), index_values)
+
+        self.predictions = np.lib.format.open_memmap(
+            join(target_folder, PREDICTIONS_FILE),
+            mode="w+",
+            dtype=dtype,
+            shape=(len(index), len(self.species_names)),
+            fortran_order=True,
+        )
+
+    def write(self, start: int, chunk):
+        """Writes the predictions [chunk_rows x species] for the rows starting
+        at start."""
+
+        self.predictions[start : start + chunk.shape[0]] = np.asarray(chunk)
+
+    def close(self):
+        """Flushes the predictions to disk and marks the store as complete."""
+
+        self.predictions.flush()
+        del self.predictions
+
+        with open(join(self.target_folder, INFO_FILE), "w") as f:
+            json.dump(
+                {"species_names": self.species_names, "index_name": self.index_name},
+                f,
+            )
+
+
+def write_predictions(
+    target_folder: str,
+    predict_chunk,
+    n_rows: int,
+    index,
+    chunk_size=100000,
+    dtype=np.float32,
+):
+    """Predicts in chunks of rows and writes each chunk to a store.
+
+    Args:
+        target_folder: The folder of the store.
+        predict_chunk: A function taking a slice of rows and returning their
+            predictions as a DataFrame [chunk_rows x species]. It is called
+            at least once, with an empty slice if n_rows is zero.
+        n_rows: The total number of rows.
+        index: The index of the rows.
+        chunk_size: The number of rows predicted at once.
+        dtype: The floating point type to store the predictions as.
+    """
+
+    # The first chunk gives the species names, so it is predicted before the
+    # writer is created. Without rows, it is empty, and so is the store.
+    chunk = predict_chunk(slice(0, chunk_size))
+    writer = PredictionStoreWriter(target_folder, chunk.columns, index, dtype)
+    writer.write(0, chunk)
+
+    for start in range(chunk_size, n_rows, chunk_size):
+        writer.write(start, predict_chunk(slice(start, start + chunk_size)))
+
+    writer.close()
+
+
+class PredictionStore(object):
+    """Predictions loaded lazily from a store."""
+
+    def __init__(self, store_folder: str, mmap_mode="r"):
+
+        info_file = join(store_folder, INFO_FILE)
+        assert os.path.isfile(info_file), f"{store_folder} is not a complete store."
+
+        with open(info_file) as f:
+            info = json.load(f)
+
+        self.species_names = info["species_names"]
+        self.index = pd.Index(
+            np.load(join(store_folder, INDEX_FILE)), name=info["index_name"]
+        )
+        self.predictions = np.load(
+            join(store_folder, PREDICTIONS_FILE), mmap_mode=mmap_mode
+        )
+
+    @property
+    def shape(self):
+
+        return self.predictions.shape
+
+    def get(self, species=None, rows=None):
+        """Reads the predictions of some species.
+
+        Args:
+            species: The names of the species to read. All species are read if
+                None.
+            rows: The rows to read, as a slice or an array of indices. All rows
+                are read if None.
+
+        Returns:
+            A DataFrame of predictions [n_rows x n_species].
+        """
+
+        rows = slice(None) if rows is None else rows
+
+        if species is None:
+            species = self.species_names
+            species_indices = slice(None)
+        else:
+            species_indices = pd.Index(self.species_names).get_indexer(species)
+            assert np.all(species_indices >= 0), "Some species are not in the store."
+
+        if isinstance(rows, slice):
+            predictions = self.predictions[rows][:, species_indices]
+        else:
+            # Select the columns first, each of which is contiguous on disk.
+            predictions = self.predictions[:, species_indices][rows]
+
+        return pd.DataFrame(
+            np.array(predictions), index=self.index[rows], columns=species
+        )
+
+    def iter_chunks(self, chunk_size=100000, species=None):
+        """Yields the predictions of chunks of chunk_size rows as DataFrames."""
+
+        for start in range(0, self.shape[0], chunk_size):
+            yield self.get(species, slice(start, start + chunk_size))
+
+
+def load_predictions(store_folder: str, species=None, rows=None):
+    """Reads predictions from a store; see PredictionStore.get."""
+
+    return PredictionStore(store_folder).get(species, rows)
@@ -0,0 +1,259 @@
+# A lightweight runtime for predictors written by occu_py.export. It only needs
+# numpy: the design matrices are rebuilt from the exported recipes rather than
+# with patsy, and predictions are computed directly from the exported
+# coefficients.
+#
+# Note that the recipes contain the Python code of the formula terms, which is
+# evaluated when predicting, so predictors should only be loaded from trusted
+# sources (as with pickle files).
+import numpy as np
+from .array_store import load_array_store
+
+PREDICTOR_FORMAT = "occu_py_predictor"
+
+# By default, rows are predicted in chunks such that the intermediate
+# [n_draws x n_rows x n_species] arrays have at most this many elements.
+MAX_CHUNK_ELEMENTS = 2**22
+
+
+class Center(object):
+    # The numpy equivalent of patsy's center.
+
+    def __init__(self, _sum, _count):
+
+        self.mean = np.asarray(_sum, dtype=float) / _count
+
+    def transform(self, x):
+
+        x = np.asarray(x, dtype=float)
+
+        return (x.reshape(x.shape[0], -1) - self.mean).reshape(x.shape)
+
+
+class Standardize(object):
+    # The numpy equivalent of patsy's standardize and scale.
+
+    def __init__(self, current_n, current_mean, current_M2):
+
+        self.n = current_n
+        self.mean = np.asarray(current_mean, dtype=float)
+        self.M2 = np.asarray(current_M2, dtype=float)
+
+    def transform(self, x, center=True, rescale=True, ddof=0):
+
+        x = np.asarray(x, dtype=float)
+        x_2d = x.reshape(x.shape[0], -1)
+
+        if center:
+            x_2d = x_2d - self.mean
+        if rescale:
+            x_2d = x_2d / np.sqrt(self.M2 / (self.n - ddof))
+
+        return x_2d.reshape(x.shape)
+
+
+TRANSFORMS = {"patsy.state.Center": Center, "patsy.state.Standardize": Standardize}
+
+
+def identity(x, *args, **kwargs):
+
+    return x
+
+
+def contrast_placeholder(*args, **kwargs):
+    # The contrasts are part of the recipe, so their specification in the code
+    # (e.g. C(x, Treatment("a"))) is ignored.
+
+    return None
+
+
+FORMULA_NAMESPACE = {
+    "np": np,
+    "numpy": np,
+    "I": identity,
+    "C": identity,
+    "Treatment": contrast_placeholder,
+    "Sum": contrast_placeholder,
+    "Helmert": contrast_placeholder,
+    "Diff": contrast_placeholder,
+    "Poly": contrast_placeholder,
+}
+
+
+def get_n_rows(data):
+
+    if hasattr(data, "shape"):
+        return data.shape[0]
+
+    return len(next(iter(data.values())))
+
+
+def decode_state(state):
+    # Arrays in the saved transform state are stored with their dtype.
+
+    return {
+        x: np.array(y["value"]) if isinstance(y, dict) and "dtype" in y else y
+        for x, y in state.items()
+    }
+
+
+def compile_factor(factor):
+    # Returns a function evaluating the factor on a data frame (or a dictionary
+    # of arrays).
+
+    transforms = {
+        x: TRANSFORMS[y["class"]](**decode_state(y["state"]))
+        for x, y in factor["transforms"].items()
+    }
+
+    code = compile(factor["eval_code"], factor["eval_code"], "eval")
+
+    def evaluate(data):
+
+        namespace = dict(FORMULA_NAMESPACE)
+        namespace.update(transforms)
+        namespace.update({x: np.asarray(data[x]) for x in factor["variables"]})
+        namespace["Q"] = lambda name: np.asarray(data[name])
+
+        value = eval(code, {"__builtins__": {}}, namespace)
+
+        if factor["kind"] == "numerical":
+            value = np.asarray(value, dtype=float)
+            return value.reshape(value.shape[0], -1)
+
+        # For categorical factors, return the index of each value's category.
+        categories = factor["categories"]
+        unique_values, inverse = np.unique(np.asarray(value), return_inverse=True)
+        lookup = {x: i for i, x in enumerate(categories)}
+
+        unknown = [x for x in unique_values.tolist() if x not in lookup]
+
+        if len(unknown) > 0:
+            raise ValueError(
+                f"Unknown categories {unknown} in {factor['eval_code']}; "
+                f"expected one of {categories}."
+            )
+
+        return np.array([lookup[x] for x in unique_values.tolist()])[inverse]
+
+    return evaluate
+
+
+class DesignRecipe(object):
+    """Builds a design matrix from a recipe compiled by occu_py.export."""
+
+    def __init__(self, recipe):
+
+        self.column_names = [x["name"] for x in recipe["columns"]]
+        self.columns = recipe["columns"]
+        self.factors = {x: compile_factor(y) for x, y in recipe["factors"].items()}
+
+    def build(self, data, dtype=np.float64):
+
+        n_rows = get_n_rows(data)
+
+        factor_values = {x: y(data) for x, y in self.factors.items()}
+        design = np.ones((n_rows, len(self.columns)), dtype=dtype)
+
+        for i, cur_column in enumerate(self.columns):
+
+            for cur_piece in cur_column["factors"]:
+
+                cur_values = factor_values[cur_piece["code"]]
+
+                if "contrast" in cur_piece:
+                    design[:, i] *= np.asarray(cur_piece["contrast"])[cur_values]
+                else:
+                    design[:, i] *= cur_values[:, cur_piece["column"]]
+
+        return design
+
+
+def log_sigmoid(x):
+
+    return -np.logaddexp(0.0, -x)
+
+
+class Predictor(object):
+    """Predicts from a model exported with occu_py.export.export_predictor.
+
+    The coefficients are stored as draws [n_draws x n_coefs x n_species]; point
+    estimates have a single draw. Probabilities are averaged over the draws.
+    """
+
+    def __init__(self, arrays, metadata):
+
+        assert metadata["format"] == PREDICTOR_FORMAT
+
+        self.metadata = metadata
+        self.species_names = [str(x) for x in arrays["species_names"]]
+        self.env_coefs = arrays["env_coefs"]
+        self.obs_coefs = arrays["obs_coefs"]
+        self.env_recipe = DesignRecipe(metadata["env_recipe"])
+        self.obs_recipe = DesignRecipe(metadata["obs_recipe"])
+
+    def predict_log_probs(self, X, X_obs=None, chunk_size=None):
+        # Returns the log probabilities of presence (or of observation, if
+        # X_obs is given) averaged over draws, for chunks of rows at a time.
+
+        n_rows = get_n_rows(X)
+        n_draws = self.env_coefs.shape[0]
+        n_species = len(self.species_names)
+        log_probs = np.empty((n_rows, n_species))
+
+        if chunk_size is None:
+            chunk_size = max(1, MAX_CHUNK_ELEMENTS // (n_draws * n_species))
+
+        env_design = self.env_recipe.build(X)
+
+        if X_obs is not None:
+            obs_design = self.obs_recipe.build(X_obs)
+
+        for start in range(0, n_rows, chunk_size):
+
+            rows = slice(start, start + chunk_size)
+
+            cur_log_probs = log_sigmoid(
+                np.einsum("nc,dcs->dns", env_design[rows], self.env_coefs)
+            )
+
+            if X_obs is not None:
+                cur_log_probs += log_sigmoid(
+                    np.einsum("nc,dcs->dns", obs_design[rows], self.obs_coefs)
+                )
+
+            log_probs[rows] = np.logaddexp.reduce(cur_log_probs, axis=0) - np.log(
+                n_draws
+            )
+
+        return log_probs
+
+    def predict_marginal_probabilities_direct(self, X, chunk_size=None):
+        """Predicts the probability of presence [n_rows x n_species].
+
+        Args:
+            X: The environmental covariates, as a data frame or a dictionary
+                of arrays.
+            chunk_size: The number of rows predicted at once. By default,
+                this is chosen to limit memory use.
+        """
+
+        return np.exp(self.predict_log_probs(X, chunk_size=chunk_size))
+
+    def predict_marginal_probabilities_obs(self, X, X_obs, chunk_size=None):
+        """Predicts the probability of observation on checklists.
+
+        Args:
+            X: The environmental covariates of each checklist's cell.
+            X_obs: The checklist covariates.
+            chunk_size: The number of rows predicted at once. By default,
+                this is chosen to limit memory use.
+        """
+
+        return np.exp(self.predict_log_probs(X, X_obs, chunk_size=chunk_size))
+
+
+def load_predictor(predictor_file: str) -> Predictor:
+    """Loads a predictor written by occu_py.export.export_predictor."""
+
+    return Predictor(*load_array_store(predictor_file))
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+from .checklist_dataset import ChecklistData
+
+
+def simulate_checklist_data(
+    n_cells=1000,
+    n_checklists=8000,
+    n_species=32,
+    n_env_covs=4,
+    env_intercept_mean=-1.0,
+    obs_intercept_mean=-0.5,
+    seed=2,
+):
+    """Simulates a dataset from the multi-species occupancy detection model.
+
+    Cells have standard normal environmental covariates ("env_cov_{i}");
+    checklists have a standardised log duration ("log_duration_z") and a
+    categorical "protocol_type" with three levels. Checklists are assigned to
+    cells uniformly at random.
+
+    Args:
+        n_cells: The number of cells.
+        n_checklists: The number of checklists.
+        n_species: The number of species.
+        n_env_covs: The number of environmental covariates.
+        env_intercept_mean: Mean of the species' occupancy intercepts.
+        obs_intercept_mean: Mean of the species' detection intercepts.
+        seed: The random seed to use.
+
+    Returns:
+        A tuple of the simulated data as ChecklistData and a dictionary with the
+        true coefficients. These are "env_coefs" [n_env_covs + 1 x n_species],
+        with the intercept first, and "obs_coefs" [4 x n_species], matching
+        the design matrix of the formula "protocol_type + log_duration_z".
+    """
+
+    from scipy.special import expit
+
+    np.random.seed(seed)
+
+    env_cov_names = [f"env_cov_{i}" for i in range(n_env_covs)]
+
+    X_env = pd.DataFrame(np.random.randn(n_cells, n_env_covs), columns=env_cov_names)
+
+    protocols = np.array(["Stationary", "Traveling", "Area"])
+
+    X_obs = pd.DataFrame(
+        {
+            "protocol_type": protocols[np.random.randint(3, size=n_checklists)],
+            "log_duration_z": np.random.randn(n_checklists),
+        }
+    )
+
+    cell_ids = np.random.randint(n_cells, size=n_checklists)
+
+    env_coefs = np.concatenate(
+        [
+            env_intercept_mean + np.random.randn(1, n_species),
+            np.random.randn(n_env_covs, n_species),
+        ]
+    )
+
+    obs_coefs = obs_intercept_mean + 0.5 * np.random.randn(4, n_species)
+
+    env_design = np.concatenate([np.ones((n_cells, 1)), X_env.values], axis=1)
+
+    # Treatment coding with "Area" as the reference level, as patsy would do.
+    obs_design = np.stack(
+        [
+            np.ones(n_checklists),
+            X_obs["protocol_type"].values == "Stationary",
+            X_obs["protocol_type"].values == "Traveling",
+            X_obs["log_duration_z"].values,
+        ],
+        axis=1,
+    ).astype(float)
+
+    present = np.random.rand(n_cells, n_species) < expit(env_design @ env_coefs)
+    detected = np.random.rand(n_checklists, n_species) < expit(obs_design @ obs_coefs)
+
+    y_obs = pd.DataFrame(
+        (present[cell_ids] & detected).astype(int),
+        columns=[f"species_{i}" for i in range(n_species)],
+    )
+
+    data = ChecklistData(X_env=X_env, X_obs=X_obs, y_obs=y_obs, env_cell_ids=cell_ids)
+
+    return data, {"env_coefs": env_coefs, "obs_coefs": obs_coefs}
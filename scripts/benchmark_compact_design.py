@@ -0,0 +1,90 @@
+# Compares the memory taken by dense design matrices with that of their compact
+# versions (see occu_py/compact_design.py), and the time taken to compute the
+# logits with each: for an eBird-like detection formula, and for an env formula
+# with sparse has_* land cover indicators.
+#
+# Usage: python benchmark_compact_design.py
+import time
+import numpy as np
+import pandas as pd
+from patsy import dmatrix
+from occu_py.compact_design import compact_dmatrix, design_dot, SPARSE_THRESHOLD
+
+N_CHECKLISTS = 1000000
+N_SPECIES = 32
+N_REPEATS = 5
+N_INDICATORS = 20
+INDICATOR_DENSITY = 0.05
+
+OBS_FORMULA = (
+    "protocol_type + daytimes_alt + time_of_day + dominant_land_cover"
+    " + log_duration_z + protocol_type:log_duration_z"
+)
+
+
+def simulate_obs_covariates(n_checklists, seed=2):
+
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame(
+        {
+            "protocol_type": rng.choice(
+                ["Traveling", "Stationary", "Area"], n_checklists
+            ),
+            "daytimes_alt": rng.choice([f"d{i}" for i in range(4)], n_checklists),
+            "time_of_day": rng.choice([f"t{i}" for i in range(6)], n_checklists),
+            "dominant_land_cover": rng.choice(
+                [f"lc{i}" for i in range(17)], n_checklists
+            ),
+            "log_duration_z": rng.normal(size=n_checklists),
+        }
+    )
+
+
+def simulate_env_covariates(n_rows, seed=2):
+
+    rng = np.random.default_rng(seed)
+
+    X_env = pd.DataFrame({f"bio_{i}": rng.normal(size=n_rows) for i in range(8)})
+
+    for i in range(N_INDICATORS):
+        X_env[f"has_{i}"] = rng.random(n_rows) < INDICATOR_DENSITY
+
+    return X_env
+
+
+def time_logits(design, coefs):
+
+    start = time.perf_counter()
+
+    for _ in range(N_REPEATS):
+        result = design_dot(design, coefs)
+
+    return (time.perf_counter() - start) / N_REPEATS, result
+
+
+def compare(name, dense, compact):
+
+    coefs = np.random.default_rng(3).normal(size=(dense.shape[1], N_SPECIES))
+
+    dense_time, dense_logits = time_logits(dense, coefs)
+    compact_time, compact_logits = time_logits(compact, coefs)
+
+    print(f"{name}: {dense.shape[1]} columns for {dense.shape[0]} rows")
+    print(f"dense:   {dense.nbytes / 1e6:8.1f} MB, logits in {dense_time:.3f}s")
+    print(
+        f"compact: {compact.nbytes / 1e6:8.1f} MB, logits in {compact_time:.3f}s; "
+        f"max abs difference {np.abs(dense_logits - compact_logits).max():.1e}"
+    )
+
+
+if __name__ == "__main__":
+
+    X_obs = simulate_obs_covariates(N_CHECKLISTS)
+    compact, _ = compact_dmatrix(OBS_FORMULA, X_obs)
+    compare("Detection", np.asarray(dmatrix(OBS_FORMULA, X_obs)), compact)
+
+    X_env = simulate_env_covariates(N_CHECKLISTS)
+    env_formula = "+".join(X_env.columns)
+    compact, _ = compact_dmatrix(env_formula, X_env, sparse_threshold=SPARSE_THRESHOLD)
+    compare("Env", np.asarray(dmatrix(env_formula, X_env)), compact)
@@ -0,0 +1,91 @@
+# Compares cold and warm starts of MaxLikOccu's Newton fit (with covariances)
+# using the persistent compilation cache of occu_py.compilation_cache. Each fit
+# runs in a new interpreter, so that nothing is reused in memory: first with an
+# empty cache, then again on the same data, and then on new data of a slightly
+# different size, which falls into the same shape buckets.
+#
+# Usage: python benchmark_compilation_cache.py [cache_dir]
+import sys
+import json
+import tempfile
+import subprocess
+
+N_CELLS = 5000
+N_CHECKLISTS = 100000
+N_SPECIES = 16
+N_ENV_COVS = 8
+
+FIT_CODE = """
+import time, json
+import numpy as np
+from occu_py.compilation_cache import (
+    enable_compilation_cache,
+    get_compilation_cache_stats,
+)
+from occu_py.simulation import simulate_checklist_data
+from occu_py.max_lik_occu import MaxLikOccu
+
+enable_compilation_cache({cache_dir!r})
+np.random.seed({seed})
+
+data, _ = simulate_checklist_data(
+    n_cells={n_cells},
+    n_checklists={n_checklists},
+    n_species={n_species},
+    n_env_covs={n_env_covs},
+)
+
+model = MaxLikOccu(
+    " + ".join(f"env_cov_{{i}}" for i in range({n_env_covs})),
+    "protocol_type + log_duration_z",
+    solver="newton",
+    compute_covariance=True,
+)
+
+start = time.perf_counter()
+model.fit(data.X_env, data.X_obs, data.y_obs, data.env_cell_ids)
+elapsed = time.perf_counter() - start
+
+print(json.dumps({{"time": elapsed, **get_compilation_cache_stats()}}))
+"""
+
+
+def run_fit(cache_dir, seed, n_checklists):
+    # Fits the model in a new interpreter, returning the time taken and the
+    # cache statistics.
+
+    code = FIT_CODE.format(
+        cache_dir=cache_dir,
+        seed=seed,
+        n_cells=N_CELLS,
+        n_checklists=n_checklists,
+        n_species=N_SPECIES,
+        n_env_covs=N_ENV_COVS,
+    )
+
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+
+    return json.loads(result.stdout.strip().split("\n")[-1])
+
+
+if __name__ == "__main__":
+
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+
+    runs = {
+        "cold": (1, N_CHECKLISTS),
+        "warm, same data": (1, N_CHECKLISTS),
+        "warm, new data": (2, int(N_CHECKLISTS * 1.02)),
+    }
+
+    for cur_name, (cur_seed, cur_n_checklists) in runs.items():
+
+        result = run_fit(cache_dir, cur_seed, cur_n_checklists)
+
+        print(
+            f"{cur_name:<16} {cur_n_checklists} checklists: fit in "
+            f"{result['time']:.1f}s, {result['hits']} hits, {result['misses']} "
+            f"misses, {result['seconds_saved']:.1f}s of compilation saved"
+        )
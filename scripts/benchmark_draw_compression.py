@@ -0,0 +1,69 @@
+# Compares predictions from all posterior draws of a Laplace fit to those from
+# a small weighted set of representative draws, selected on a validation set:
+# the time taken and the errors of the mean prediction on held-out checklists.
+#
+# Usage: python benchmark_draw_compression.py
+import time
+import numpy as np
+from occu_py.simulation import simulate_checklist_data
+from occu_py.multi_species_occu_laplace import MultiSpeciesOccuLaplace
+
+N_SPECIES = 32
+N_DRAWS = 1000
+N_REPRESENTATIVE = [20, 50, 100]
+N_VALIDATION = 500
+N_TEST = 50000
+
+
+def time_prediction(model, X, X_obs):
+
+    start = time.perf_counter()
+    predictions = model.predict_marginal_probabilities_obs(X, X_obs)
+
+    return time.perf_counter() - start, predictions.values
+
+
+if __name__ == "__main__":
+
+    data, _ = simulate_checklist_data(
+        n_cells=2000, n_checklists=57000, n_species=N_SPECIES, n_env_covs=4
+    )
+
+    model = MultiSpeciesOccuLaplace(
+        " + ".join(f"env_cov_{i}" for i in range(4)),
+        "protocol_type + log_duration_z",
+        n_draws=N_DRAWS,
+    )
+
+    # Fit on the checklists not used for validation or testing
+    n_fit = data.X_obs.shape[0] - N_VALIDATION - N_TEST
+    cell_ids = data.env_cell_ids
+    model.fit(data.X_env, data.X_obs[:n_fit], data.y_obs[:n_fit], cell_ids[:n_fit])
+
+    validation = np.arange(n_fit, n_fit + N_VALIDATION)
+    test = np.arange(n_fit + N_VALIDATION, n_fit + N_VALIDATION + N_TEST)
+
+    X_test = data.X_env.iloc[cell_ids[test]]
+    X_obs_test = data.X_obs.iloc[test]
+
+    full_time, full_predictions = time_prediction(model, X_test, X_obs_test)
+    print(f"{N_DRAWS} draws: predicted in {full_time:.2f}s")
+
+    for cur_n_representative in N_REPRESENTATIVE:
+
+        errors = model.compress_posterior(
+            data.X_env.iloc[cell_ids[validation]],
+            data.X_obs.iloc[validation],
+            n_representative=cur_n_representative,
+        )
+
+        cur_time, cur_predictions = time_prediction(model, X_test, X_obs_test)
+        abs_errors = np.abs(cur_predictions - full_predictions)
+
+        print(
+            f"{cur_n_representative} draws: predicted in {cur_time:.2f}s "
+            f"({full_time / cur_time:.1f}x faster); test error of mean: "
+            f"max {abs_errors.max():.4f}, mean {abs_errors.mean():.5f}; "
+            f"validation errors: "
+            + ", ".join(f"{x}: {y:.4f}" for x, y in errors.items())
+        )
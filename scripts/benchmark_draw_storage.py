@@ -0,0 +1,86 @@
+# Compares the size of the saved posterior draws and the time taken to predict
+# from the restored model for different draw storage policies: the netCDF files
+# written previously, and the draw store with and without float32 storage,
+# derived variables and thinning.
+#
+# Usage: python benchmark_draw_storage.py
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from os.path import join
+from occu_py.simulation import simulate_checklist_data
+from occu_py.multi_species_occu_laplace import MultiSpeciesOccuLaplace
+from occu_py.draw_store import save_draw_store, DRAW_STORE_FILE
+
+N_SPECIES = 64
+N_DRAWS = 1000
+N_PREDICTION_ROWS = 2000
+
+POLICIES = {
+    "float64, with derived": dict(dtype=None, keep_derived=True),
+    "float32": dict(),
+    "float32, 250 draws": dict(n_draws=250),
+    "float32, 100 draws": dict(n_draws=100),
+}
+
+
+def time_prediction(model_folder, X, X_obs):
+
+    start = time.perf_counter()
+
+    model = MultiSpeciesOccuLaplace("", "")
+    model.restore_model(model_folder)
+    predictions = model.predict_marginal_probabilities_obs(X, X_obs)
+
+    return time.perf_counter() - start, predictions.values
+
+
+if __name__ == "__main__":
+
+    data, _ = simulate_checklist_data(
+        n_cells=1000, n_checklists=5000, n_species=N_SPECIES, n_env_covs=8
+    )
+
+    model = MultiSpeciesOccuLaplace(
+        " + ".join(f"env_cov_{i}" for i in range(8)),
+        "protocol_type + log_duration_z",
+        n_draws=N_DRAWS,
+    )
+    model.fit(data.X_env, data.X_obs, data.y_obs, data.env_cell_ids)
+
+    X = data.X_env.iloc[data.env_cell_ids[:N_PREDICTION_ROWS]]
+    X_obs = data.X_obs.iloc[:N_PREDICTION_ROWS]
+
+    base_folder = tempfile.mkdtemp()
+    model_folder = join(base_folder, "model")
+    model.save_model(model_folder)
+
+    netcdf_file = join(base_folder, "draws.netcdf")
+    model.samples.to_netcdf(netcdf_file)
+    print(f"{'netCDF':<25} {os.path.getsize(netcdf_file) / 1e6:8.2f} MB")
+
+    reference = None
+
+    for cur_name, cur_policy in POLICIES.items():
+
+        save_draw_store(
+            model.samples,
+            model.design_info["species_names"],
+            join(model_folder, DRAW_STORE_FILE),
+            **cur_policy,
+        )
+
+        size = os.path.getsize(join(model_folder, DRAW_STORE_FILE))
+        cur_time, cur_predictions = time_prediction(model_folder, X, X_obs)
+
+        if reference is None:
+            reference = cur_predictions
+
+        print(
+            f"{cur_name:<25} {size / 1e6:8.2f} MB, predicted in {cur_time:6.2f}s, "
+            f"max abs difference {np.abs(cur_predictions - reference).max():.1e}"
+        )
+
+    shutil.rmtree(base_folder)
@@ -0,0 +1,71 @@
+# Compares the EM engine (EMOccu) to direct maximum likelihood (MaxLikOccu) on
+# the example data and on simulated data of increasing size.
+#
+# Usage: python benchmark_em_occu.py [target_csv]
+import sys
+import numpy as np
+import pandas as pd
+from benchmark_utils import prepare_example_data, time_fit
+from occu_py.max_lik_occu import MaxLikOccu
+from occu_py.em_occu import EMOccu
+from occu_py.simulation import simulate_checklist_data
+
+SIMULATED_SIZES = [(1000, 8000), (10000, 80000), (50000, 400000)]
+SIM_OBS_FORMULA = "protocol_type + log_duration_z"
+
+
+def summarise(model, runtime):
+
+    neg_log_liks = [float(x["opt_result"].fun) for x in model.fit_results]
+    successful = [bool(x["optimisation_successful"]) for x in model.fit_results]
+
+    return {
+        "runtime": runtime,
+        "total_neg_log_lik": np.sum(neg_log_liks),
+        "fraction_converged": np.mean(successful),
+    }
+
+
+def benchmark(data, env_formula, obs_formula):
+
+    models = {
+        "max_lik_trust_ncg": MaxLikOccu(env_formula, obs_formula),
+        "max_lik_newton": MaxLikOccu(env_formula, obs_formula, solver="newton"),
+        "em": EMOccu(env_formula, obs_formula),
+    }
+
+    return {
+        name: summarise(model, time_fit(model, data)) for name, model in models.items()
+    }
+
+
+results = dict()
+
+example_data = prepare_example_data()
+results["example"] = benchmark(
+    example_data, example_data["env_formula"], example_data["obs_formula"]
+)
+
+for n_cells, n_checklists in SIMULATED_SIZES:
+
+    simulated, _ = simulate_checklist_data(n_cells=n_cells, n_checklists=n_checklists)
+
+    env_formula = "+".join(simulated.X_env.columns)
+
+    data = {
+        "X_env": simulated.X_env,
+        "X_checklist": simulated.X_obs,
+        "y_checklist": simulated.y_obs,
+        "checklist_cell_ids": simulated.env_cell_ids,
+    }
+
+    results[f"simulated_{n_checklists}"] = benchmark(data, env_formula, SIM_OBS_FORMULA)
+
+results = pd.concat(
+    {x: pd.DataFrame(y).T for x, y in results.items()}, names=["dataset", "model"]
+)
+
+print(results.to_string())
+
+if len(sys.argv) > 1:
+    results.to_csv(sys.argv[1])
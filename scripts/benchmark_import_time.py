@@ -0,0 +1,94 @@
+# Measures how long each occu_py module takes to import, in a fresh interpreter,
+# and checks that modules do not load heavy dependencies (JAX, arviz,
+# scikit-learn, ...) until they are needed. Exits with a non-zero status if a
+# module exceeds its time budget or imports a forbidden module.
+#
+# Usage: python benchmark_import_time.py [n_repeats]
+import sys
+import json
+import subprocess
+
+# Module: (time budget in seconds, modules which must not be imported).
+# numpy, pandas and patsy take about 0.15s together; JAX and arviz take about
+# 0.3s and 0.9s respectively.
+BUDGETS = {
+    "occu_py": (0.05, ["numpy", "pandas", "jax"]),
+    "occu_py.predictor_runtime": (0.15, ["pandas", "patsy", "jax", "scipy"]),
+    "occu_py.checklist_dataset": (0.4, ["jax", "sklearn", "ml_tools"]),
+    "occu_py.simulation": (0.4, ["jax", "scipy"]),
+    "occu_py.cross_validation": (0.4, ["jax", "sklearn"]),
+    "occu_py.evaluation": (0.4, ["jax", "scipy", "sklearn"]),
+    "occu_py.prediction_store": (0.4, ["jax", "scipy", "sklearn"]),
+    "occu_py.fit_cache": (0.4, ["jax", "arviz", "sklearn"]),
+    "occu_py.max_lik_occu": (0.4, ["jax", "arviz", "sklearn", "tqdm"]),
+    "occu_py.em_occu": (0.4, ["jax", "arviz", "sklearn", "tqdm"]),
+    "occu_py.export": (0.4, ["jax", "arviz", "sklearn"]),
+    "occu_py.multi_species_occu_advi": (0.5, ["jax", "arviz", "sklearn"]),
+    "occu_py.multi_species_occu_mcmc": (0.5, ["jax", "arviz", "sklearn"]),
+    "occu_py.multi_species_occu_laplace": (0.5, ["jax", "arviz", "sklearn"]),
+    "occu_py.multi_species_occu_stan": (0.5, ["jax", "arviz", "sklearn"]),
+    "occu_py.multi_species_presence_absence": (0.5, ["jax", "arviz", "sklearn"]),
+}
+
+MEASURE_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"time": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def measure_import(module):
+    # Imports the module in a new interpreter, returning the time taken and the
+    # top-level names of all modules loaded. Raises an ImportError if the import
+    # fails.
+
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE_CODE.format(module=module)],
+        capture_output=True,
+        text=True,
+    )
+
+    if result.returncode != 0:
+        # The last line of the traceback names the error.
+        raise ImportError(result.stderr.strip().split("\n")[-1])
+
+    output = json.loads(result.stdout.strip().split("\n")[-1])
+
+    return output["time"], {x.split(".")[0] for x in output["modules"]}
+
+
+if __name__ == "__main__":
+
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    violations = list()
+
+    for cur_module, (cur_budget, cur_forbidden) in BUDGETS.items():
+
+        try:
+            measurements = [measure_import(cur_module) for _ in range(n_repeats)]
+        except ImportError as error:
+            print(f"{cur_module:<40} failed to import: {error}")
+            violations.append(f"{cur_module} failed to import: {error}")
+            continue
+
+        best_time = min(x[0] for x in measurements)
+        loaded = measurements[0][1]
+
+        forbidden_loaded = [x for x in cur_forbidden if x in loaded]
+
+        print(
+            f"{cur_module:<40} {best_time:6.3f}s (budget {cur_budget:.2f}s)"
+            + (f" loads {forbidden_loaded}" if forbidden_loaded else "")
+        )
+
+        if best_time > cur_budget:
+            violations.append(f"{cur_module} took {best_time:.3f}s")
+
+        if forbidden_loaded:
+            violations.append(f"{cur_module} imports {forbidden_loaded}")
+
+    if violations:
+        print("\n".join(["Violations:"] + violations))
+        sys.exit(1)
@@ -0,0 +1,206 @@
+# Compares the precisions of occu_py.precision against full double precision:
+# the error of the hierarchical models' log likelihood and of the maximum
+# likelihood estimates, the time taken for the likelihood (with its gradient)
+# and for the fit, and the memory taken by the design matrices. None is JAX's
+# default, i.e. float32 throughout.
+#
+# It then checks that single precision fits (float32 designs with float64
+# sums) match double precision ones within FIT_TOLERANCES, for MaxLikOccu on
+# the benchmark data and for the ADVI and MCMC models on a smaller dataset,
+# and exits with a non-zero status if one does not.
+#
+# Usage: python benchmark_precision.py
+import sys
+import time
+import numpy as np
+import jax
+from occu_py.simulation import simulate_checklist_data
+from occu_py.max_lik_occu import MaxLikOccu
+from occu_py.multi_species_occu_advi import MultiSpeciesOccuADVI
+from occu_py.multi_species_occu_mcmc import MultiSpeciesOccuMCMC
+from occu_py.functional.model import calculate_likelihood
+from occu_py.functional.hierarchical_checklist_model_mcmc import (
+    design_env_covs,
+    fetch_env_samples,
+    fetch_obs_samples,
+)
+from occu_py.compact_design import compact_dmatrix
+from occu_py.precision import precision_scope, get_design_dtype
+
+N_CELLS = 5000
+N_CHECKLISTS = 200000
+N_SPECIES = 16
+N_ENV_COVS = 8
+N_REPEATS = 5
+
+PRECISIONS = ["double", "single", None]
+
+# The maximum errors of single precision fits: for MaxLikOccu, the absolute
+# error of the estimates; for the Bayesian models, the error of the posterior
+# means in units of the posterior sd. The MCMC tolerance also covers the Monte
+# Carlo error of the two runs, whose chains diverge once rounding differs.
+FIT_TOLERANCES = {"max_lik": 1e-3, "advi": 0.1, "mcmc": 0.5}
+
+# The smaller dataset the Bayesian models are checked on.
+CHECK_N_CELLS = 500
+CHECK_N_CHECKLISTS = 5000
+CHECK_N_SPECIES = 4
+CHECK_ENV_FORMULA = "env_cov_0 + env_cov_1"
+
+ENV_FORMULA = " + ".join(f"env_cov_{i}" for i in range(N_ENV_COVS))
+OBS_FORMULA = "protocol_type + log_duration_z"
+
+
+def benchmark_likelihood(data, precision):
+    # Returns the log likelihood and its gradient at a fixed point, the time
+    # taken to compute them, and the size of the designs.
+
+    with precision_scope(precision):
+
+        dtype = get_design_dtype(precision)
+        X_env, _, _ = design_env_covs(data.X_env, ENV_FORMULA, dtype=dtype)
+        X_obs, _ = compact_dmatrix(OBS_FORMULA, data.X_obs, dtype=dtype)
+
+        theta = {
+            "env_slopes": np.full((X_env.shape[1], N_SPECIES), 0.1),
+            "env_intercepts": np.full(N_SPECIES, -0.5),
+            "obs_coefs": np.linspace(-1.0, 1.0, X_obs.shape[1] * N_SPECIES).reshape(
+                -1, N_SPECIES
+            ),
+        }
+
+        # The data are passed as arguments rather than closed over, so that XLA
+        # does not constant fold the computations on them while compiling.
+        value_and_grad = jax.jit(
+            jax.value_and_grad(
+                lambda x, y, cell_ids: calculate_likelihood(
+                    x, X_env, X_obs, y, cell_ids, precision=precision
+                )
+            )
+        )
+
+        args = (theta, data.y_obs.values, data.env_cell_ids)
+        jax.block_until_ready(value_and_grad(*args))
+
+        start = time.perf_counter()
+
+        for _ in range(N_REPEATS):
+            value, grad = jax.block_until_ready(value_and_grad(*args))
+
+        elapsed = (time.perf_counter() - start) / N_REPEATS
+
+    return (
+        float(value),
+        np.asarray(grad["obs_coefs"]),
+        elapsed,
+        X_env.nbytes + X_obs.nbytes,
+    )
+
+
+def benchmark_fit(data, precision):
+    # Returns the maximum likelihood estimates and the time taken to fit them.
+
+    model = MaxLikOccu(ENV_FORMULA, OBS_FORMULA, solver="newton", precision=precision)
+
+    start = time.perf_counter()
+    model.fit(data.X_env, data.X_obs, data.y_obs, data.env_cell_ids)
+    elapsed = time.perf_counter() - start
+
+    coefs = np.concatenate([model.env_coef_matrix, model.obs_coef_matrix])
+    n_failed = sum(not x["optimisation_successful"] for x in model.fit_results)
+
+    return coefs, elapsed, n_failed
+
+
+def summarise_posterior(model):
+    # Returns the posterior means and sds of all coefficients.
+
+    env_slopes, env_intercepts = fetch_env_samples(model.samples)
+    draws = np.concatenate(
+        [
+            np.reshape(x, (x.shape[0], -1))
+            for x in [env_slopes, env_intercepts, fetch_obs_samples(model.samples)]
+        ],
+        axis=1,
+    )
+
+    return draws.mean(axis=0), draws.std(axis=0)
+
+
+def check_bayesian_fit(create_model, data):
+    # Returns the maximum error of the posterior means of a single precision
+    # fit, in units of the posterior sd of the double precision fit.
+
+    summaries = dict()
+
+    for cur_precision in ["double", "single"]:
+        model = create_model(cur_precision)
+        model.fit(data.X_env, data.X_obs, data.y_obs, data.env_cell_ids)
+        summaries[cur_precision] = summarise_posterior(model)
+
+    (ref_means, ref_sds), (means, _) = summaries["double"], summaries["single"]
+
+    return np.max(np.abs(means - ref_means) / ref_sds)
+
+
+if __name__ == "__main__":
+
+    data, _ = simulate_checklist_data(
+        n_cells=N_CELLS,
+        n_checklists=N_CHECKLISTS,
+        n_species=N_SPECIES,
+        n_env_covs=N_ENV_COVS,
+    )
+
+    results = {
+        x: (benchmark_likelihood(data, x), benchmark_fit(data, x)) for x in PRECISIONS
+    }
+
+    (ref_value, ref_grad, _, _), (ref_coefs, _, _) = results["double"]
+
+    for cur_precision, cur_results in results.items():
+
+        (value, grad, lik_time, design_bytes), (coefs, fit_time, n_failed) = cur_results
+
+        print(
+            f"{str(cur_precision):<7} designs {design_bytes / 1e6:6.1f} MB; "
+            f"likelihood and gradient in {lik_time:.3f}s, relative error "
+            f"{abs(value - ref_value) / abs(ref_value):.1e} (gradient "
+            f"{np.abs(grad - ref_grad).max() / np.abs(ref_grad).max():.1e}); "
+            f"fit in {fit_time:.1f}s, max coef error "
+            f"{np.abs(coefs - ref_coefs).max():.1e}, {n_failed} not converged"
+        )
+
+    check_data, _ = simulate_checklist_data(
+        n_cells=CHECK_N_CELLS,
+        n_checklists=CHECK_N_CHECKLISTS,
+        n_species=CHECK_N_SPECIES,
+    )
+
+    errors = {
+        "max_lik": np.abs(results["single"][1][0] - ref_coefs).max(),
+        "advi": check_bayesian_fit(
+            lambda x: MultiSpeciesOccuADVI(
+                CHECK_ENV_FORMULA, OBS_FORMULA, verbose_fit=False, precision=x
+            ),
+            check_data,
+        ),
+        "mcmc": check_bayesian_fit(
+            lambda x: MultiSpeciesOccuMCMC(
+                CHECK_ENV_FORMULA, OBS_FORMULA, n_draws=500, n_tune=500, precision=x
+            ),
+            check_data,
+        ),
+    }
+
+    failed = [x for x, y in errors.items() if y > FIT_TOLERANCES[x]]
+
+    for cur_name, cur_error in errors.items():
+        print(
+            f"{cur_name:<8} single precision error {cur_error:.1e} "
+            f"(tolerance {FIT_TOLERANCES[cur_name]:.0e})"
+        )
+
+    if failed:
+        print(f"Single precision fits outside tolerance: {', '.join(failed)}")
+        sys.exit(1)
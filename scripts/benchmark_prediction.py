@@ -0,0 +1,93 @@
+# Compares MaxLikOccu's vectorised prediction to the previous approach, which
+# built the design matrices and predicted one species at a time.
+#
+# Usage: python benchmark_prediction.py [target_csv]
+import sys
+import time
+import numpy as np
+import pandas as pd
+from jax.nn import log_sigmoid
+from occu_py.max_lik_occu import MaxLikOccu
+from occu_py.simulation import simulate_checklist_data
+from occu_py.functional.max_lik_occu_model import predict_env_logit, predict_obs_logit
+
+N_SPECIES = 600
+N_PREDICTION_ROWS = [1000, 10000, 100000]
+OBS_FORMULA = "protocol_type + log_duration_z"
+
+
+def predict_obs_per_species(model, X, X_obs):
+
+    predictions = list()
+
+    for cur_fit_result in model.fit_results:
+
+        cur_env_prediction = predict_env_logit(
+            X, model.env_design_info, cur_fit_result["env_coefs"]
+        )
+
+        cur_obs_prediction = predict_obs_logit(
+            X_obs, model.obs_design_info, cur_fit_result["obs_coefs"]
+        )
+
+        predictions.append(
+            np.exp(log_sigmoid(cur_env_prediction) + log_sigmoid(cur_obs_prediction))
+        )
+
+    return pd.DataFrame(np.stack(predictions, axis=1), columns=model.species_names)
+
+
+def time_call(fun):
+
+    start_time = time.time()
+    result = fun()
+
+    return time.time() - start_time, result
+
+
+simulated, _ = simulate_checklist_data(
+    n_cells=500, n_checklists=4000, n_species=N_SPECIES
+)
+
+model = MaxLikOccu("+".join(simulated.X_env.columns), OBS_FORMULA, solver="newton")
+
+model.fit(simulated.X_env, simulated.X_obs, simulated.y_obs, simulated.env_cell_ids)
+
+results = list()
+
+for n_rows in N_PREDICTION_ROWS:
+
+    # Resample the simulated cells and checklists to the required size.
+    env_rows = np.random.randint(simulated.X_env.shape[0], size=n_rows)
+    obs_rows = np.random.randint(simulated.X_obs.shape[0], size=n_rows)
+
+    X = simulated.X_env.iloc[env_rows].reset_index(drop=True)
+    X_obs = simulated.X_obs.iloc[obs_rows].reset_index(drop=True)
+
+    runtime_old, reference = time_call(lambda: predict_obs_per_species(model, X, X_obs))
+
+    for dtype in [np.float32, np.float64]:
+
+        runtime_new, prediction = time_call(
+            lambda: model.predict_marginal_probabilities_obs(X, X_obs, dtype=dtype)
+        )
+
+        results.append(
+            {
+                "n_rows": n_rows,
+                "dtype": dtype.__name__,
+                "runtime_per_species": runtime_old,
+                "runtime_vectorised": runtime_new,
+                "speedup": runtime_old / runtime_new,
+                "max_abs_difference": np.max(
+                    np.abs(prediction.values - reference.values)
+                ),
+            }
+        )
+
+results = pd.DataFrame(results)
+
+print(results)
+
+if len(sys.argv) > 1:
+    results.to_csv(sys.argv[1])
@@ -0,0 +1,92 @@
+# Compares writing predictions of a maximum likelihood model to CSV, as
+# evaluate_ebird.py used to, against writing them to a prediction store (see
+# occu_py/prediction_store.py), and reading back a few species from each.
+#
+# Usage: python benchmark_prediction_store.py
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from os.path import join
+from occu_py.simulation import simulate_checklist_data
+from occu_py.max_lik_occu import MaxLikOccu
+from occu_py.prediction_store import PredictionStore
+from occu_py.fit_cache import get_folder_size
+
+N_SPECIES = 256
+N_PREDICTION_ROWS = 100000
+N_SPECIES_READ = 4
+
+ENV_FORMULA = " + ".join(f"env_cov_{i}" for i in range(4))
+OBS_FORMULA = "protocol_type + log_duration_z"
+
+
+def time_call(fun):
+
+    start = time.perf_counter()
+    result = fun()
+
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+
+    data, _ = simulate_checklist_data(
+        n_cells=1000, n_checklists=8000, n_species=N_SPECIES
+    )
+
+    model = MaxLikOccu(ENV_FORMULA, OBS_FORMULA, solver="newton")
+    model.fit(data.X_env, data.X_obs, data.y_obs, data.env_cell_ids)
+
+    # Predict for checklists drawn with replacement from the simulated ones.
+    choice = np.random.default_rng(2).integers(
+        0, data.X_obs.shape[0], N_PREDICTION_ROWS
+    )
+    X = data.X_env.iloc[data.env_cell_ids[choice]]
+    X_obs = data.X_obs.iloc[choice].reset_index(drop=True)
+    species_indices = list(range(0, N_SPECIES, N_SPECIES // N_SPECIES_READ))
+    species = list(data.y_obs.columns[species_indices])
+
+    base_folder = tempfile.mkdtemp()
+    csv_file = join(base_folder, "obs_preds.csv")
+    store_folder = join(base_folder, "obs_preds")
+
+    predict_time, predictions = time_call(
+        lambda: model.predict_marginal_probabilities_obs(X, X_obs)
+    )
+    csv_time, _ = time_call(lambda: predictions.to_csv(csv_file))
+    store_time, _ = time_call(
+        lambda: model.predict_marginal_probabilities_to_store(store_folder, X, X_obs)
+    )
+
+    csv_read_time, from_csv = time_call(
+        # The first column is the index.
+        lambda: pd.read_csv(
+            csv_file, index_col=0, usecols=[0] + [x + 1 for x in species_indices]
+        )
+    )
+    store_read_time, from_store = time_call(
+        lambda: PredictionStore(store_folder).get(species)
+    )
+
+    print(f"Prediction alone: {predict_time:.2f}s")
+    print(
+        f"{'CSV':<20} written in {csv_time:6.2f}s, "
+        f"{os.path.getsize(csv_file) / 1e6:8.1f} MB, "
+        f"{N_SPECIES_READ} species read in {csv_read_time:.2f}s"
+    )
+    print(
+        f"{'Store (predicted)':<20} written in {store_time:6.2f}s, "
+        f"{get_folder_size(store_folder) / 1e6:8.1f} MB, "
+        f"{N_SPECIES_READ} species read in {store_read_time:.3f}s"
+    )
+    print(
+        "Max abs difference: "
+        f"{np.abs(from_store.values - predictions[species].values).max():.1e} "
+        f"(store), {np.abs(from_csv.values - predictions[species].values).max():.1e} "
+        "(CSV)"
+    )
+
+    shutil.rmtree(base_folder)
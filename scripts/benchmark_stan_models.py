@@ -0,0 +1,33 @@
+# Compares the runtime of the original Stan model (checklist_model.stan) and
+# the vectorised, cell-grouped one (checklist_model_grouped.stan) on the
+# example data.
+#
+# Usage: python benchmark_stan_models.py [n_species]
+import sys
+import pandas as pd
+from benchmark_utils import prepare_example_data, time_fit
+from occu_py.multi_species_occu_stan import (
+    MultiSpeciesOccuStan,
+    LOOP_MODEL_FILE,
+    GROUPED_MODEL_FILE,
+)
+
+data = prepare_example_data()
+
+if len(sys.argv) > 1:
+    data["y_checklist"] = data["y_checklist"].iloc[:, : int(sys.argv[1])]
+
+models = {
+    "loop": MultiSpeciesOccuStan(
+        LOOP_MODEL_FILE, data["env_formula"], data["obs_formula"]
+    ),
+    "grouped": MultiSpeciesOccuStan(
+        GROUPED_MODEL_FILE, data["env_formula"], data["obs_formula"]
+    ),
+}
+
+runtimes = pd.Series({name: time_fit(model, data) for name, model in models.items()})
+
+print("Runtimes in seconds:")
+print(runtimes)
+print(f"Speedup: {runtimes['loop'] / runtimes['grouped']:.2f}x")
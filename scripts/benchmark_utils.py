@@ -0,0 +1,67 @@
+# Shared helpers for the benchmark scripts in this folder.
+import os
+import time
+import pandas as pd
+from ml_tools.patsy import create_formula
+from occu_py.checklist_dataset import load_example_dataset
+
+EXAMPLE_DATA_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "examples", "data"
+)
+
+OBS_FORMULA = "protocol_type + daytimes_alt + log_duration_z + dominant_land_cover"
+
+
+def prepare_example_data(data_dir=EXAMPLE_DATA_DIR):
+    # Loads the example data and preprocesses it as in examples/R: the bio
+    # covariates are standardised, the has_ covariates added as indicators and
+    # log duration standardised.
+
+    data = load_example_dataset(data_dir)
+
+    bio_covs = [x for x in data.X_env.columns if "bio" in x]
+    has_covs = [x for x in data.X_env.columns if x.startswith("has_")]
+
+    X_bio = data.X_env[bio_covs]
+    X_env = pd.concat(
+        [(X_bio - X_bio.mean()) / X_bio.std(), data.X_env[has_covs]], axis=1
+    )
+
+    X_checklist = data.X_obs.copy()
+    log_duration = X_checklist["log_duration"]
+    X_checklist["log_duration_z"] = (
+        log_duration - log_duration.mean()
+    ) / log_duration.std()
+
+    env_formula = create_formula(
+        bio_covs,
+        main_effects=True,
+        quadratic_effects=True,
+        interactions=False,
+        intercept=True,
+    )
+    env_formula = env_formula + "+" + "+".join(has_covs)
+
+    return {
+        "X_env": X_env,
+        "X_checklist": X_checklist,
+        "y_checklist": data.y_obs,
+        "checklist_cell_ids": data.env_cell_ids,
+        "env_formula": env_formula,
+        "obs_formula": OBS_FORMULA,
+    }
+
+
+def time_fit(model, data):
+    # Fits the model and returns the runtime in seconds.
+
+    start_time = time.time()
+
+    model.fit(
+        X_env=data["X_env"],
+        X_checklist=data["X_checklist"],
+        y_checklist=data["y_checklist"],
+        checklist_cell_ids=data["checklist_cell_ids"],
+    )
+
+    return time.time() - start_time
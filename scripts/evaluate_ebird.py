@@ -1,175 +1,248 @@
+# Runs a grid of experiments on the eBird dataset. Each combination of model,
+# subset size, min_presences, M and precision in the grid is fitted to a random
+# subset of the training checklists and evaluated on the test set.
+#
+# The dataset is loaded and prepared once and stored in target_dir, from where
+# the workers read it. The experiments run in a pool of worker processes, one
+# process per experiment, each pinned to its own cpus_per_task CPUs and, if
+# memory_gb_per_task is given, with its memory limited (see limit_resources).
+# Each experiment writes its saved model, predictions (as prediction stores,
+# see occu_py.prediction_store), held-out metrics (see occu_py.evaluation),
+# runtime and a cProfile of the fit to its own folder in target_dir (along
+# with its subset of the data), and a row to target_dir/results_index.csv when
+# it finishes.
+# Experiments already in the index are skipped when the grid is run again;
+# those that failed are retried.
+#
+# Usage: python evaluate_ebird.py grid_file target_dir [n_workers]
+#   [cpus_per_task] [memory_gb_per_task] [fit_cache_dir]
+#
+# The grid file is a JSON file with lists of values for each setting, e.g.
+#
+# {"model": ["max_lik", "vi"], "subset_size": [10000, -1],
+#  "min_presences": [5], "M": [20], "precision": ["single", "double"]}
+#
+# where a subset size of -1 uses all training checklists and M is only used
+# by the "vi" model. The models are "max_lik", "vi", "numpyro", "stan" and
+# "presence_absence", the baseline without detection. The grid can also set
+# "use_gpu": true, in which case all experiments run on the GPU and n_workers
+# should be 1.
+import os
 import sys
+import json
+import time
+import pickle
+import cProfile
+import resource
+import itertools
+import numpy as np
+import pandas as pd
+from os.path import join
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+MODEL_NAMES = ["numpyro", "vi", "max_lik", "stan", "presence_absence"]
+GRID_KEYS = ["model", "subset_size", "min_presences", "M", "precision"]
+
+PREPARED_DATA_FILE = "prepared_data.pkl"
+RESULTS_INDEX_FILE = "results_index.csv"
+
+OBS_FORMULA = "protocol_type + daytimes_alt + log_duration_z + dominant_land_cover"
+
+CHECKLIST_COLUMNS = [
+    "protocol_type",
+    "log_duration",
+    "time_of_day",
+    "dominant_land_cover",
+    "daytimes_alt",
+]
+
+
+def prepare_dataset():
+    # Loads the eBird dataset and derives the covariates and formulas shared by
+    # all experiments.
+    from ml_tools.patsy import create_formula
+    from occu_py.checklist_dataset import load_ebird_dataset_using_env_var
+
+    ebird_dataset = load_ebird_dataset_using_env_var()
+    train_set = ebird_dataset["train"]
+    test_set = ebird_dataset["test"]
+
+    bio_covs = [x for x in train_set.X_env.columns if "bio" in x]
+    has_covs = [x for x in train_set.X_env.columns if x.startswith("has_")]
+
+    # The intercept included here will be removed for the Bayesian models --
+    # this is not pretty but necessary for things to work as they should with
+    # patsy. The maximum likelihood model keeps it.
+    env_formula = create_formula(
+        bio_covs,
+        main_effects=True,
+        quadratic_effects=True,
+        interactions=False,
+        intercept=True,
+    )
+    env_formula = env_formula + "+" + "+".join(has_covs)
+
+    return {
+        "train": train_set._replace(
+            X_env=train_set.X_env[bio_covs + has_covs],
+            X_obs=train_set.X_obs[CHECKLIST_COLUMNS],
+        ),
+        "test": test_set._replace(
+            X_env=test_set.X_env[bio_covs + has_covs],
+            X_obs=test_set.X_obs[CHECKLIST_COLUMNS],
+        ),
+        "bio_covs": bio_covs,
+        "has_covs": has_covs,
+        "env_formula": env_formula,
+    }
+
+
+def get_experiment_name(config):
+
+    return (
+        f"{config['model']}_{config['precision']}_n{config['subset_size']}"
+        f"_min{config['min_presences']}_M{config['M']}"
+    )
 
 
-model_name = sys.argv[1]
-use_double_precision = sys.argv[2] == "double"
-use_gpu = sys.argv[3] == "gpu"
-subset_size = int(sys.argv[4])
-min_presences = int(sys.argv[5])
-M = int(sys.argv[6])
-target_dir = sys.argv[7]
+def expand_grid(grid):
+    # Returns one config per combination of the values in the grid.
 
-assert sys.argv[2] in ["float", "double"]
-assert sys.argv[3] in ["gpu", "cpu"]
-assert model_name in ["numpyro", "vi", "max_lik", "stan"]
+    values = [grid[x] for x in GRID_KEYS]
 
-if use_double_precision:
-    print("Using double precision")
-    from jax.config import config
+    return [dict(zip(GRID_KEYS, x)) for x in itertools.product(*values)]
 
-    config.update("jax_enable_x64", True)
 
-import numpyro
+def create_model(config, env_formula, use_gpu):
 
-if use_gpu:
-    numpyro.set_platform("gpu")
-else:
-    numpyro.set_host_device_count(4)
+    from occu_py.multi_species_occu_advi import MultiSpeciesOccuADVI
+    from occu_py.multi_species_occu_mcmc import MultiSpeciesOccuMCMC
+    from occu_py.max_lik_occu import MaxLikOccu
+    from occu_py.multi_species_occu_stan import MultiSpeciesOccuStan, LOOP_MODEL_FILE
+    from occu_py.multi_species_presence_absence import MultiSpeciesPresenceAbsence
 
-import os
-import time
-import numpy as np
-from ml_tools.patsy import create_formula
-from ml_tools.utils import save_pickle_safely
-from occu_py.checklist_dataset import (
-    load_ebird_dataset_using_env_var,
-    random_checklist_subset,
-)
-import pandas as pd
-from sklearn.preprocessing import StandardScaler
-
-from occu_py.multi_species_occu_advi import MultiSpeciesOccuADVI
-from occu_py.multi_species_occu_mcmc import MultiSpeciesOccuMCMC
-from occu_py.max_lik_occu import MaxLikOccu
-from occu_py.multi_species_occu_stan import MultiSpeciesOccuStan
-
-
-ebird_dataset = load_ebird_dataset_using_env_var()
-train_set = ebird_dataset["train"]
-bio_covs = [x for x in train_set.X_env.columns if "bio" in x]
-train_covs = train_set.X_env
-
-stan_model_path = "/home/martin/projects/occu_py/occu_py/checklist_model.stan"
-
-# min_presences = 5
-# n_species = 4
-n_species = None
-
-# Make a subset of the training checklists
-np.random.seed(2)
-
-if subset_size == -1:
-    # Use full dataset
-    subset_size = train_set.X_obs.shape[0]
-
-subsetting_result = random_checklist_subset(
-    train_set.X_obs.shape[0], train_set.env_cell_ids, subset_size
-)
-
-choice = subsetting_result["checklist_indices"]
-species_counts = train_set.y_obs.iloc[choice].sum()
-species_subset = species_counts[species_counts >= min_presences].index
-
-if n_species is not None:
-    species_subset = species_subset[
-        np.random.choice(len(species_subset), size=n_species, replace=False)
-    ]
-
-test_set = ebird_dataset["test"]
-test_covs = test_set.X_env
-test_y = test_set.y_obs
-test_cell_ids = test_set.env_cell_ids
-
-# Check that all the required fields are present
-for cur_field in ["time_of_day", "protocol_type"]:
-    unique_test = test_set.X_obs[cur_field].unique()
-    unique_train = train_set.X_obs.iloc[choice][cur_field].unique()
-    print(cur_field, unique_test, unique_train)
-    assert set(unique_test) == set(unique_train)
-
-# Note that intercept included here will be removed -- this is not pretty but
-# necessary for things to work as they should with patsy.
-env_formula = create_formula(
-    bio_covs,
-    main_effects=True,
-    quadratic_effects=True,
-    interactions=False,
-    intercept=True,
-)
-
-# Add on the other ones
-to_add = [x for x in train_set.X_env.columns if x.startswith("has_")]
-
-combined = "+".join(to_add)
-
-train_covs = train_covs[bio_covs + to_add]
-test_covs = test_covs[bio_covs + to_add]
-
-env_formula = env_formula + "+" + combined
-
-print(env_formula)
-
-# Same but includes an intercept term
-env_formula_max_lik = create_formula(
-    bio_covs,
-    main_effects=True,
-    quadratic_effects=True,
-    interactions=False,
-    intercept=True,
-)
-env_formula_max_lik = env_formula_max_lik + "+" + combined
-
-obs_formula = "protocol_type + daytimes_alt + log_duration_z + dominant_land_cover"
-
-chain_method = "vectorized" if use_gpu else "parallel"
-suffix = "_gpu" if use_gpu else "_cpu"
-suffix = suffix + "_double" if use_double_precision else suffix + "_float"
-
-models = {
-    "numpyro"
-    + suffix: MultiSpeciesOccuMCMC(
-        env_formula,
-        obs_formula,
-        n_draws=1000,
-        n_tune=1000,
-        thinning=4,
-        chain_method=chain_method,
-    ),
-    "vi": MultiSpeciesOccuADVI(env_formula=env_formula, obs_formula=obs_formula, M=M),
-    "max_lik": MaxLikOccu(env_formula_max_lik, obs_formula),
-    "stan": MultiSpeciesOccuStan(stan_model_path, env_formula, obs_formula),
-}
-
-# Fit only model indicated
-models = {
-    x: y for x, y in models.items() if x == model_name or x == model_name + suffix
-}
-
-os.makedirs(target_dir, exist_ok=True)
-
-for cur_model_name, model in models.items():
-
-    X_env = train_covs.iloc[subsetting_result["env_cell_indices"]]
-    X_checklist = train_set.X_obs.iloc[choice][
-        [
-            "protocol_type",
-            "log_duration",
-            "time_of_day",
-            "dominant_land_cover",
-            "daytimes_alt",
-        ]
-    ]
+    model_name, precision = config["model"], config["precision"]
+
+    if model_name == "numpyro":
+        return MultiSpeciesOccuMCMC(
+            env_formula,
+            OBS_FORMULA,
+            n_draws=1000,
+            n_tune=1000,
+            thinning=4,
+            chain_method="vectorized" if use_gpu else "parallel",
+            precision=precision,
+        )
+    elif model_name == "vi":
+        return MultiSpeciesOccuADVI(
+            env_formula=env_formula,
+            obs_formula=OBS_FORMULA,
+            M=config["M"],
+            precision=precision,
+        )
+    elif model_name == "max_lik":
+        return MaxLikOccu(env_formula, OBS_FORMULA, precision=precision)
+    elif model_name == "presence_absence":
+        return MultiSpeciesPresenceAbsence(env_formula)
+    else:
+        return MultiSpeciesOccuStan(LOOP_MODEL_FILE, env_formula, OBS_FORMULA)
+
+
+def limit_resources(cpu_queue, memory_bytes, use_gpu):
+    # Pins this process to a set of CPUs from the queue and limits its memory.
+    # Returns the CPUs, which must be put back on the queue when done.
+
+    cpus = cpu_queue.get()
+    os.sched_setaffinity(0, cpus)
+
+    if memory_bytes is not None:
+        # This limits the data segment, i.e. the heap and private anonymous
+        # mappings, rather than the address space: JAX reserves far more
+        # address space than it uses, especially on the GPU, so that with
+        # RLIMIT_AS it fails well below the limit. Memory-mapped files, such
+        # as restored draws and prediction stores, do not count.
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_bytes, memory_bytes))
+
+    # This must happen before JAX is first used.
+    import numpyro
+
+    if use_gpu:
+        numpyro.set_platform("gpu")
+    else:
+        numpyro.set_host_device_count(len(cpus))
+
+    return cpus
+
+
+def run_experiment(config, target_dir, cpu_queue, memory_bytes, fit_cache_dir, use_gpu):
+    # Fits and evaluates the model of one config in its own worker process,
+    # returning the row of the results index.
+
+    cpus = limit_resources(cpu_queue, memory_bytes, use_gpu)
+
+    try:
+        return fit_and_evaluate(config, target_dir, fit_cache_dir, use_gpu)
+    finally:
+        cpu_queue.put(cpus)
+
+
+def fit_and_evaluate(config, target_dir, fit_cache_dir, use_gpu):
+
+    from occu_py.checklist_dataset import random_checklist_subset
+    from occu_py.compilation_cache import (
+        enable_compilation_cache,
+        get_compilation_cache_stats,
+    )
+    from occu_py.fit_cache import FitCache
+    from occu_py.evaluation import compute_metrics_from_store
+    from ml_tools.utils import save_pickle_safely
+    from sklearn.preprocessing import StandardScaler
+
+    # Reuse the compiled fits of earlier experiments with the same structure.
+    enable_compilation_cache()
+
+    with open(join(target_dir, PREPARED_DATA_FILE), "rb") as f:
+        prepared = pickle.load(f)
+
+    train_set, test_set = prepared["train"], prepared["test"]
+    bio_covs, has_covs = prepared["bio_covs"], prepared["has_covs"]
+
+    experiment_name = get_experiment_name(config)
+    cur_target_dir = join(target_dir, experiment_name)
+    os.makedirs(cur_target_dir, exist_ok=True)
+
+    subset_size = config["subset_size"]
+
+    if subset_size == -1:
+        # Use full dataset
+        subset_size = train_set.X_obs.shape[0]
+
+    subsetting_result = random_checklist_subset(
+        train_set.X_obs.shape[0], train_set.env_cell_ids, subset_size
+    )
+
+    choice = subsetting_result["checklist_indices"]
+    species_counts = train_set.y_obs.iloc[choice].sum()
+    species_subset = species_counts[species_counts >= config["min_presences"]].index
+
+    # Check that all the required fields are present
+    for cur_field in ["time_of_day", "protocol_type"]:
+        unique_test = test_set.X_obs[cur_field].unique()
+        unique_train = train_set.X_obs.iloc[choice][cur_field].unique()
+        assert set(unique_test) == set(unique_train), cur_field
+
+    X_env = train_set.X_env.iloc[subsetting_result["env_cell_indices"]]
+    X_checklist = train_set.X_obs.iloc[choice].copy()
     y_checklist = train_set.y_obs[species_subset].iloc[choice]
     checklist_cell_ids = subsetting_result["checklist_cell_ids"]
 
     scaler = StandardScaler()
-    to_scale = bio_covs
-    not_scaled = to_add
     scaled_bio_covs = scaler.fit_transform(X_env[bio_covs])
     X_env_scaled = pd.concat(
         [
             pd.DataFrame(scaled_bio_covs, index=X_env.index, columns=bio_covs),
-            X_env[not_scaled],
+            X_env[has_covs],
         ],
         axis=1,
     )
@@ -182,41 +255,41 @@ for cur_model_name, model in models.items():
         X_checklist["log_duration"] - log_duration_mean
     ) / log_duration_std
 
-    X_env.to_csv(os.path.join(target_dir, "X_env.csv"))
-    X_checklist.to_csv(os.path.join(target_dir, "X_checklist.csv"))
-    y_checklist.to_csv(os.path.join(target_dir, "y_checklist.csv"))
-    np.savez(os.path.join(target_dir, "cell_ids"), checklist_cell_ids)
-
     assert not np.any(X_env.isnull().values)
     assert not np.any(X_checklist.isnull().values)
     assert not np.any(y_checklist.isnull().values)
     assert not np.any(np.isnan(checklist_cell_ids))
 
-    start_time = time.time()
-    model.fit(
-        X_env=X_env_scaled,
-        X_checklist=X_checklist,
-        y_checklist=y_checklist,
-        checklist_cell_ids=checklist_cell_ids,
-    )
-    runtime = time.time() - start_time
-
-    # Evaluate on test set
-    rel_y = test_y[species_subset]
-    rel_covs = test_covs.loc[test_cell_ids]
-
-    scaled_bio_covs = scaler.transform(rel_covs[bio_covs])
-    rel_covs_scaled = pd.concat(
-        [
-            pd.DataFrame(scaled_bio_covs, index=rel_covs.index, columns=bio_covs),
-            rel_covs[not_scaled],
-        ],
-        axis=1,
-    )
+    X_env.to_csv(join(cur_target_dir, "X_env.csv"))
+    X_checklist.to_csv(join(cur_target_dir, "X_checklist.csv"))
+    y_checklist.to_csv(join(cur_target_dir, "y_checklist.csv"))
+    np.savez(join(cur_target_dir, "cell_ids"), checklist_cell_ids)
+
+    model = create_model(config, prepared["env_formula"], use_gpu)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    if fit_cache_dir is None:
+        start_time = time.time()
+        model.fit(
+            X_env=X_env_scaled,
+            X_checklist=X_checklist,
+            y_checklist=y_checklist,
+            checklist_cell_ids=checklist_cell_ids,
+        )
+        fit_info = {"fit_seconds": time.time() - start_time, "hit": False}
+    else:
+        # The runtime is that of the original fit if it was restored.
+        fit_info = FitCache(fit_cache_dir).fit(
+            model, X_env_scaled, X_checklist, y_checklist, checklist_cell_ids
+        )
+
+    profiler.disable()
+    profiler.dump_stats(join(cur_target_dir, "fit_profile.prof"))
 
-    cur_target_dir = target_dir + cur_model_name + "/"
     model.save_model(cur_target_dir)
-    print(runtime, file=open(cur_target_dir + "runtime.txt", "w"))
+    print(fit_info["fit_seconds"], file=open(join(cur_target_dir, "runtime.txt"), "w"))
 
     # Save scaling info
     save_pickle_safely(
@@ -224,25 +297,209 @@ for cur_model_name, model in models.items():
             "env_scaler": scaler,
             "log_duration_mean": log_duration_mean,
             "log_duration_sd": log_duration_std,
-            "env_vars_scaled": to_scale,
-            "env_vars_unscaled": not_scaled,
+            "env_vars_scaled": bio_covs,
+            "env_vars_unscaled": has_covs,
         },
-        os.path.join(cur_target_dir, "scaler.pkl"),
+        join(cur_target_dir, "scaler.pkl"),
+    )
+
+    # Evaluate on test set
+    rel_covs = test_set.X_env.loc[test_set.env_cell_ids]
+    rel_covs_scaled = pd.concat(
+        [
+            pd.DataFrame(
+                scaler.transform(rel_covs[bio_covs]),
+                index=rel_covs.index,
+                columns=bio_covs,
+            ),
+            rel_covs[has_covs],
+        ],
+        axis=1,
     )
 
-    pred_pres_prob = model.predict_marginal_probabilities_direct(rel_covs_scaled)
-    pred_pres_prob.to_csv(os.path.join(cur_target_dir, "pres_preds.csv"))
+    start_time = time.time()
 
-    X_obs_test = test_set.X_obs
+    X_obs_test = test_set.X_obs.copy()
     X_obs_test["log_duration_z"] = (
         X_obs_test["log_duration"] - log_duration_mean
     ) / log_duration_std
 
-    pred_obs_prob = model.predict_marginal_probabilities_obs(
-        rel_covs_scaled, X_obs_test
+    # The predictions are written to prediction stores as they are made.
+    model.predict_marginal_probabilities_to_store(
+        join(cur_target_dir, "pres_preds"), rel_covs_scaled
+    )
+    model.predict_marginal_probabilities_to_store(
+        join(cur_target_dir, "obs_preds"), rel_covs_scaled, X_obs_test
     )
-    pred_obs_prob.to_csv(os.path.join(cur_target_dir, "obs_preds.csv"))
 
-    rel_y.to_csv(os.path.join(cur_target_dir, "y_t.csv"))
+    predict_seconds = time.time() - start_time
 
-    species_counts.to_csv(os.path.join(cur_target_dir, "species_counts.csv"))
+    test_set.y_obs[species_subset].to_csv(join(cur_target_dir, "y_t.csv"))
+    species_counts.to_csv(join(cur_target_dir, "species_counts.csv"))
+
+    # The predictions are streamed from the stores rather than loaded whole.
+    metrics = compute_metrics_from_store(
+        test_set.y_obs[species_subset],
+        join(cur_target_dir, "obs_preds"),
+        join(cur_target_dir, "pres_preds"),
+        test_set.env_cell_ids,
+    )
+    metrics.to_csv(join(cur_target_dir, "metrics.csv"))
+
+    compilation_stats = get_compilation_cache_stats()
+
+    return {
+        **config,
+        "status": "done",
+        "folder": experiment_name,
+        "n_checklists": len(choice),
+        "n_species": len(species_subset),
+        "fit_seconds": fit_info["fit_seconds"],
+        "fit_restored": fit_info["hit"],
+        "predict_seconds": predict_seconds,
+        # On Linux, ru_maxrss is in kilobytes.
+        "peak_memory_gb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20,
+        "compilation_cache_hits": compilation_stats["hits"],
+        "compilation_cache_misses": compilation_stats["misses"],
+        # Means over species; per-species metrics are in metrics.csv.
+        **{f"mean_{x}": y for x, y in metrics.mean().items()},
+        "metrics": join(experiment_name, "metrics.csv"),
+        "profile": join(experiment_name, "fit_profile.prof"),
+        "pres_preds": join(experiment_name, "pres_preds"),
+        "obs_preds": join(experiment_name, "obs_preds"),
+    }
+
+
+def load_results_index(target_dir):
+
+    index_file = join(target_dir, RESULTS_INDEX_FILE)
+
+    if not os.path.isfile(index_file):
+        return pd.DataFrame(columns=GRID_KEYS + ["status"])
+
+    return pd.read_csv(index_file)
+
+
+def run_grid(
+    grid,
+    target_dir,
+    n_workers=1,
+    cpus_per_task=4,
+    memory_gb_per_task=None,
+    fit_cache_dir=None,
+):
+    """Runs the experiments of a grid which are not yet done.
+
+    Args:
+        grid: A dictionary with a list of values for each of GRID_KEYS, and
+            optionally "use_gpu".
+        target_dir: The folder to write the results to.
+        n_workers: The number of experiments to run at once.
+        cpus_per_task: The number of CPUs each experiment is pinned to.
+        memory_gb_per_task: If given, the limit of each experiment's data
+            segment (see limit_resources), in GB.
+        fit_cache_dir: If given, fits are stored in a FitCache in this folder
+            and restored from it.
+
+    Returns:
+        The results index as a DataFrame, with one row per experiment.
+    """
+
+    use_gpu = grid.get("use_gpu", False)
+    configs = expand_grid(grid)
+
+    assert all(x["model"] in MODEL_NAMES for x in configs)
+    assert all(x["precision"] in ["single", "double"] for x in configs)
+
+    os.makedirs(target_dir, exist_ok=True)
+    index = load_results_index(target_dir)
+
+    done = set(index[index["status"] == "done"][GRID_KEYS].astype(str).agg(tuple, 1))
+    pending = [x for x in configs if tuple(str(x[y]) for y in GRID_KEYS) not in done]
+
+    print(f"{len(configs) - len(pending)} experiments done, {len(pending)} to run")
+
+    if len(pending) == 0:
+        return index
+
+    # Only the experiments that are not yet done need the data.
+    with open(join(target_dir, PREPARED_DATA_FILE), "wb") as f:
+        pickle.dump(prepare_dataset(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    available_cpus = sorted(os.sched_getaffinity(0))
+    assert n_workers * cpus_per_task <= len(available_cpus)
+
+    memory_bytes = (
+        None if memory_gb_per_task is None else int(memory_gb_per_task * 2**30)
+    )
+
+    # JAX does not support forking, so the workers are spawned, and each
+    # experiment gets a fresh process.
+    context = get_context("spawn")
+
+    with context.Manager() as manager, ProcessPoolExecutor(
+        n_workers, mp_context=context, max_tasks_per_child=1
+    ) as executor:
+
+        # Each running experiment takes one of these disjoint sets of CPUs.
+        cpu_queue = manager.Queue()
+
+        for i in range(n_workers):
+            cpu_queue.put(available_cpus[i * cpus_per_task : (i + 1) * cpus_per_task])
+
+        futures = {
+            executor.submit(
+                run_experiment,
+                cur_config,
+                target_dir,
+                cpu_queue,
+                memory_bytes,
+                fit_cache_dir,
+                use_gpu,
+            ): cur_config
+            for cur_config in pending
+        }
+
+        for cur_future in as_completed(futures):
+
+            cur_config = futures[cur_future]
+
+            try:
+                cur_row = cur_future.result()
+            except Exception as e:
+                cur_row = {**cur_config, "status": "failed", "error": repr(e)}
+
+            print(get_experiment_name(cur_config), cur_row["status"])
+
+            # Earlier failures of the same config are replaced.
+            is_same = (
+                index[GRID_KEYS].astype(str) == pd.Series(cur_config).astype(str)
+            ).all(axis=1)
+
+            index = pd.concat(
+                [index[~is_same], pd.DataFrame([cur_row])], ignore_index=True
+            )
+            index.to_csv(join(target_dir, RESULTS_INDEX_FILE), index=False)
+
+    return index
+
+
+if __name__ == "__main__":
+
+    with open(sys.argv[1]) as f:
+        grid = json.load(f)
+
+    target_dir = sys.argv[2]
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    cpus_per_task = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    memory_gb_per_task = float(sys.argv[5]) if len(sys.argv) > 5 else None
+    fit_cache_dir = sys.argv[6] if len(sys.argv) > 6 else None
+
+    run_grid(
+        grid,
+        target_dir,
+        n_workers=n_workers,
+        cpus_per_task=cpus_per_task,
+        memory_gb_per_task=memory_gb_per_task,
+        fit_cache_dir=fit_cache_dir,
+    )
@@ -8,4 +8,5 @@ setup(
     version=getenv("VERSION", "LOCAL"),
     description="Occupancy detection modelling in python",
     packages=find_packages(),
+    package_data={"occu_py": ["*.stan"]},
 )